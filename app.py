@@ -1,32 +1,65 @@
 import streamlit as st
+from streamlit.runtime import get_instance as get_runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import requests
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageFilter
 import io
 import base64
 import time
 import uuid
 import json
 import os
+import re
+import hashlib
+import hmac
+import errno
+import secrets
+import random
+import email.utils
+import sys
+import marshal
+import tracemalloc
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import http.server
+import urllib.parse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
 from datetime import datetime
 
+import log_shards
+import image_workers
+import state_store
+
+# 이번 스크립트 실행 시작 시각 (재실행 시간 측정용)
+RERUN_STARTED_AT = time.perf_counter()
+
+try:
+    import fcntl  # 다중 프로세스 파일 잠금 (Windows에는 없음)
+except ImportError:
+    fcntl = None
+
 # 테스터 검증용 로깅 시스템 추가
 def setup_verification_logging():
-    """테스터 독립 검증을 위한 로깅 시스템 초기화"""
-    os.makedirs("logs", exist_ok=True)
-    os.makedirs("performance_data", exist_ok=True)
-    
-    # 세션 시작 로그
+    """테스터 독립 검증을 위한 로깅 시스템 초기화 (세션당 한 번)"""
     if 'logging_initialized' not in st.session_state:
+        os.makedirs("logs", exist_ok=True)
+        os.makedirs("performance_data", exist_ok=True)
+        
+        # 세션 시작 로그
         timestamp = datetime.now().isoformat()
         session_start_log = f"[{timestamp}] SESSION_START: User {st.session_state.get('user_id', 'unknown')} started session"
         append_to_log("logs/session.log", session_start_log)
         st.session_state.logging_initialized = True
 
 def append_to_log(file_path, message):
-    """로그 파일에 메시지 추가"""
+    """로그 파일에 메시지 추가 - 워커 프로세스별 샤드에 한 줄 단위로 기록 (읽을 때 병합)"""
     try:
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(f"{message}\n")
+        log_shards.append_line(file_path, message)
     except Exception as e:
         print(f"로그 기록 실패: {e}")
 
@@ -41,39 +74,52 @@ def log_vmodel_api_call(request_data, response_data, success=True, processing_ti
     api_response_log = f"[{timestamp}] VMODEL_RESPONSE: {json.dumps(response_data, ensure_ascii=False)}"
     append_to_log("logs/vmodel_api_raw.log", api_response_log)
     
-    # 성공/실패 로그
-    if success:
-        success_log = f"[{timestamp}] SUCCESS - Task completed in {processing_time:.1f}s"
-    else:
-        success_log = f"[{timestamp}] FAILED - {response_data.get('error', 'unknown error')}"
-    append_to_log("logs/success_failures.log", success_log)
+    # 성공/실패 로그 (최종 결과만 - 생성/폴링 중간 단계는 원본 로그에만 기록)
+    if is_final_completion:
+        if success:
+            success_log = f"[{timestamp}] SUCCESS - Task completed in {processing_time:.1f}s"
+        else:
+            success_log = f"[{timestamp}] FAILED - {response_data.get('error', 'unknown error')}"
+        append_to_log("logs/success_failures.log", success_log)
     
     # 성능 데이터는 실제 완료된 변환만 기록 (중복 제거)
     if is_final_completion:
         # 간단하고 명확한 완료 판정
         completed = success and bool(response_data.get('result_url'))
         
+        # 백그라운드 작업 스레드에는 세션이 없으므로 작업을 시작한 사용자로 기록
+        job = get_job_runner().current()
         performance_record = {
             "timestamp": timestamp,
             "request_id": f"req_{int(time.time())}_{uuid.uuid4().hex[:8]}",
-            "user_id": st.session_state.get('user_id', 'unknown'),
+            "user_id": job.user_id if job else st.session_state.get('user_id', 'unknown'),
             "success": success,
             "completed": completed,
             "processing_time": processing_time,
             "api_response_time": response_data.get('api_response_time', 0),
+            "queue_wait_time": response_data.get('queue_wait_time', 0),
+            "quality_mode": response_data.get('quality_mode', 'high'),
+            "stage_times": response_data.get('stage_times'),
+            "backend": response_data.get('backend'),
+            "poll_count": (response_data.get('poll_summary') or {}).get('polls'),
+            "retries": response_data.get('retries'),
             "task_id": response_data.get('task_id'),
+            "process": log_shards.get_shard_id(),
             "error": response_data.get('error') if not success else None
         }
         
-        # 성능 데이터를 JSON 파일에 저장
-        performance_file = "performance_data/performance_log.jsonl"
-        with open(performance_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(performance_record, ensure_ascii=False) + '\n')
+        # 성능 데이터를 프로세스별 JSONL 샤드에 저장
+        try:
+            log_shards.append_record(log_shards.PERFORMANCE_LOG, performance_record)
+        except Exception as e:
+            print(f"성능 로그 기록 실패: {e}")
         
-        # 세션 상태에도 저장 (실시간 통계용)
-        if 'performance_history' not in st.session_state:
-            st.session_state.performance_history = []
-        st.session_state.performance_history.append(performance_record)
+        # 세션 상태에도 저장 (실시간 통계용) - 작업 스레드에서는 세션 상태를 쓸 수 없으므로 작업 기록에 남기고
+        # 작업이 끝난 뒤 collect_finished_jobs가 세션에 옮김
+        if job:
+            job.add_performance_record(performance_record)
+        else:
+            st.session_state.setdefault('performance_history', []).append(performance_record)
 
 def calculate_realtime_metrics():
     """실시간 성능 지표 계산 (정부 기준) - 실제 변환만 계산"""
@@ -82,6 +128,11 @@ def calculate_realtime_metrics():
     
     data = st.session_state.performance_history
     total = len(data)
+    
+    # 기록은 추가만 되므로 개수가 그대로면 이전 계산 결과 재사용 (재실행마다 전체 기록을 다시 집계하지 않음)
+    cached = st.session_state.get('realtime_metrics_cache')
+    if cached and cached[0] == total:
+        return cached[1]
     successful = len([d for d in data if d.get('success', False)])
     completed = len([d for d in data if d.get('completed', False)])
     
@@ -97,7 +148,7 @@ def calculate_realtime_metrics():
     avg_processing = sum(processing_times) / len(processing_times) if processing_times else 0
     avg_api = sum(api_times) / len(api_times) if api_times else 0
     
-    return {
+    metrics = {
         'total_requests': total,
         'successful_requests': successful,
         'completed_requests': completed,
@@ -109,6 +160,8 @@ def calculate_realtime_metrics():
         'avg_api_time': avg_api,
         'processing_times': processing_times
     }
+    st.session_state.realtime_metrics_cache = (total, metrics)
+    return metrics
 
 # API 엔드포인트 (테스터 검증용)
 def handle_verification_api():
@@ -135,6 +188,82 @@ def handle_verification_api():
             display_detailed_metrics()
             st.stop()
 
+        elif api_type == "governor":
+            # API 키별 호출 대기열 및 대기시간 지표 반환
+            st.json({state.key_id: state.governor.stats() for state in get_api_key_pool().keys})
+            st.stop()
+
+        elif api_type == "memory":
+            # 관리자 전용: 세션별 추정 메모리, 큰 이미지, RSS 추이, tracemalloc 비교 (?tracemalloc=start|stop)
+            if not is_admin_request():
+                st.json({"error": "admin_token required"})
+                st.stop()
+            monitor = get_memory_monitor()
+            if query_params.get("tracemalloc") == "start":
+                monitor.start_tracing()
+            elif query_params.get("tracemalloc") == "stop":
+                monitor.stop_tracing()
+            st.json(monitor.stats())
+            st.stop()
+
+        elif api_type == "profiles":
+            # 관리자 전용: 저장된 프로파일 목록 (?profile=run|job&admin_token=... 으로 수집)
+            if not is_admin_request():
+                st.json({"error": "admin_token required"})
+                st.stop()
+            st.json({"directory": os.path.abspath(PROFILE_DIR), "max_count": PROFILE_MAX_COUNT, "profiles": list_profiles()})
+            st.stop()
+
+        elif api_type == "image_pool":
+            # 이미지 처리 프로세스 풀 대기열 깊이 및 작업별 처리/대기 시간
+            st.json(get_image_pool().stats())
+            st.stop()
+
+        elif api_type == "reruns":
+            # 스크립트 재실행 소요시간 (전체 및 구간별 백분위수)
+            st.json(get_rerun_timings().stats())
+            st.stop()
+
+        elif api_type == "backends":
+            # 백엔드별 최근 지연/오류율과 라우팅 순서 반환
+            st.json(get_backend_router().stats())
+            st.stop()
+
+        elif api_type == "scheduler":
+            # 사용자별 진행/대기 작업 수와 배정 대기시간 반환
+            st.json(get_job_scheduler().stats())
+            st.stop()
+
+        elif api_type == "admission":
+            # 입장 제어 결정 집계 (거절 건수는 모델 실패와 별도), 예상 완료 시간, 최근 처리 시간
+            st.json(get_admission_controller().stats())
+            st.stop()
+
+        elif api_type == "jobs":
+            # 백그라운드 작업 수 (진행 중, 결과 미수거, 진행 영역이 사라진 작업)
+            st.json(get_job_runner().stats())
+            st.stop()
+
+        elif api_type == "state":
+            # 공유 상태 저장소 종류와 namespace별 기록 수, 이미지 blob 수/용량
+            st.json({"state": get_state_store().stats(), "blobs": get_blob_store().stats(), "ttl": STATE_TTL})
+            st.stop()
+
+        elif api_type == "keys":
+            # API 키별 사용률 및 차단 상태 반환
+            st.json(get_api_key_pool().stats())
+            st.stop()
+
+        elif api_type == "uploads":
+            # 이미지 호스트별 지연/오류 통계 및 차단 상태 반환
+            st.json(get_upload_hedger().stats())
+            st.stop()
+
+        elif api_type == "poller":
+            # 공용 폴러가 추적 중인 Task 및 조회 횟수 반환
+            st.json(get_task_poller().stats())
+            st.stop()
+
 def display_detailed_metrics():
     """상세 성능 지표 및 계산 과정 표시 - 실제 변환만 집계"""
     st.title("🎯 AI 성능 평가 결과 (정부 기준)")
@@ -249,7 +378,26 @@ def display_detailed_metrics():
 정부 기준: 1초 이내 → {'✅ 통과' if avg_api <= 1 else '❌ 미달'}
 ```
 """)
-    
+
+    # 품질 모드별 생성시간 (모드마다 목표 시간이 다름)
+    st.subheader("⏱️ 품질 모드별 생성시간")
+    mode_columns = st.columns(len(QUALITY_TIERS))
+    for column, (mode, tier) in zip(mode_columns, QUALITY_TIERS.items()):
+        mode_times = sorted(
+            d.get('processing_time', 0) for d in data
+            if d.get('success', False) and d.get('quality_mode', 'high') == mode
+        )
+        with column:
+            st.write(f"**{tier['label']} 모드** (목표 {tier['target_time']}초 이내)")
+            if not mode_times:
+                st.write("- 기록 없음")
+                continue
+            mode_avg = sum(mode_times) / len(mode_times)
+            mode_p90 = mode_times[min(len(mode_times) - 1, int(len(mode_times) * 0.9))]
+            st.write(f"- 변환 수: {len(mode_times)}건")
+            st.write(f"- 평균: {mode_avg:.1f}초 {'✅' if mode_avg <= tier['target_time'] else '❌'}")
+            st.write(f"- p90: {mode_p90:.1f}초")
+
     # 중복 제거 설명
     st.subheader("🔍 데이터 정확성 보장")
     st.markdown(f"""
@@ -311,22 +459,23 @@ def get_logs_data():
         log_files = [
             "logs/vmodel_api_raw.log",
             "logs/success_failures.log",
-            "logs/session.log"
+            "logs/session.log",
+            "logs/admission.log",
+            "logs/image_pool.log"
         ]
         
         for log_file in log_files:
-            if os.path.exists(log_file):
+            if log_shards.log_exists(log_file):
                 try:
-                    with open(log_file, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        logs_data["log_files"][os.path.basename(log_file)] = content
-                        
-                        # 최근 로그 파싱
-                        lines = content.strip().split('\n')
-                        for line in lines[-10:]:
-                            if line.strip() and line.startswith('['):
-                                logs_data["recent_logs"].append(line)
-                                
+                    # 기준 파일과 프로세스별 샤드를 시간순으로 병합
+                    lines = log_shards.read_log_lines(log_file)
+                    logs_data["log_files"][os.path.basename(log_file)] = "\n".join(lines)
+                    
+                    # 최근 로그 파싱
+                    for line in lines[-10:]:
+                        if line.strip() and line.startswith('['):
+                            logs_data["recent_logs"].append(line)
+                            
                 except Exception as e:
                     logs_data["log_files"][f"{log_file}_error"] = f"Read failed: {str(e)}"
             else:
@@ -339,377 +488,3589 @@ def get_logs_data():
 def get_performance_data():
     """성능 데이터 수집 및 반환"""
     try:
-        performance_data = []
-        
         # 디렉토리 생성 확인
         if not os.path.exists("performance_data"):
             os.makedirs("performance_data")
         
-        # JSONL 파일에서 성능 데이터 읽기
-        performance_file = "performance_data/performance_log.jsonl"
-        if os.path.exists(performance_file):
-            with open(performance_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                if content.strip():
-                    for line in content.strip().split('\n'):
-                        if line.strip():
-                            try:
-                                performance_data.append(json.loads(line))
-                            except json.JSONDecodeError as e:
-                                print(f"JSON decode error: {e} in line: {line}")
-                                continue
+        # 기준 JSONL 파일 + 프로세스별 샤드 병합 (request_id 중복 제거, 시간순)
+        performance_file = log_shards.PERFORMANCE_LOG
+        performance_data = log_shards.read_records(performance_file)
         
         return {
             "timestamp": datetime.now().isoformat(),
             "data": performance_data,
             "total_records": len(performance_data),
-            "file_exists": os.path.exists(performance_file),
-            "file_path": os.path.abspath(performance_file)
+            "file_exists": log_shards.log_exists(performance_file),
+            "file_path": os.path.abspath(performance_file),
+            "shards": log_shards.shard_status(performance_file),
+            # 과부하로 시작 전에 거절한 요청 (모델 실패와 별도 집계, 위 data에는 포함되지 않음)
+            "shed_requests": sum(1 for line in log_shards.read_log_lines("logs/admission.log") if "ADMISSION_REJECT:" in line)
         }
     except Exception as e:
         return {"error": f"Failed to collect performance data: {str(e)}"}
 
-# 페이지 설정
-st.set_page_config(
-    page_title="AI 헤어스타일 변경 서비스",
-    page_icon="💇‍♀️",
-    layout="wide"
-)
+# 품질 모드별 처리 설정 - 표준 모드는 작은 해상도, JPEG, 짧은 제한시간과 촘촘한 폴링
+VMODEL_DEFAULT_VERSION = "5c0440717a995b0bbd93377bd65dbb4fe360f67967c506aa6bd8f6b660733a7e"
+QUALITY_TIERS = {
+    "high": {
+        "label": "고품질",
+        "max_size": 1024,          # 모델 입력 해상도 (긴 변)
+        "format": "PNG",
+        "jpeg_quality": None,
+        "create_timeout": 30,      # Task 생성 요청 제한시간 (초)
+        "status_timeout": 10,      # 상태 조회 1회 제한시간 (초)
+        "download_timeout": 30,    # 결과 다운로드 제한시간 (초)
+        "poll_delay": 0,           # 첫 상태 조회까지 대기 (초)
+        "poll_interval": 1.0,      # 상태 조회 간격 (초)
+        "max_wait": 90,            # 최대 대기 시간 (초)
+        "target_time": 45,         # 안내한 처리 시간 상한 (초)
+        "version_secret": "VMODEL_HIGH_VERSION"
+    },
+    "standard": {
+        "label": "표준",
+        "max_size": 640,
+        "format": "JPEG",
+        "jpeg_quality": 85,
+        "create_timeout": 15,
+        "status_timeout": 5,
+        "download_timeout": 15,
+        "poll_delay": 3,
+        "poll_interval": 0.5,
+        "max_wait": 45,
+        "target_time": 25,
+        "version_secret": "VMODEL_STANDARD_VERSION"  # 더 빠른 모델 버전이 있으면 secrets에 지정
+    }
+}
 
-# API 엔드포인트 처리 (가장 먼저 실행)
-handle_verification_api()
+def get_quality_tier(quality_mode):
+    """품질 모드 설정 (알 수 없는 값은 고품질)"""
+    return QUALITY_TIERS.get(quality_mode, QUALITY_TIERS["high"])
 
-# 스타일링
-st.markdown("""
-<style>
-    .main-header {
-        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        padding: 2rem;
-        border-radius: 10px;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .stButton > button {
-        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border: none;
-        border-radius: 20px;
-        padding: 0.5rem 2rem;
-        font-weight: bold;
-    }
-    .success-box {
-        background: #d4edda;
-        color: #155724;
-        padding: 1rem;
-        border-radius: 5px;
-        border: 1px solid #c3e6cb;
-        margin: 1rem 0;
-    }
-    .info-box {
-        background: #d1ecf1;
-        color: #0c5460;
-        padding: 1rem;
-        border-radius: 5px;
-        border: 1px solid #bee5eb;
-        margin: 1rem 0;
-    }
-    .quality-info {
-        background: #fff3cd;
-        color: #856404;
-        padding: 1rem;
-        border-radius: 5px;
-        border: 1px solid #ffeaa7;
-        margin: 1rem 0;
-    }
-    .metrics-box {
-        background: #e2e3e5;
-        color: #383d41;
-        padding: 1rem;
-        border-radius: 5px;
-        border: 1px solid #d6d8db;
-        margin: 1rem 0;
-    }
-    .verification-box {
-        background: #f8f9fa;
-        color: #495057;
-        padding: 1rem;
-        border: 2px solid #6c757d;
-        border-radius: 8px;
-        margin: 1rem 0;
+# 작업 전체 시간 예산 (정부 기준: 생성시간 60초 이내)
+JOB_DEADLINE_SECONDS = 60
+JOB_MIN_REQUEST_TIMEOUT = 1.0   # 남은 예산이 이보다 적으면 요청을 보내지 않고 중단 (초)
+JOB_STAGE_BUDGETS = {           # 단계별 예상 소요시간 (초) - 초과시 logs/deadline_overruns.log에 기록
+    "upload": 10,
+    "queue": 10,
+    "create": 5,
+    "poll": 30,
+    "download": 5,
+}
+
+class DeadlineExceeded(TimeoutError):
+    """작업 마감 시각까지 남은 시간으로는 다음 단계를 진행할 수 없음"""
+
+    def __init__(self, stage):
+        super().__init__(f"작업 시간 예산 초과 (단계: {stage})")
+        self.stage = stage
+
+class JobDeadline:
+    """변환 작업 하나의 마감 시각 - 모든 단계가 공유하며 남은 시간으로 요청 제한시간을 줄임"""
+
+    def __init__(self, budget=JOB_DEADLINE_SECONDS, expires_at=None):
+        self.expires_at = expires_at or time.time() + budget
+        self.started_at = self.expires_at - budget
+        self.stage_times = {}
+        self.current_stage = None
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def expired(self):
+        return self.remaining() < JOB_MIN_REQUEST_TIMEOUT
+
+    def timeout(self, limit, stage=None):
+        """단계별 기본 제한시간(limit)을 남은 예산으로 줄여 반환 - 예산이 없으면 DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded(stage or self.current_stage)
+        return min(limit, self.remaining())
+
+    def record(self, stage, elapsed):
+        """단계 소요시간 누적, 예상 시간을 넘으면 초과 로그 기록"""
+        self.stage_times[stage] = self.stage_times.get(stage, 0) + elapsed
+        budget = JOB_STAGE_BUDGETS.get(stage)
+        if budget and elapsed > budget:
+            append_to_log(
+                "logs/deadline_overruns.log",
+                f"[{datetime.now().isoformat()}] STAGE_OVERRUN {stage}: {elapsed:.1f}s (예상 {budget}s, 남은 예산 {self.remaining():.1f}s)"
+            )
+
+    @contextmanager
+    def stage(self, name):
+        """with 블록 소요시간을 단계 시간으로 기록"""
+        self.current_stage = name
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time)
+
+# 재시도 정책 - 오류를 종류별로 나누고 일시적 오류만 상한 있는 지수 백오프(+지터)로 다시 시도
+RETRY_BASE_DELAY = 0.5         # 첫 재시도 전 대기 상한 (초) - 매번 두 배
+RETRY_MAX_DELAY = 8.0          # 재시도 대기 상한 (초, 서버가 Retry-After로 알려준 값은 그대로 따름)
+CREATE_MAX_RETRIES = 3         # Task 생성 재시도 횟수
+STATUS_MAX_RETRIES = 6         # 상태 조회 연속 실패 허용 횟수 (넘으면 Task 확인 실패로 종료)
+DOWNLOAD_MAX_RETRIES = 2       # 결과 다운로드 재시도 횟수
+RETRYABLE_ERRORS = ("connect", "timeout", "network", "rate_limited", "unavailable", "server")
+NOT_PROCESSED_ERRORS = ("connect", "rate_limited", "unavailable")   # 서버가 요청을 처리하지 않은 것이 확실한 오류
+
+class TransientAPIError(Exception):
+    """다시 시도하면 성공할 수 있는 API 응답 (429/5xx)"""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def parse_retry_after(response):
+    """Retry-After 헤더 (초 또는 HTTP 날짜)를 대기 초로 변환 - 없으면 None"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error=None, status_code=None):
+    """오류 종류 분류
+
+    connect: 연결 실패 (요청이 서버에 닿지 않음), timeout: 응답 대기 초과 (처리 여부 불명),
+    network: 연결이 중간에 끊김 (처리 여부 불명), rate_limited: 429, unavailable: 503,
+    server: 그 외 5xx, client: 그 외 4xx (다시 보내도 같은 결과), unknown: 그 외 예외
+    """
+    if isinstance(error, TransientAPIError):
+        status_code = error.status_code
+    elif isinstance(error, requests.exceptions.ConnectTimeout):
+        return "connect"
+    elif isinstance(error, (requests.exceptions.Timeout, TimeoutError)):
+        return "timeout"
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return "connect" if "NewConnectionError" in type(reason).__name__ or "NameResolution" in type(reason).__name__ else "network"
+    elif error is not None:
+        return "unknown"
+    
+    if status_code == 429:
+        return "rate_limited"
+    if status_code == 503:
+        return "unavailable"
+    if status_code is not None and status_code >= 500:
+        return "server"
+    return "client"
+
+def is_retryable(category):
+    return category in RETRYABLE_ERRORS
+
+def retry_delay(attempt, retry_after=None):
+    """attempt번째(0부터) 재시도 전 대기 시간 - 상한 있는 지수 백오프에 전체 지터, Retry-After가 더 길면 그 값"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+# VModel API 호출 제어 (프로세스 공용)
+GOVERNOR_DEFAULTS = {
+    "VMODEL_CREATE_RATE": 1.0,     # Task 생성 초당 허용 횟수 (0 이하면 제한 없음)
+    "VMODEL_CREATE_BURST": 3,      # Task 생성 순간 최대 허용 횟수
+    "VMODEL_STATUS_RATE": 10.0,    # 상태 조회 초당 허용 횟수 (0 이하면 제한 없음)
+    "VMODEL_STATUS_BURST": 20,     # 상태 조회 순간 최대 허용 횟수
+    "VMODEL_MAX_IN_FLIGHT": 10,    # 동시에 진행 가능한 Task 수
+}
+
+def summarize_wait_times(wait_times):
+    """대기시간 목록 요약 (평균/p50/p90/p99/최대)"""
+    if not wait_times:
+        return {"count": 0, "avg": 0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+    ordered = sorted(wait_times)
+    return {
+        "count": len(ordered),
+        "avg": sum(ordered) / len(ordered),
+        "p50": ordered[int(len(ordered) * 0.5)],
+        "p90": ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))],
+        "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+        "max": ordered[-1]
     }
-</style>
-""", unsafe_allow_html=True)
 
-# 세션 상태 초기화
-if 'user_id' not in st.session_state:
-    st.session_state.user_id = str(uuid.uuid4())[:8]
+class TokenBucket:
+    """토큰 버킷 속도 제한기 - 토큰이 없으면 실패하지 않고 FIFO 순서로 대기 (rate가 0 이하면 제한 없음)"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.waiters = deque()
+        self.condition = threading.Condition()
+        self.wait_times = deque(maxlen=500)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, timeout=None):
+        """토큰 1개 획득, 대기한 시간(초) 반환 - timeout 초과시 TimeoutError"""
+        if self.rate <= 0:
+            return 0.0
+        start_time = time.monotonic()
+        ticket = object()
+        with self.condition:
+            self.waiters.append(ticket)
+            try:
+                while True:
+                    self._refill()
+                    is_first = self.waiters[0] is ticket
+                    if is_first and self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+
+                    # 맨 앞 요청만 다음 토큰 생성 시점까지 대기, 나머지는 순서가 올 때까지 대기
+                    wait = (1 - self.tokens) / self.rate if is_first else None
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - start_time)
+                        if remaining <= 0:
+                            raise TimeoutError("API 호출 대기열 시간 초과")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.condition.wait(wait)
+            finally:
+                self.waiters.remove(ticket)
+                self.condition.notify_all()
+
+        waited = time.monotonic() - start_time
+        self.wait_times.append(waited)
+        return waited
+
+class VModelGovernor:
+    """VModel Task 생성/상태 조회 속도 제한과 동시 진행 Task 수 제한"""
+
+    def __init__(self, create_rate, create_burst, status_rate, status_burst, max_in_flight):
+        self.buckets = {
+            "create": TokenBucket(create_rate, create_burst),
+            "status": TokenBucket(status_rate, status_burst)
+        }
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight = 0
+        self.slot_waiters = deque()
+        self.condition = threading.Condition()
+        self.slot_wait_times = deque(maxlen=500)
+
+    def acquire(self, kind, timeout=None):
+        """'create' 또는 'status' 호출 전 토큰 획득"""
+        return self.buckets[kind].acquire(timeout=timeout)
+
+    def is_saturated(self):
+        """새 Task가 슬롯을 기다려야 하는 상태인지 여부"""
+        with self.condition:
+            return self.in_flight >= self.max_in_flight or bool(self.slot_waiters)
+
+    @contextmanager
+    def task_slot(self, timeout=None):
+        """진행 중 Task 슬롯 하나를 점유 (FIFO 대기), 대기시간(초)을 반환"""
+        start_time = time.monotonic()
+        ticket = object()
+        with self.condition:
+            self.slot_waiters.append(ticket)
+            try:
+                while not (self.slot_waiters[0] is ticket and self.in_flight < self.max_in_flight):
+                    wait = None
+                    if timeout is not None:
+                        wait = timeout - (time.monotonic() - start_time)
+                        if wait <= 0:
+                            raise TimeoutError("Task 슬롯 대기 시간 초과")
+                    self.condition.wait(wait)
+                self.in_flight += 1
+            finally:
+                self.slot_waiters.remove(ticket)
+                self.condition.notify_all()
+
+        waited = time.monotonic() - start_time
+        self.slot_wait_times.append(waited)
+        try:
+            yield waited
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def stats(self):
+        """대기시간 지표 및 현재 상태"""
+        with self.condition:
+            in_flight = self.in_flight
+            queued = len(self.slot_waiters)
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued_tasks": queued,
+            "slot_wait": summarize_wait_times(list(self.slot_wait_times)),
+            "create_wait": summarize_wait_times(list(self.buckets["create"].wait_times)),
+            "status_wait": summarize_wait_times(list(self.buckets["status"].wait_times)),
+            "queued_create_calls": len(self.buckets["create"].waiters),
+            "queued_status_calls": len(self.buckets["status"].waiters)
+        }
+
+# VModel API 키 풀 - 키마다 호출 제어기(속도/동시 진행 제한)를 따로 두고 새 Task는 가장 한가한 키로
+API_KEY_COOLDOWN_RATE_LIMIT = 30      # 429 응답 후 키를 쉬게 하는 시간 (초)
+API_KEY_COOLDOWN_AUTH = 10 * 60       # 401/403 응답 후 키를 제외하는 시간 (초)
+API_KEY_TASK_MEMORY = 10000           # Task별 사용 키를 메모리에 기억하는 최대 개수
+
+def get_api_key_id(api_key):
+    """로그/기록용 키 식별자 (키 자체는 저장하지 않음)"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:8]
+
+class ApiKeyState:
+    """API 키 하나의 호출 제어기와 차단 상태"""
+
+    def __init__(self, api_key, governor):
+        self.api_key = api_key
+        self.key_id = get_api_key_id(api_key)
+        self.governor = governor
+        self.cooldown_until = 0
+        self.tasks_created = 0
+        self.responses = {}
+        self.last_error = None
+
+    def load(self):
+        """부하 = (진행 중 + 슬롯 대기 중 Task 수) / 동시 진행 한도"""
+        with self.governor.condition:
+            return (self.governor.in_flight + len(self.governor.slot_waiters)) / self.governor.max_in_flight
+
+    def is_available(self):
+        return time.monotonic() >= self.cooldown_until
+
+class ApiKeyPool:
+    """여러 VModel API 키에 Task를 나눠 보내는 풀
+
+    새 Task는 차단되지 않은 키 중 부하가 가장 낮은 키로 만들고, 상태 조회/취소는 Task를 만든 키로만 보냅니다.
+    429(속도 제한)나 401/403(인증 오류)을 받은 키는 일정 시간 새 Task 배정에서 제외합니다.
+    """
+
+    def __init__(self, api_keys, make_governor):
+        self.keys = [ApiKeyState(api_key, make_governor()) for api_key in dict.fromkeys(api_keys)]
+        self.by_key = {state.api_key: state for state in self.keys}
+        self.by_id = {state.key_id: state for state in self.keys}
+        self.task_keys = {}
+        self.lock = threading.Lock()
+
+    def select(self):
+        """새 Task에 쓸 키 - 모든 키가 차단 중이면 가장 먼저 풀리는 키"""
+        with self.lock:
+            available = [state for state in self.keys if state.is_available()]
+            if not available:
+                return min(self.keys, key=lambda state: state.cooldown_until)
+            return min(available, key=lambda state: state.load())
+
+    def get(self, key_id=None):
+        """key_id의 키 (모르는 키면 첫 번째 키)"""
+        return self.by_id.get(key_id) or self.keys[0]
+
+    def for_api_key(self, api_key):
+        return self.by_key.get(api_key) or self.keys[0]
+
+    def pin(self, task_id, state):
+        """Task를 만든 키 기록 - 이후 상태 조회/취소는 이 키로"""
+        with self.lock:
+            self.task_keys[task_id] = state.key_id
+            state.tasks_created += 1
+            while len(self.task_keys) > API_KEY_TASK_MEMORY:
+                self.task_keys.pop(next(iter(self.task_keys)))
+
+    def key_for_task(self, task_id):
+        """메모리에 기억된 Task의 키 (없으면 None)"""
+        with self.lock:
+            key_id = self.task_keys.get(task_id)
+        return self.by_id.get(key_id) if key_id else None
+
+    def record_response(self, api_key, status_code):
+        """응답 코드 집계 - 429/401/403이면 키를 잠시 배정에서 제외"""
+        state = self.by_key.get(api_key)
+        if state is None:
+            return
+        with self.lock:
+            state.responses[str(status_code)] = state.responses.get(str(status_code), 0) + 1
+            cooldown = API_KEY_COOLDOWN_RATE_LIMIT if status_code == 429 else API_KEY_COOLDOWN_AUTH if status_code in (401, 403) else 0
+            if cooldown:
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + cooldown)
+                state.last_error = f"HTTP {status_code}"
+
+    def stats(self):
+        """키별 사용률 (진행 중 Task / 동시 진행 한도) 및 차단 상태"""
+        keys = []
+        for state in self.keys:
+            governor = state.governor.stats()
+            with self.lock:
+                keys.append({
+                    "key_id": state.key_id,
+                    "available": state.is_available(),
+                    "cooldown_remaining": max(0, state.cooldown_until - time.monotonic()),
+                    "in_flight": governor["in_flight"],
+                    "max_in_flight": governor["max_in_flight"],
+                    "queued_tasks": governor["queued_tasks"],
+                    "utilization": governor["in_flight"] / governor["max_in_flight"],
+                    "tasks_created": state.tasks_created,
+                    "responses": dict(state.responses),
+                    "last_error": state.last_error
+                })
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "total_keys": len(keys),
+            "available_keys": len([key for key in keys if key["available"]]),
+            "in_flight": sum(key["in_flight"] for key in keys),
+            "capacity": sum(key["max_in_flight"] for key in keys),
+            "keys": keys
+        }
+
+def get_vmodel_api_keys():
+    """secrets의 VModel API 키 목록 - VMODEL_API_KEYS(목록 또는 쉼표 구분) 우선, 없으면 VMODEL_API_KEY"""
+    api_keys = st.secrets.get("VMODEL_API_KEYS") or []
+    if isinstance(api_keys, str):
+        api_keys = api_keys.split(",")
+    api_keys = [api_key.strip() for api_key in api_keys if api_key and api_key.strip()]
+    single_key = st.secrets.get("VMODEL_API_KEY", "")
+    return api_keys or ([single_key] if single_key else [])
+
+@st.cache_resource
+def get_api_key_pool():
+    """프로세스 전체에서 공유하는 VModel API 키 풀 (키마다 GOVERNOR_DEFAULTS 한도 적용)"""
+    config = {key: st.secrets.get(key, default) for key, default in GOVERNOR_DEFAULTS.items()}
     
-if 'seed_images' not in st.session_state:
-    st.session_state.seed_images = {}
+    def make_governor():
+        return VModelGovernor(
+            create_rate=float(config["VMODEL_CREATE_RATE"]),
+            create_burst=int(config["VMODEL_CREATE_BURST"]),
+            status_rate=float(config["VMODEL_STATUS_RATE"]),
+            status_burst=int(config["VMODEL_STATUS_BURST"]),
+            max_in_flight=int(config["VMODEL_MAX_IN_FLIGHT"])
+        )
     
-if 'processing_history' not in st.session_state:
-    st.session_state.processing_history = []
+    return ApiKeyPool(get_vmodel_api_keys() or [""], make_governor)
 
-# 로깅 시스템 초기화
-setup_verification_logging()
+# 이미지 업로드 헤징 및 호스트별 서킷 브레이커 (프로세스 공용)
+UPLOAD_HEDGE_DEFAULT_DELAY = 3.0     # 지연 기록이 부족할 때 두 번째 호스트를 시작하기까지 기다리는 시간 (초)
+UPLOAD_HEDGE_MIN_DELAY = 0.5         # 헤징 대기시간 하한 (초)
+UPLOAD_BREAKER_THRESHOLD = 3         # 연속 실패 몇 번이면 호스트를 건너뛸지
+UPLOAD_REQUEST_TIMEOUT = 30          # 이미지 업로드 기본 제한시간 (초)
+UPLOAD_BREAKER_COOLDOWN = 30.0       # 차단 후 다시 시험해 보기까지의 시간 (초)
 
-# API 설정
-VMODEL_API_KEY = st.secrets.get("VMODEL_API_KEY", "")
+class UploadHostHealth:
+    """업로드 호스트 하나의 지연/오류 통계와 서킷 브레이커 상태"""
 
-def resize_image_if_needed(image, max_size=1024):
-    """이미지가 너무 크면 자동으로 리사이즈"""
-    width, height = image.size
-    
-    # 이미지가 max_size보다 크면 비율을 유지하며 리사이즈
-    if width > max_size or height > max_size:
-        # 긴 쪽을 기준으로 비율 계산
-        if width > height:
-            new_width = max_size
-            new_height = int(height * (max_size / width))
-        else:
-            new_height = max_size
-            new_width = int(width * (max_size / height))
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=50)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed: 정상, open: 차단, half_open: 재시험 중
+        self.open_until = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def p90(self):
+        """최근 성공 업로드 지연의 p90 - 기록이 부족하면 기본값"""
+        with self.lock:
+            if len(self.latencies) < 5:
+                return UPLOAD_HEDGE_DEFAULT_DELAY
+            ordered = sorted(self.latencies)
+        return max(UPLOAD_HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))])
+
+    def try_acquire(self):
+        """이 호스트로 업로드를 시도해도 되는지 - 차단 시간이 지나면 한 번만 재시험 허용"""
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if time.monotonic() >= self.open_until:
+                # 재시험 요청이 결과 없이 끝나도 다음 주기에 다시 시험할 수 있도록 시점을 미룸
+                self.state = "half_open"
+                self.open_until = time.monotonic() + UPLOAD_BREAKER_COOLDOWN
+                return True
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.state = "closed"
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.state == "half_open" or self.consecutive_failures >= UPLOAD_BREAKER_THRESHOLD:
+                self.state = "open"
+                self.open_until = time.monotonic() + UPLOAD_BREAKER_COOLDOWN
+
+    def stats(self):
+        p90 = self.p90()
+        with self.lock:
+            total = self.successes + self.failures
+            latencies = list(self.latencies)
+            return {
+                "state": self.state,
+                "successes": self.successes,
+                "failures": self.failures,
+                "error_rate": self.failures / total if total else 0,
+                "consecutive_failures": self.consecutive_failures,
+                "avg_latency": sum(latencies) / len(latencies) if latencies else 0,
+                "p90_latency": p90,
+                "reopen_in": max(0, self.open_until - time.monotonic()) if self.state == "open" else 0,
+                "last_error": self.last_error
+            }
+
+class UploadHedger:
+    """여러 이미지 호스트에 헤징 업로드 - 첫 호스트가 평소 p90보다 느리면 다음 호스트를 동시에 시작"""
+
+    def __init__(self, max_workers=16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self.health = {}
+        self.lock = threading.Lock()
+
+    def get_health(self, name):
+        with self.lock:
+            if name not in self.health:
+                self.health[name] = UploadHostHealth(name)
+            return self.health[name]
+
+    def _run(self, name, upload_fn, image_bytes, mime_type, timeout):
+        health = self.get_health(name)
+        start_time = time.monotonic()
+        try:
+            url = upload_fn(image_bytes, mime_type, timeout=timeout)
+            if not url:
+                raise RuntimeError("빈 URL 응답")
+        except Exception as e:
+            health.record_failure(e)
+            raise
+        health.record_success(time.monotonic() - start_time)
+        return url
+
+    def upload(self, hosts, image_bytes, mime_type, timeout=UPLOAD_REQUEST_TIMEOUT):
+        """hosts: {이름: 업로드 함수} - 가장 먼저 성공한 (URL, 호스트 이름) 반환, 모두 실패하면 예외
+
+        timeout: 헤징 업로드 전체 제한시간 (초) - 초과시 TimeoutError
+        """
+        give_up_at = time.monotonic() + timeout
+        candidates = [name for name in hosts if self.get_health(name).try_acquire()]
+        # 정상 호스트를 먼저, 재시험 중인 호스트는 뒤로
+        candidates.sort(key=lambda name: self.get_health(name).state != "closed")
+        if not candidates:
+            # 모든 호스트가 차단된 경우 가장 먼저 재시험 시점이 오는 호스트를 그대로 시도
+            candidates = [min(hosts, key=lambda name: self.get_health(name).open_until)]
         
-        # 리샘플링으로 고품질 리사이즈
-        resized_image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        return resized_image, True  # 리사이즈됨을 표시
-    
-    return image, False  # 리사이즈 안됨
+        pending = {}
+        errors = []
+        next_index = 0
+        
+        def launch():
+            nonlocal next_index
+            name = candidates[next_index]
+            next_index += 1
+            future = self.executor.submit(self._run, name, hosts[name], image_bytes, mime_type, max(0.1, give_up_at - time.monotonic()))
+            pending[future] = name
+            return name
+        
+        hedge_delay = self.get_health(launch()).p90()
+        while pending:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                for other in pending:
+                    other.cancel()
+                raise TimeoutError("; ".join(errors) or "이미지 업로드 시간 초과")
+            can_hedge = next_index < len(candidates)
+            done, _ = wait(list(pending), timeout=min(hedge_delay, remaining) if can_hedge else remaining, return_when=FIRST_COMPLETED)
+            
+            if not done and not can_hedge:
+                continue
+            if not done:
+                # 첫 호스트가 평소보다 느림 → 다음 호스트를 추가로 시작
+                hedge_delay = self.get_health(launch()).p90()
+                continue
+            
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    url = future.result()
+                except Exception as e:
+                    errors.append(f"{name}: {e}")
+                    continue
+                # 먼저 성공한 결과 사용, 아직 시작 안 한 나머지 업로드는 취소
+                for other in pending:
+                    other.cancel()
+                return url, name
+            
+            # 진행 중인 업로드가 모두 실패했으면 다음 호스트를 즉시 시작
+            if not pending and next_index < len(candidates):
+                hedge_delay = self.get_health(launch()).p90()
+        
+        raise RuntimeError("; ".join(errors) or "사용 가능한 업로드 호스트가 없습니다")
 
-def validate_image(image):
-    """이미지 유효성 검사 및 자동 리사이즈"""
-    try:
-        if image.size[0] < 100 or image.size[1] < 100:
-            return False, "이미지 크기가 너무 작습니다 (최소 100x100)", image
+    def stats(self):
+        with self.lock:
+            hosts = dict(self.health)
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "hosts": {name: health.stats() for name, health in hosts.items()}
+        }
+
+@st.cache_resource
+def get_upload_hedger():
+    """프로세스 전체에서 공유하는 이미지 업로드 헤징 관리자"""
+    return UploadHedger()
+
+# 자체 이미지 서빙 (선택 기능: IMAGE_SERVING_MODE = "local")
+LOCAL_IMAGE_DEFAULTS = {
+    "LOCAL_IMAGE_DIR": "served_images",  # 콘텐츠 주소 방식 저장 디렉토리
+    "LOCAL_IMAGE_BIND": "0.0.0.0",
+    "LOCAL_IMAGE_PORT": 8600,
+    "LOCAL_IMAGE_BASE_URL": "",          # VModel에서 접근 가능한 외부 주소 (비우면 http://127.0.0.1:포트)
+    "LOCAL_IMAGE_TTL": 30 * 60,          # 서명된 URL 유효 시간 (초)
+    "LOCAL_IMAGE_SECRET": "",            # URL 서명 키 (비우면 디렉토리에 생성해 둔 키 사용)
+}
+LOCAL_IMAGE_CLEANUP_INTERVAL = 5 * 60
+LOCAL_IMAGE_MIME_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+LOCAL_IMAGE_PATH_PATTERN = re.compile(r"^/img/([0-9a-f]{64})\.(png|jpg|webp)$")
+
+class LocalImageServer:
+    """전처리된 입력 이미지를 직접 서빙하는 작은 정적 파일 서버
+
+    이미지는 SHA-256 이름으로 디렉토리에 저장하고, 만료 시각이 포함된
+    HMAC 서명 URL로만 내려줍니다 (sendfile로 전송). 오래된 파일은 주기적으로 삭제합니다.
+
+    여러 워커 프로세스가 같은 포트를 쓰므로 처음 포트를 연 프로세스만 요청을 받고 파일을 정리합니다.
+    나머지 프로세스(listening=False)는 같은 디렉토리에 파일을 쓰고 같은 서명 키로 URL만 만듭니다.
+    """
+
+    def __init__(self, directory, bind, port, base_url, ttl, secret):
+        self.directory = os.path.abspath(directory)
+        self.base_url = (base_url or f"http://127.0.0.1:{port}").rstrip('/')
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+        self.secret = secret.encode() if secret else self._load_signing_key()
         
-        # 자동 리사이즈
-        processed_image, was_resized = resize_image_if_needed(image, max_size=1024)
+        server = self
         
-        if was_resized:
-            original_size = f"{image.size[0]}x{image.size[1]}"
-            new_size = f"{processed_image.size[0]}x{processed_image.size[1]}"
-            message = f"이미지 크기를 자동 조정했습니다: {original_size} → {new_size}"
-        else:
-            message = "유효한 이미지입니다"
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                server.handle_request(self, send_body=False)
+            
+            def do_GET(self):
+                server.handle_request(self, send_body=True)
+            
+            def log_message(self, format, *args):
+                pass  # 요청마다 콘솔 출력하지 않음
         
-        return True, message, processed_image
+        try:
+            self.httpd = http.server.ThreadingHTTPServer((bind, port), Handler)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # 다른 워커 프로세스가 이미 서빙 중 - 공유 디렉토리/서명 키로 그 서버가 내려줌
+            self.httpd = None
+            self.listening = False
+            return
+        self.listening = True
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, name="local-image-server", daemon=True).start()
+        threading.Thread(target=self._cleanup_loop, name="local-image-cleanup", daemon=True).start()
+
+    def _load_signing_key(self):
+        """서명 키를 디렉토리에 만들어 두고 재사용 (같은 디렉토리를 쓰는 프로세스끼리 공유)"""
+        key_path = os.path.join(self.directory, ".signing_key")
+        if not os.path.exists(key_path):
+            # 임시 파일에 다 쓴 뒤 한 번에 연결 - 다른 프로세스가 비어 있거나 덜 쓴 키를 읽지 않도록
+            # (동시에 만들었으면 먼저 연결된 키를 모두 사용)
+            temp_path = f"{key_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secrets.token_bytes(32))
+            try:
+                os.link(temp_path, key_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+        with open(key_path, 'rb') as f:
+            return f.read()
+
+    def sign(self, name, expires_at):
+        return hmac.new(self.secret, f"{name}:{expires_at}".encode(), hashlib.sha256).hexdigest()
+
+    def put(self, image_bytes, mime_type):
+        """이미지 저장 후 서명된 URL 반환 (같은 내용이면 파일 재사용)"""
+        extension = LOCAL_IMAGE_MIME_EXTENSIONS.get(mime_type, "png")
+        name = f"{hashlib.sha256(image_bytes).hexdigest()}.{extension}"
+        path = os.path.join(self.directory, name)
+        
+        if os.path.exists(path):
+            os.utime(path)  # 정리 대상에서 제외되도록 갱신
+        else:
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(image_bytes)
+            os.replace(temp_path, path)
+        
+        expires_at = int(time.time() + self.ttl)
+        return f"{self.base_url}/img/{name}?exp={expires_at}&sig={self.sign(name, expires_at)}"
+
+    def handle_request(self, request, send_body):
+        parsed = urllib.parse.urlsplit(request.path)
+        match = LOCAL_IMAGE_PATH_PATTERN.match(parsed.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        if not match:
+            request.send_error(404)
+            return
+        
+        name = f"{match.group(1)}.{match.group(2)}"
+        try:
+            expires_at = int(query.get("exp", ["0"])[0])
+        except ValueError:
+            expires_at = 0
+        signature = query.get("sig", [""])[0]
+        if expires_at < time.time() or not hmac.compare_digest(signature, self.sign(name, expires_at)):
+            request.send_error(403)
+            return
+        
+        path = os.path.join(self.directory, name)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            request.send_error(404)
+            return
+        
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            request.send_response(200)
+            request.send_header("Content-Type", "image/jpeg" if match.group(2) == "jpg" else f"image/{match.group(2)}")
+            request.send_header("Content-Length", str(size))
+            request.send_header("Cache-Control", "private, max-age=300")
+            request.end_headers()
+            if send_body:
+                request.wfile.flush()
+                request.connection.sendfile(f)
+
+    def cleanup(self):
+        """유효 시간이 지난 이미지 파일 삭제, 삭제 개수 반환"""
+        removed = 0
+        cutoff = time.time() - self.ttl - LOCAL_IMAGE_CLEANUP_INTERVAL
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def _cleanup_loop(self):
+        while True:
+            time.sleep(LOCAL_IMAGE_CLEANUP_INTERVAL)
+            try:
+                self.cleanup()
+            except Exception as e:
+                print(f"이미지 정리 실패: {e}")
+
+def is_local_image_serving():
+    """입력 이미지를 외부 호스트 대신 자체 서버로 제공하는 모드인지"""
+    return st.secrets.get("IMAGE_SERVING_MODE", "public") == "local"
+
+@st.cache_resource
+def get_local_image_server():
+    """프로세스 전체에서 공유하는 자체 이미지 서버 (처음 사용할 때 시작)"""
+    config = {key: st.secrets.get(key, default) for key, default in LOCAL_IMAGE_DEFAULTS.items()}
+    if not config["LOCAL_IMAGE_BASE_URL"]:
+        # 127.0.0.1 주소는 외부 제공자(VModel)가 가져갈 수 없음 - 같은 호스트의 대체 백엔드 시험에만 사용 가능
+        print("LOCAL_IMAGE_BASE_URL 미설정 - 입력 이미지 URL이 http://127.0.0.1로 만들어져 VModel이 가져갈 수 없습니다")
+    return LocalImageServer(
+        directory=config["LOCAL_IMAGE_DIR"],
+        bind=config["LOCAL_IMAGE_BIND"],
+        port=int(config["LOCAL_IMAGE_PORT"]),
+        base_url=config["LOCAL_IMAGE_BASE_URL"],
+        ttl=int(config["LOCAL_IMAGE_TTL"]),
+        secret=config["LOCAL_IMAGE_SECRET"]
+    )
+
+@st.cache_resource
+def get_background_executor():
+    """사용자 대기 경로 밖에서 실행할 작업(미리 업로드 등)용 공용 스레드 풀"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="background")
+
+# 백그라운드 변환 작업 - 작업 전체(업로드~결과 다운로드)를 스크립트 밖 스레드에서 실행하고 진행 상태는 공용 저장소에 기록
+# 화면은 진행 영역 fragment만 주기적으로 다시 실행해 상태를 읽으므로, 작업 중에도 나머지 화면은 그대로 조작 가능
+JOB_PROGRESS_INTERVAL = 1.0     # 진행 영역 새로고침 간격 (초)
+JOB_VIEW_TIMEOUT = 15           # 진행 영역이 이 시간 동안 한 번도 그려지지 않으면 탭을 닫은 것으로 봄 (초)
+JOB_RETENTION = 10 * 60         # 아무도 결과를 가져가지 않은 끝난 작업을 보관하는 시간 (초)
+
+class BackgroundJob:
+    """백그라운드 작업 하나의 진행 상태 - 작업 스레드가 갱신하고 진행 영역이 읽음
+
+    meta: 작업이 끝난 뒤 화면에서 결과를 처리할 때 필요한 정보 (종류, 파일명, 품질 모드 등)
+    """
+
+    def __init__(self, job_id, user_id, meta):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.meta = meta
+        self.state = "running"
+        self.progress = 0.0
+        self.status_text = ""
+        self.notices = []
+        self.performance_records = []
+        self.task_id = None
+        self.result = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.last_viewed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, **changes):
+        with self.lock:
+            for key, value in changes.items():
+                setattr(self, key, value)
+
+    def add_notice(self, kind, message, options):
+        """사용자 안내 메시지 (st.info/st.error 등 종류와 인자) 추가"""
+        with self.lock:
+            self.notices.append((kind, message, options))
+
+    def add_performance_record(self, record):
+        """최종 성능 기록 (세션의 실시간 성능 지표용) 추가"""
+        with self.lock:
+            self.performance_records.append(record)
+
+    def mark_viewed(self):
+        with self.lock:
+            self.last_viewed = time.monotonic()
+
+    def is_viewed(self):
+        """진행 영역이 최근에 그려졌는지 (모든 탭이 닫히면 False)"""
+        with self.lock:
+            return time.monotonic() - self.last_viewed < JOB_VIEW_TIMEOUT
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "job_id": self.job_id,
+                "state": self.state,
+                "progress": self.progress,
+                "status_text": self.status_text,
+                "notices": list(self.notices),
+                "performance_records": list(self.performance_records),
+                "task_id": self.task_id,
+                "result": self.result,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at
+            }
+
+class JobRunner:
+    """백그라운드 작업 실행기 - 작업마다 스레드 하나 (동시 진행 수는 작업 스케줄러가 제한)"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.failed = 0
+
+    def start(self, user_id, run, meta=None):
+        """run()을 새 스레드에서 실행 - run의 반환값(결과 이미지 또는 None)이 작업 결과"""
+        job = BackgroundJob(uuid.uuid4().hex[:12], user_id, meta or {})
+        with self.lock:
+            self._prune()
+            self.jobs[job.job_id] = job
+            self.started += 1
+        threading.Thread(target=self._run, args=(job, run), daemon=True, name=f"job-{job.job_id}").start()
+        return job
+
+    def _run(self, job, run):
+        self.local.job = job
+        result = None
+        try:
+            result = run()
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            job.add_notice("error", f"처리 중 오류 발생: {e}", {})
+        finally:
+            self.local.job = None
+            job.update(state="done", result=result, finished_at=time.time())
+
+    def current(self):
+        """현재 스레드에서 실행 중인 작업 (작업 스레드가 아니면 None)"""
+        return getattr(self.local, "job", None)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def find_running(self, user_id):
+        """사용자의 진행 중 작업 목록 (새로고침/재접속한 세션이 다시 연결)"""
+        with self.lock:
+            return [job for job in self.jobs.values() if job.user_id == user_id and job.state == "running"]
+
+    def discard(self, job_id):
+        """결과를 화면에 반영한 작업 제거"""
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def _prune(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.finished_at and now - job.finished_at > JOB_RETENTION]:
+            del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            self._prune()
+            jobs = list(self.jobs.values())
+            started, failed = self.started, self.failed
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "started": started,
+            "failed": failed,
+            "running": len([job for job in jobs if job.state == "running"]),
+            "unclaimed": len([job for job in jobs if job.state == "done"]),
+            "unviewed": len([job for job in jobs if job.state == "running" and not job.is_viewed()])
+        }
+
+@st.cache_resource
+def get_job_runner():
+    """프로세스 전체에서 공유하는 백그라운드 작업 실행기"""
+    return JobRunner()
+
+def notify(kind, message, **options):
+    """사용자 안내 메시지 - 백그라운드 작업 중이면 작업 기록에 남기고 (진행 영역이 표시), 아니면 바로 표시"""
+    job = get_job_runner().current()
+    if job is None:
+        getattr(st, kind)(message, **options)
+    else:
+        job.add_notice(kind, message, options)
+
+def report_job_progress(**changes):
+    """백그라운드 작업의 진행률/상태 문구/Task ID 갱신 (작업 스레드가 아니면 무시)"""
+    job = get_job_runner().current()
+    if job is not None:
+        job.update(**changes)
+
+def is_job_viewed():
+    """작업 결과를 기다리는 화면이 남아 있는지 - 작업 스레드면 진행 영역 표시 여부, 아니면 브라우저 연결 여부"""
+    job = get_job_runner().current()
+    return job.is_viewed() if job is not None else is_client_connected()
+
+# 이미지 처리 프로세스 풀 - LANCZOS 리사이즈와 PNG/JPEG 인코딩을 스크립트 스레드 대신 작업자 프로세스에서 실행
+# (동시 세션이 GIL 하나에 줄 서지 않고 코어 수만큼 병렬 처리, 기다리는 스레드는 GIL을 놓음)
+IMAGE_POOL_MIN_PIXELS = 512 * 512       # 이보다 작은 이미지는 전달 비용이 더 커서 현재 스레드에서 처리
+IMAGE_POOL_SHM_MIN_BYTES = 1024 * 1024  # 이보다 큰 픽셀 버퍼는 공유 메모리로 전달
+IMAGE_POOL_LOG = "logs/image_pool.log"  # 풀 재생성 기록
+IMAGE_POOL_STATS_WINDOW = 500           # 작업 종류별로 보관하는 최근 처리/대기 시간 수
+
+class ImageWorkerPool:
+    """이미지 작업을 프로세스 풀에서 실행하고 대기열 깊이/처리 시간 기록
+
+    작업자 수가 0이면 모든 작업을 현재 스레드에서 실행합니다.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = self._create_executor() if workers > 0 else None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.counts = {"pool": 0, "inline": 0, "failed": 0}
+        self.run_times = {}
+        self.queue_waits = {}
+
+    def _create_executor(self):
+        # 스레드가 많은 서버 프로세스를 fork하지 않도록 spawn 사용 (작업자는 image_workers만 import)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _record(self, operation, kind, run_time, queue_wait=None):
+        with self.lock:
+            self.counts[kind] += 1
+            self.run_times.setdefault(operation, deque(maxlen=IMAGE_POOL_STATS_WINDOW)).append(run_time)
+            if queue_wait is not None:
+                self.queue_waits.setdefault(operation, deque(maxlen=IMAGE_POOL_STATS_WINDOW)).append(queue_wait)
+
+    def run(self, operation, image, **options):
+        """작업 실행 후 결과 반환 (PIL 이미지 또는 바이트) - 작은 이미지/특수 모드는 현재 스레드에서"""
+        if (self.executor is None or image.mode not in image_workers.RAW_MODES
+                or image.width * image.height < IMAGE_POOL_MIN_PIXELS):
+            start_time = time.perf_counter()
+            result = image_workers.apply(operation, image, options)
+            self._record(operation, "inline", time.perf_counter() - start_time)
+            return result
+        
+        data = image.tobytes()
+        shm = None
+        if len(data) >= IMAGE_POOL_SHM_MIN_BYTES:
+            shm = shared_memory.SharedMemory(create=True, size=len(data))
+            shm.buf[:len(data)] = data
+            spec = {"shm": shm.name, "mode": image.mode, "size": image.size, "length": len(data)}
+        else:
+            spec = {"mode": image.mode, "size": image.size, "data": data}
+        spec["info"] = image_workers.pack_info(image)
+        del data
+        
+        with self.lock:
+            self.pending += 1
+            executor = self.executor
+        submitted_at = time.time()
+        try:
+            outcome = executor.submit(image_workers.run, operation, spec, options).result()
+        except BrokenProcessPool as e:
+            # 작업자가 죽으면 풀을 새로 만들고 이번 작업은 현재 스레드에서 처리
+            # (여러 스레드가 동시에 실패해도 아직 교체되지 않은 경우에만 한 번 교체)
+            with self.lock:
+                self.counts["failed"] += 1
+                replaced = self.executor is executor
+                if replaced:
+                    self.executor = self._create_executor()
+            if replaced:
+                executor.shutdown(wait=False)
+                append_to_log(IMAGE_POOL_LOG, f"[{datetime.now().isoformat()}] IMAGE_POOL_RESTART: {e}")
+            return image_workers.apply(operation, image, options)
+        finally:
+            with self.lock:
+                self.pending -= 1
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        
+        self._record(operation, "pool", outcome["elapsed"], max(0.0, outcome["started_at"] - submitted_at))
+        result = outcome["result"]
+        return image_workers.unpack_image(result) if isinstance(result, dict) else result
+
+    def stats(self):
+        """대기열 깊이, 처리 건수, 작업 종류별 처리/대기 시간"""
+        with self.lock:
+            return {
+                "timestamp": datetime.now().isoformat(),
+                "workers": self.workers,
+                "pending": self.pending,
+                "queue_depth": max(0, self.pending - self.workers),
+                "counts": dict(self.counts),
+                "run_time": {operation: summarize_wait_times(list(times)) for operation, times in self.run_times.items()},
+                "queue_wait": {operation: summarize_wait_times(list(times)) for operation, times in self.queue_waits.items()}
+            }
+
+@st.cache_resource
+def get_image_pool():
+    """프로세스 전체에서 공유하는 이미지 처리 풀 (IMAGE_WORKERS 시크릿, 0이면 사용 안 함)
+
+    기본은 코어 수만큼이며, 코어가 하나뿐이면 전달 비용만 늘어나므로 풀을 쓰지 않습니다.
+    """
+    cores = os.cpu_count() or 1
+    return ImageWorkerPool(int(st.secrets.get("IMAGE_WORKERS", cores if cores > 1 else 0)))
+
+def resize_image(image, size):
+    """LANCZOS 리사이즈 (큰 이미지는 이미지 처리 풀에서)"""
+    return get_image_pool().run("resize", image, size=size)
+
+def encode_image(image, format, **save_options):
+    """이미지를 파일 형식 바이트로 인코딩 (큰 이미지는 이미지 처리 풀에서)"""
+    return get_image_pool().run("encode", image, format=format, **save_options)
+
+# VModel Task 상태 폴링 (프로세스 공용 단일 폴러)
+TASK_POLL_INTERVAL = 1.0          # Task별 상태 조회 간격 (초)
+TASK_WATCH_RETENTION = 300        # 완료된 Task 결과를 보관하는 시간 (초)
+TASK_FINAL_STATUSES = ("succeeded", "failed", "canceled", "error")
+TASK_ABANDON_GRACE = 20           # 기다리던 세션이 사라진 Task를 취소하기 전 재연결 유예 시간 (초)
+
+def cancel_vmodel_task(task_id, api_key, timeout=5):
+    """VModel Task 취소 요청 - 취소 성공 여부 반환 (실패해도 예외 없음)"""
+    try:
+        response = requests.post(
+            f"https://api.vmodel.ai/api/tasks/v1/cancel/{task_id}",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=timeout
+        )
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+def fetch_vmodel_task_status(task_id, api_key, timeout=10):
+    """VModel Task 상태 1회 조회 - (HTTP 상태코드, 응답 JSON, 응답시간) 반환"""
+    pool = get_api_key_pool()
+    pool.for_api_key(api_key).governor.acquire("status")
+    
+    poll_start_time = time.time()
+    response = requests.get(
+        f"https://api.vmodel.ai/api/tasks/v1/get/{task_id}",
+        headers={"Authorization": f"Bearer {api_key}"},
+        timeout=timeout
+    )
+    api_response_time = time.time() - poll_start_time
+    pool.record_response(api_key, response.status_code)
+    
+    # 429/5xx는 폴러가 백오프 후 다시 조회 (Task 실패로 보지 않음)
+    if is_retryable(classify_error(status_code=response.status_code)):
+        raise TransientAPIError(response.status_code, parse_retry_after(response))
+    
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    return response.status_code, result, api_response_time
+
+class TaskWatch:
+    """폴러가 관리하는 Task 하나의 최신 상태 - 대기 중인 세션에 변경을 알림"""
+
+    def __init__(self, task_id, api_key, poll_delay=0, interval=TASK_POLL_INTERVAL, timeout=10):
+        self.task_id = task_id
+        self.api_key = api_key
+        self.interval = interval
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.version = 0
+        self.poll_count = 0
+        self.status = "starting"
+        self.result = None
+        self.http_status = None
+        self.last_error = None
+        self.api_response_time = 0
+        self.total_response_time = 0
+        self.retries = 0
+        self.consecutive_errors = 0
+        self.backoff_until = 0
+        self.subscribers = 0
+        self.fetching = False
+        self.next_poll_at = time.monotonic() + poll_delay
+        self.finished_at = None
+        self.abandoned_at = None
+
+    @property
+    def done(self):
+        return self.status in TASK_FINAL_STATUSES
+
+    def publish(self, **changes):
+        with self.condition:
+            for key, value in changes.items():
+                setattr(self, key, value)
+            if self.done and self.finished_at is None:
+                self.finished_at = time.monotonic()
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait_for_update(self, seen_version, timeout):
+        """seen_version 이후 변경이 생기거나 timeout이 지날 때까지 대기, 현재 버전 반환"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != seen_version, timeout=timeout)
+            return self.version
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "task_id": self.task_id,
+                "version": self.version,
+                "status": self.status,
+                "result": self.result,
+                "http_status": self.http_status,
+                "last_error": self.last_error,
+                "poll_count": self.poll_count,
+                "api_response_time": self.api_response_time,
+                "total_response_time": self.total_response_time,
+                "retries": self.retries
+            }
+
+class TaskPoller:
+    """진행 중인 모든 Task의 상태 조회를 한 곳에서 스케줄링
+
+    같은 task_id는 하나로 합쳐 조회하고, 결과는 TaskWatch로 대기 중인 세션들에 전달합니다.
+    조회 횟수는 세션(스레드) 수가 아니라 서로 다른 Task 수에 비례합니다.
+    fetch_batch가 주어지면 한 번의 호출로 여러 Task 상태를 조회합니다.
+    """
+
+    def __init__(self, fetch_status, fetch_batch=None, interval=TASK_POLL_INTERVAL, max_workers=8, on_abandon=None):
+        self.fetch_status = fetch_status
+        self.fetch_batch = fetch_batch
+        self.interval = interval
+        self.on_abandon = on_abandon
+        self.watches = {}
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="task-poll")
+        self.total_polls = 0
+        self.abandoned_tasks = 0
+        self.thread = threading.Thread(target=self._run, name="task-poller", daemon=True)
+        self.thread.start()
+
+    def watch(self, task_id, api_key, poll_delay=0, interval=None, timeout=10):
+        """Task 상태 구독 - 이미 조회 중인 Task면 같은 TaskWatch를 공유
+
+        poll_delay: 첫 조회까지 대기 시간, interval: 조회 간격 (품질 모드별 스케줄)
+        """
+        with self.condition:
+            watch = self.watches.get(task_id)
+            if watch is None:
+                watch = TaskWatch(task_id, api_key, poll_delay, interval or self.interval, timeout)
+                self.watches[task_id] = watch
+            watch.subscribers += 1
+            watch.abandoned_at = None
+            self.condition.notify_all()
+            return watch
+
+    def unwatch(self, task_id, abandoned=False):
+        """구독 해제 - 구독자가 없는 미완료 Task는 더 이상 조회하지 않음
+
+        abandoned: 세션이 결과를 받기 전에 사라짐 - 유예 시간 안에 다시 구독되지 않으면 on_abandon으로 취소
+        """
+        with self.condition:
+            watch = self.watches.get(task_id)
+            if watch is None:
+                return
+            watch.subscribers = max(0, watch.subscribers - 1)
+            if watch.subscribers == 0 and not watch.done:
+                if abandoned and self.on_abandon:
+                    watch.abandoned_at = time.monotonic()
+                else:
+                    del self.watches[task_id]
+
+    def forget(self, task_id):
+        """직접 취소한 Task는 더 이상 조회하지 않음 - 기다리던 작업은 canceled 상태로 깨움"""
+        with self.condition:
+            watch = self.watches.pop(task_id, None)
+        if watch is not None and not watch.done:
+            watch.publish(status="canceled")
+
+    def _apply(self, watch, status_code, result, api_response_time):
+        """조회 결과를 TaskWatch 상태로 반영"""
+        changes = {
+            "poll_count": watch.poll_count + 1,
+            "http_status": status_code,
+            "api_response_time": api_response_time,
+            "total_response_time": watch.total_response_time + api_response_time,
+            "result": result,
+            "consecutive_errors": 0,
+            "backoff_until": 0
+        }
+        if status_code != 200:
+            changes.update(status="error", last_error=f"HTTP {status_code}")
+        elif result and result.get('code') == 200 and 'result' in result:
+            changes["status"] = result['result'].get('status', 'processing')
+        watch.publish(**changes)
+
+    def _apply_error(self, watch, error):
+        """조회 실패 반영 - 일시적 오류는 백오프 후 다시 조회, 연속 실패가 한도를 넘거나 재시도할 수 없는 오류면 종료"""
+        category = classify_error(error)
+        changes = {
+            "poll_count": watch.poll_count + 1,
+            "last_error": f"{category}: {error}",
+            "retries": watch.retries + 1,
+            "consecutive_errors": watch.consecutive_errors + 1
+        }
+        if category == "client" or changes["consecutive_errors"] > STATUS_MAX_RETRIES:
+            changes["status"] = "error"
+        else:
+            changes["backoff_until"] = time.monotonic() + retry_delay(watch.consecutive_errors, getattr(error, "retry_after", None))
+        watch.publish(**changes)
+
+    def _poll_one(self, watch):
+        try:
+            status_code, result, api_response_time = self.fetch_status(watch.task_id, watch.api_key, watch.timeout)
+            self._apply(watch, status_code, result, api_response_time)
+        except Exception as e:
+            self._apply_error(watch, e)
+        finally:
+            self._finish_fetch([watch])
+
+    def _poll_batch(self, watches):
+        try:
+            results = self.fetch_batch([watch.task_id for watch in watches], watches[0].api_key)
+            for watch in watches:
+                if watch.task_id in results:
+                    self._apply(watch, *results[watch.task_id])
+        except Exception as e:
+            for watch in watches:
+                self._apply_error(watch, e)
+        finally:
+            self._finish_fetch(watches)
+
+    def _finish_fetch(self, watches):
+        with self.condition:
+            self.total_polls += len(watches)
+            for watch in watches:
+                watch.fetching = False
+                watch.next_poll_at = max(time.monotonic() + watch.interval, watch.backoff_until)
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                # 오래 전에 끝난 Task 정리, 유예 시간 동안 아무도 돌아오지 않은 Task는 취소
+                for task_id, watch in list(self.watches.items()):
+                    if watch.done and watch.subscribers == 0 and now - watch.finished_at > TASK_WATCH_RETENTION:
+                        del self.watches[task_id]
+                    elif (not watch.done and watch.subscribers == 0 and watch.abandoned_at is not None
+                          and now - watch.abandoned_at > TASK_ABANDON_GRACE):
+                        del self.watches[task_id]
+                        self.abandoned_tasks += 1
+                        self.executor.submit(self.on_abandon, task_id, watch.api_key)
+                
+                pending = [w for w in self.watches.values() if not w.done and not w.fetching]
+                due = [w for w in pending if w.next_poll_at <= now]
+                if not due:
+                    next_at = min((w.next_poll_at for w in pending), default=None)
+                    self.condition.wait(None if next_at is None else max(0.01, next_at - now))
+                    continue
+                for watch in due:
+                    watch.fetching = True
+            
+            if self.fetch_batch:
+                by_key = {}
+                for watch in due:
+                    by_key.setdefault(watch.api_key, []).append(watch)
+                for watches in by_key.values():
+                    self.executor.submit(self._poll_batch, watches)
+            else:
+                for watch in due:
+                    self.executor.submit(self._poll_one, watch)
+
+    def stats(self):
+        with self.condition:
+            watches = list(self.watches.values())
+            total_polls = self.total_polls
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "tracked_tasks": len(watches),
+            "pending_tasks": len([w for w in watches if not w.done]),
+            "subscribers": sum(w.subscribers for w in watches),
+            "abandoned_waiting": len([w for w in watches if w.abandoned_at is not None]),
+            "abandoned_canceled": self.abandoned_tasks,
+            "total_polls": total_polls,
+            "poll_interval": self.interval,
+            "tasks": [
+                {"task_id": w.task_id, "status": w.status, "polls": w.poll_count, "subscribers": w.subscribers,
+                 "abandoned": w.abandoned_at is not None}
+                for w in watches
+            ]
+        }
+
+def cancel_abandoned_task(task_id, api_key, reason="abandoned"):
+    """더 이상 아무도 기다리지 않는 Task를 제공자에서 취소하고 기록 갱신 - 취소 성공 여부 반환"""
+    if reason == "abandoned":
+        record = get_task_store().get(task_id)
+        if record and record.get('replica', log_shards.get_shard_id()) != log_shards.get_shard_id():
+            # 사용자가 다른 서버로 재접속해 그 서버가 이어받음 - 취소하지 않음
+            return False
+    canceled = cancel_task(task_id, api_key)
+    get_task_store().update(task_id, status="canceled" if canceled else "abandoned", cancel_reason=reason)
+    append_to_log(
+        "logs/success_failures.log",
+        f"[{datetime.now().isoformat()}] CANCELED - Task {task_id} ({reason}, provider_canceled={canceled})"
+    )
+    return canceled
+
+@st.cache_resource
+def get_task_poller():
+    """프로세스 전체에서 공유하는 Task 상태 폴러"""
+    return TaskPoller(fetch_task_status, on_abandon=cancel_abandoned_task)
+
+# 진행 중 Task 기록 (새로고침/재접속 후 재연결용)
+TASK_STORE_PATH = "task_state/inflight_tasks.json"
+TASK_RESUME_MAX_AGE = 15 * 60       # 이 시간이 지난 Task는 이어받지 않음 (초)
+TASK_RECORD_MAX_AGE = 24 * 60 * 60  # 기록 보관 기간 (초)
+
+def compute_image_hash(image):
+    """이미지 픽셀 내용 기반 해시 (같은 이미지 판별용)"""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()[:16]
+
+def compute_job_hash(seed_hash, ref_hash, quality_mode):
+    """변환 입력 조합의 해시 - 같은 입력으로 유료 Task가 중복 생성되지 않도록 사용"""
+    return hashlib.sha256(f"{seed_hash}:{ref_hash}:{quality_mode}".encode()).hexdigest()[:16]
+
+class TaskStore:
+    """생성된 VModel Task 기록 (JSON 파일)
+
+    task_id와 입력 해시, 사용자/세션 ID를 함께 저장해 두었다가
+    새로고침이나 재접속 후 같은 Task에 다시 연결하거나 완료된 결과를 가져옵니다.
+    """
+
+    def __init__(self, path=TASK_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """스레드 잠금 + (가능하면) 다른 프로세스와의 파일 잠금"""
+        with self.lock:
+            with open(self.path + ".lock", 'a') as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, records):
+        # 오래된 기록 정리 후 임시 파일에 쓰고 교체 (쓰는 도중 읽어도 깨지지 않음)
+        now = time.time()
+        records = {
+            task_id: record for task_id, record in records.items()
+            if now - record.get('created_at', now) < TASK_RECORD_MAX_AGE
+        }
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def _records(self):
+        with self._locked():
+            return self._load()
+
+    def _modify(self, task_id, change):
+        """change(기존 기록 또는 None)가 돌려준 기록으로 교체 - None이면 그대로 둠"""
+        with self._locked():
+            records = self._load()
+            record = change(records.get(task_id))
+            if record is not None:
+                records[task_id] = record
+                self._save(records)
+
+    def add(self, record):
+        now = time.time()
+        # replica: Task를 기다리는 서버 - 다른 서버로 재접속해 이어받으면 바뀜
+        record = {"status": "pending", "delivered": False, "created_at": now, "updated_at": now,
+                  "replica": log_shards.get_shard_id(), **record}
+        self._modify(record['task_id'], lambda _: record)
+
+    def get(self, task_id):
+        return self._records().get(task_id)
+
+    def update(self, task_id, **changes):
+        now = time.time()
+        self._modify(task_id, lambda record: record and {**record, **changes, "updated_at": now})
+
+    def find_resumable(self, user_id, input_hash=None):
+        """사용자의 아직 전달되지 않은 진행 중/완료 Task 목록 (최신순)"""
+        now = time.time()
+        records = self._records()
+        matches = [
+            record for record in records.values()
+            if record.get('user_id') == user_id
+            and not record.get('delivered')
+            and record.get('status') in ("pending", "succeeded")
+            and now - record.get('created_at', 0) < TASK_RESUME_MAX_AGE
+            and (input_hash is None or record.get('input_hash') == input_hash)
+        ]
+        return sorted(matches, key=lambda record: record['created_at'], reverse=True)
+
+class SharedTaskStore(TaskStore):
+    """공유 상태 저장소에 보관하는 Task 기록 - 다른 서버에서 시작한 Task도 이어받거나 취소할 수 있음"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def _records(self):
+        return self.state.items("tasks")
+
+    def _modify(self, task_id, change):
+        self.state.modify("tasks", task_id, change, ttl=TASK_RECORD_MAX_AGE)
+
+    def get(self, task_id):
+        return self.state.get("tasks", task_id)
+
+@st.cache_resource
+def get_task_store():
+    """프로세스 전체에서 공유하는 Task 기록 저장소 - 공유 상태 저장소를 설정하면 그곳에, 아니면 JSON 파일에 기록"""
+    state = get_state_store()
+    return SharedTaskStore(state) if state.shared else TaskStore()
+
+# 공유 상태 저장소 - 시드/처리 기록/Task 기록을 user_id 기준으로 보관 (이미지 바이트는 blob 저장소)
+# 여러 서버(레플리카) 중 어디로 접속해도, 서버가 재시작되어도 URL의 uid로 같은 상태를 복원 (sticky session 불필요)
+STATE_TTL = 6 * 60 * 60      # 마지막 저장 후 사용자 상태 보관 시간 (초)
+STATE_NAMESPACES = ("seeds", "history")
+STATE_BLOB_MEMORY_MAX_MB = 256   # 메모리 blob 저장소 최대 크기 - 넘으면 오래 안 쓴 이미지부터 버림 (MB)
+
+@st.cache_resource
+def get_state_store():
+    """프로세스 전체에서 공유하는 상태 저장소 - STATE_BACKEND: "memory"(기본) | "sqlite:///경로" | "redis://호스트:포트/DB"
+
+    연결할 수 없으면 메모리 저장소로 동작 (?api=state에서 확인)
+    """
+    url = st.secrets.get("STATE_BACKEND", "memory")
+    try:
+        return state_store.open_state_store(url)
+    except Exception as e:
+        print(f"상태 저장소 연결 실패 ({url.split('://', 1)[0]}), 메모리 저장소 사용: {e}")
+        return state_store.MemoryStateStore()
+
+@st.cache_resource
+def get_blob_store():
+    """시드/결과 이미지 바이트 저장소 - STATE_BLOB_DIR(공유 디렉토리), 미지정시 SQLite 파일 옆 blobs/ 또는 메모리
+
+    메모리 저장소는 STATE_BLOB_MEMORY_MAX_MB까지만 보관 (?api=state의 evicted가 늘면 늘리거나 디렉토리 지정)
+    """
+    directory = st.secrets.get("STATE_BLOB_DIR")
+    state = get_state_store()
+    if not directory and isinstance(state, state_store.SQLiteStateStore):
+        directory = os.path.join(os.path.dirname(os.path.abspath(state.path)), "blobs")
+    if state.shared and not directory:
+        print("STATE_BLOB_DIR 미설정 - 이미지는 이 서버 메모리에만 보관됩니다")
+    max_bytes = int(float(st.secrets.get("STATE_BLOB_MEMORY_MAX_MB", STATE_BLOB_MEMORY_MAX_MB)) * 1024 * 1024)
+    return state_store.open_blob_store(directory, ttl=STATE_TTL, max_bytes=max_bytes)
+
+def load_blob(user_id, digest):
+    """blob 저장소의 바이트 (없거나 정리됐으면 None)"""
+    return get_blob_store().get(user_id, digest) if digest else None
+
+def open_blob_image(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def run_state_write(description, write):
+    """상태 기록은 이미지 인코딩이 포함되므로 백그라운드에서 실행 (실패해도 화면 동작에는 영향 없음)"""
+    def run():
+        try:
+            write()
+        except Exception as e:
+            print(f"상태 저장 실패 ({description}): {e}")
+    get_background_executor().submit(run)
+
+def get_state_generation(user_id):
+    """사용자 상태 세대 - 새 세션 시작(clear_user_state)마다 1씩 증가"""
+    return get_state_store().get("generations", user_id) or 0
+
+def is_state_write_stale(user_id, generation, tombstone=None):
+    """예약된 기록이 그 사이의 삭제보다 늦게 실행되는지 - 세대가 바뀌었거나 삭제 표시(tombstone)가 있으면 True"""
+    state = get_state_store()
+    if (state.get("generations", user_id) or 0) != generation:
+        return True
+    return tombstone is not None and state.get("deleted", tombstone) is not None
+
+def write_user_record(user_id, generation, namespace, key, record, digests, tombstone=None):
+    """정보 기록 후 다시 확인해 삭제와 엇갈렸으면 되돌림 - 삭제가 확인과 기록 사이에 끼어들어도 되살아나지 않도록
+
+    세대가 바뀐 경우(새 세션 시작)에는 방금 쓴 이미지 blob도 지움 (새 세션은 다른 사용자 ID를 쓰므로 공유되지 않음)
+    """
+    state = get_state_store()
+    state.put(namespace, key, record, ttl=STATE_TTL)
+    if not is_state_write_stale(user_id, generation, tombstone):
+        return
+    state.delete(namespace, key)
+    if get_state_generation(user_id) != generation:
+        blobs = get_blob_store()
+        for digest in digests:
+            blobs.delete(user_id, digest)
+
+def save_seed_state(user_id, seed_id, seed_data):
+    """시드 정보와 이미지(처리된 이미지, 원본 해상도 이미지)를 공유 저장소에 기록 - 이미지를 먼저 쓰고 정보를 기록
+
+    기록은 백그라운드에서 늦게 실행될 수 있으므로 예약 시점의 세대를 기억해 두고, 그 사이 시드를 삭제했거나
+    새 세션을 시작했으면 기록하지 않음
+    """
+    record = {key: seed_data[key] for key in ('image_hash', 'head_box', 'filename', 'original_size', 'processed_size', 'created_at')}
+    images = {'image_blob': seed_data['image'], 'original_blob': seed_data['original_image']}
+    generation = get_state_generation(user_id)
+    tombstone = f"{user_id}/{seed_id}"
+
+    def write():
+        if is_state_write_stale(user_id, generation, tombstone):
+            return
+        blobs = get_blob_store()
+        for field, image in images.items():
+            record[field] = blobs.put(user_id, encode_image(image, 'PNG', compress_level=1))
+        write_user_record(user_id, generation, "seeds", f"{user_id}/{seed_id}", record,
+                          [record[field] for field in images], tombstone)
+
+    run_state_write(f"seed {seed_id}", write)
+
+def delete_seed_state(user_id, seed_id):
+    # 아직 실행되지 않은 저장이 시드를 되살리지 않도록 삭제 표시를 먼저 남김
+    # 이미지 blob은 다른 시드와 같은 내용일 수 있으므로 남겨 두고 보관 시간이 지나면 정리
+    state = get_state_store()
+    state.put("deleted", f"{user_id}/{seed_id}", True, ttl=STATE_TTL)
+    state.delete("seeds", f"{user_id}/{seed_id}")
+
+def save_history_state(user_id, item):
+    """처리 기록과 결과 이미지(다운로드용 PNG)를 공유 저장소에 기록 - 그 사이 새 세션을 시작했으면 기록하지 않음"""
+    record = {key: item[key] for key in ('id', 'seed_filename', 'ref_filename', 'created_at', 'processing_time', 'quality_mode')}
+    result_image = item['result_image']
+    generation = get_state_generation(user_id)
+
+    def write():
+        if is_state_write_stale(user_id, generation):
+            return
+        record['result_blob'] = get_blob_store().put(user_id, create_download_link(result_image, None))
+        write_user_record(user_id, generation, "history", f"{user_id}/{record['id']}", record, [record['result_blob']])
+
+    run_state_write(f"history {record['id']}", write)
+
+def load_user_state(user_id):
+    """공유 저장소에 남아 있는 사용자의 (시드 dict, 처리 기록 목록) - 다른 서버에서 저장했거나 재시작 전에 저장한 상태"""
+    state = get_state_store()
+    seeds = {}
+    for key, record in sorted(state.items("seeds", f"{user_id}/").items(), key=lambda entry: entry[1]['created_at']):
+        image_data = load_blob(user_id, record.get('image_blob'))
+        if image_data is None:
+            continue
+        image = open_blob_image(image_data)
+        original_data = load_blob(user_id, record.get('original_blob'))
+        seeds[key.split("/", 1)[1]] = {
+            **record,
+            'image': image,
+            'original_image': open_blob_image(original_data) if original_data else image,
+            'head_box': tuple(record['head_box']) if record.get('head_box') else None,
+            'original_size': tuple(record['original_size']),
+            'processed_size': tuple(record['processed_size'])
+        }
+
+    history = []
+    for record in sorted(state.items("history", f"{user_id}/").values(), key=lambda record: record['created_at']):
+        data = load_blob(user_id, record.get('result_blob'))
+        if data is None:
+            continue
+        result_image = open_blob_image(data)
+        # 저장된 PNG를 그대로 다운로드 데이터로 사용 (다시 인코딩하지 않음)
+        history.append({**record, 'result_image': result_image, 'download_data': data})
+    return seeds, history
+
+def clear_user_state(user_id):
+    """사용자의 저장된 시드/처리 기록과 이미지 삭제 (새 세션 시작) - 세대를 먼저 올려 예약된 기록을 무효화"""
+    state = get_state_store()
+    state.modify("generations", user_id, lambda generation: (generation or 0) + 1, ttl=STATE_TTL)
+    for namespace in STATE_NAMESPACES:
+        for key in state.items(namespace, f"{user_id}/"):
+            state.delete(namespace, key)
+    get_blob_store().delete_user(user_id)
+
+# 이미지 편집 백엔드 (Task 생성/상태 조회/결과 받기/취소) 및 백엔드 라우팅
+#
+# 상태 조회 응답은 모든 백엔드가 VModel 형식({"code": 200, "result": {"status", "output", ...}})으로 반환
+BACKEND_HEALTH_WINDOW = 20          # 지연/오류율 계산에 쓰는 최근 작업 수
+BACKEND_FAILURE_THRESHOLD = 3       # 연속 실패 몇 번이면 백엔드를 잠시 제외할지
+BACKEND_ERROR_RATE_LIMIT = 0.5      # 최근 오류율이 이보다 높으면 잠시 제외
+BACKEND_MIN_SAMPLES = 5             # 오류율 판정에 필요한 최소 작업 수
+BACKEND_COOLDOWN = 60               # 제외 후 다시 배정하기까지의 시간 (초)
+LOCAL_BACKEND_DEFAULT_LATENCY = 2.0 # 대체 백엔드의 가짜 처리 시간 (초)
+
+class VModelBackend:
+    """VModel API 백엔드 - 키 풀에서 고른 키로 Task를 만들고, 만든 키로 조회/취소"""
+
+    name = "vmodel"
+
+    def __init__(self, key_pool):
+        self.key_pool = key_pool
+
+    def is_saturated(self):
+        return self.key_pool.select().governor.is_saturated()
+
+    @contextmanager
+    def reserve(self, timeout=None):
+        """가장 한가한 키의 진행 슬롯과 생성 토큰 확보 - (키 상태, 대기시간) 반환, Task가 끝날 때까지 유지"""
+        state = self.key_pool.select()
+        with state.governor.task_slot(timeout=timeout) as slot_wait_time:
+            remaining = None if timeout is None else max(0, timeout - slot_wait_time)
+            yield state, slot_wait_time + state.governor.acquire("create", timeout=remaining)
+
+    def acquire_retry(self, lease, timeout=None):
+        """생성 재시도 전 같은 키의 생성 토큰 다시 확보 - 대기시간 반환"""
+        return lease.governor.acquire("create", timeout=timeout)
+
+    def submit(self, lease, target_url, source_url, quality_mode, timeout, idempotency_key=None):
+        """Task 생성 요청 - {task_id(실패시 None), status_code, response, payload, api_response_time, retry_after} 반환
+
+        idempotency_key: 재시도해도 같은 값을 보내 제공자가 중복 생성을 막을 수 있게 하는 키
+        """
+        payload = {
+            "version": get_vmodel_version(quality_mode),
+            "input": {
+                "source": source_url,
+                "target": target_url,
+                "disable_safety_checker": False,
+            }
+        }
+        headers = {
+            "Authorization": f"Bearer {lease.api_key}",
+            "Content-Type": "application/json"
+        }
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        
+        api_start_time = time.time()
+        response = requests.post(
+            "https://api.vmodel.ai/api/tasks/v1/create",
+            json=payload,
+            headers=headers,
+            timeout=timeout
+        )
+        api_response_time = time.time() - api_start_time
+        self.key_pool.record_response(lease.api_key, response.status_code)
+        
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        task_id = None
+        if response.status_code == 200 and result and result.get('code') == 200 and 'result' in result:
+            task_id = result['result'].get('task_id')
+        if task_id:
+            self.key_pool.pin(task_id, lease)
+        return {
+            "task_id": task_id,
+            "status_code": response.status_code,
+            "response": result,
+            "payload": payload,
+            "api_response_time": api_response_time,
+            "key_id": lease.key_id,
+            "retry_after": parse_retry_after(response)
+        }
+
+    def status(self, task_id, api_key, timeout):
+        return fetch_vmodel_task_status(task_id, api_key, timeout)
+
+    def fetch_result(self, result_url, timeout):
+        """결과 이미지 다운로드 - (HTTP 상태코드, 바이트) 반환"""
+        response = requests.get(result_url, timeout=timeout)
+        return response.status_code, response.content
+
+    def cancel(self, task_id, api_key):
+        return cancel_vmodel_task(task_id, api_key)
+
+class LocalStandInBackend:
+    """외부 모델 없이 동작하는 결정적 대체 백엔드 - 라우팅/장애 전환을 오프라인에서 시험하는 용도
+
+    입력 URL이 같으면 항상 같은 결과를 만들고, 설정한 시간이 지나면 완료됩니다.
+    결과는 대상 이미지에 입력 해시로 정한 색을 섞은 이미지입니다 (대상 이미지를 받지 못하면 단색).
+    """
+
+    name = "local"
+    result_prefix = "local://"
+
+    def __init__(self, latency=LOCAL_BACKEND_DEFAULT_LATENCY):
+        self.latency = latency
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def is_saturated(self):
+        return False
+
+    @contextmanager
+    def reserve(self, timeout=None):
+        yield None, 0
+
+    def acquire_retry(self, lease, timeout=None):
+        return 0
+
+    def submit(self, lease, target_url, source_url, quality_mode, timeout, idempotency_key=None):
+        digest = hashlib.sha256(f"{target_url}|{source_url}|{quality_mode}".encode()).hexdigest()
+        task_id = f"local_{digest[:12]}_{uuid.uuid4().hex[:6]}"
+        now = time.monotonic()
+        with self.lock:
+            # 오래된 가짜 Task 정리
+            for old_id in [key for key, task in self.tasks.items() if now - task['created_at'] > TASK_RESUME_MAX_AGE]:
+                del self.tasks[old_id]
+            # 같은 멱등 키로 다시 요청하면 새로 만들지 않고 기존 Task 반환
+            existing = next((key for key, task in self.tasks.items() if idempotency_key and task['idempotency_key'] == idempotency_key), None)
+            if existing:
+                task_id = existing
+            else:
+                self.tasks[task_id] = {"created_at": now, "target_url": target_url, "digest": digest, "canceled": False, "idempotency_key": idempotency_key}
+        return {
+            "task_id": task_id,
+            "status_code": 200,
+            "response": {"code": 200, "result": {"task_id": task_id}},
+            "payload": {"backend": self.name, "input": {"source": source_url, "target": target_url}},
+            "api_response_time": 0,
+            "key_id": None,
+            "retry_after": None
+        }
+
+    def status(self, task_id, api_key, timeout):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return 404, None, 0
+        
+        elapsed = time.monotonic() - task['created_at']
+        result = {"task_id": task_id, "status": "processing"}
+        if task['canceled']:
+            result["status"] = "canceled"
+        elif elapsed >= self.latency:
+            result.update(status="succeeded", output=[f"{self.result_prefix}{task_id}"], total_time=self.latency)
+        return 200, {"code": 200, "result": result}, 0
+
+    def fetch_result(self, result_url, timeout):
+        with self.lock:
+            task = self.tasks.get(result_url[len(self.result_prefix):])
+        if task is None:
+            return 404, b""
+        
+        color = tuple(bytes.fromhex(task['digest'][:6]))
+        try:
+            response = requests.get(task['target_url'], timeout=timeout)
+            base = Image.open(io.BytesIO(response.content)).convert("RGB")
+        except Exception:
+            base = Image.new("RGB", (512, 512), color)
+        result = Image.blend(base, Image.new("RGB", base.size, color), 0.3)
+        buffer = io.BytesIO()
+        result.save(buffer, format='PNG')
+        return 200, buffer.getvalue()
+
+    def cancel(self, task_id, api_key):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            task['canceled'] = True
+            return True
+
+class BackendHealth:
+    """백엔드 하나의 최근 작업 지연/오류율과 제외 상태"""
+
+    def __init__(self, name):
+        self.name = name
+        self.recent = deque(maxlen=BACKEND_HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0
+        self.lock = threading.Lock()
+
+    def record(self, ok, latency=None):
+        with self.lock:
+            self.recent.append((ok, latency))
+            self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+            failures = len([1 for success, _ in self.recent if not success])
+            error_rate = failures / len(self.recent)
+            if self.consecutive_failures >= BACKEND_FAILURE_THRESHOLD or (
+                    len(self.recent) >= BACKEND_MIN_SAMPLES and error_rate > BACKEND_ERROR_RATE_LIMIT):
+                self.cooldown_until = time.monotonic() + BACKEND_COOLDOWN
+                # 다시 배정될 때는 새 기록으로 판정
+                self.recent.clear()
+                self.consecutive_failures = 0
+
+    def is_healthy(self):
+        return time.monotonic() >= self.cooldown_until
+
+    def latency(self):
+        """최근 성공 작업 지연의 중앙값 (기록이 없으면 0 - 먼저 시험해 봄)"""
+        with self.lock:
+            latencies = sorted(latency for ok, latency in self.recent if ok and latency is not None)
+        return latencies[len(latencies) // 2] if latencies else 0
+
+    def score(self):
+        """라우팅 순위 (작을수록 우선) - 지연 중앙값을 성공률로 나눔, 기록이 없으면 0, 성공이 없으면 무한대"""
+        with self.lock:
+            total = len(self.recent)
+            successes = len([1 for ok, _ in self.recent if ok])
+        if total == 0:
+            return 0
+        if successes == 0:
+            return float("inf")
+        return self.latency() / (successes / total)
+
+    def stats(self):
+        latency = self.latency()
+        with self.lock:
+            total = len(self.recent)
+            failures = len([1 for ok, _ in self.recent if not ok])
+            return {
+                "healthy": time.monotonic() >= self.cooldown_until,
+                "recent_jobs": total,
+                "error_rate": failures / total if total else 0,
+                "p50_latency": latency,
+                "consecutive_failures": self.consecutive_failures,
+                "cooldown_remaining": max(0, self.cooldown_until - time.monotonic())
+            }
+
+class BackendRouter:
+    """새 작업을 가장 빠른 정상 백엔드로 보내고, 실패하면 다음 백엔드로 넘김
+
+    Task를 만든 백엔드는 기억해 두고 상태 조회/결과/취소는 항상 그 백엔드로 보냅니다.
+    """
+
+    def __init__(self, backends):
+        self.backends = {backend.name: backend for backend in backends}
+        self.health = {name: BackendHealth(name) for name in self.backends}
+        self.task_backends = {}
+        self.lock = threading.Lock()
+
+    def candidates(self):
+        """시도할 순서 - 정상 백엔드를 (오류율을 반영한) 지연이 짧은 순으로, 제외 중인 백엔드는 마지막 수단으로"""
+        healthy = [name for name in self.backends if self.health[name].is_healthy()]
+        healthy.sort(key=lambda name: self.health[name].score())
+        excluded = sorted(
+            (name for name in self.backends if name not in healthy),
+            key=lambda name: self.health[name].cooldown_until
+        )
+        return [self.backends[name] for name in healthy + excluded]
+
+    def record(self, name, ok, latency=None):
+        if name in self.health:
+            self.health[name].record(ok, latency)
+
+    def pin(self, task_id, name):
+        with self.lock:
+            self.task_backends[task_id] = name
+            while len(self.task_backends) > API_KEY_TASK_MEMORY:
+                self.task_backends.pop(next(iter(self.task_backends)))
+
+    def backend_for_task(self, task_id, name=None):
+        """Task를 만든 백엔드 (모르면 name, 그것도 없으면 첫 번째 백엔드)"""
+        with self.lock:
+            name = self.task_backends.get(task_id) or name
+        return self.backends.get(name) or next(iter(self.backends.values()))
+
+    def is_known_task(self, task_id):
+        with self.lock:
+            return task_id in self.task_backends
+
+    def stats(self):
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "order": [backend.name for backend in self.candidates()],
+            "backends": {name: health.stats() for name, health in self.health.items()}
+        }
+
+def get_image_backend_names():
+    """사용할 백엔드 이름 목록 - IMAGE_BACKENDS (목록 또는 쉼표 구분), 기본은 VModel만"""
+    names = st.secrets.get("IMAGE_BACKENDS") or ["vmodel"]
+    if isinstance(names, str):
+        names = names.split(",")
+    return [name.strip() for name in names if name.strip() in ("vmodel", "local")] or ["vmodel"]
+
+@st.cache_resource
+def get_backend_router():
+    """프로세스 전체에서 공유하는 백엔드 라우터"""
+    backends = []
+    for name in get_image_backend_names():
+        if name == "vmodel":
+            backends.append(VModelBackend(get_api_key_pool()))
+        elif name == "local":
+            backends.append(LocalStandInBackend(float(st.secrets.get("LOCAL_BACKEND_LATENCY", LOCAL_BACKEND_DEFAULT_LATENCY))))
+    return BackendRouter(backends)
+
+def get_task_backend(task_id):
+    """Task를 만든 백엔드 (재시작 후에는 Task 기록의 backend 사용)"""
+    router = get_backend_router()
+    if router.is_known_task(task_id):
+        return router.backend_for_task(task_id)
+    return router.backend_for_task(task_id, (get_task_store().get(task_id) or {}).get('backend'))
+
+def fetch_task_status(task_id, api_key, timeout=10):
+    """Task를 만든 백엔드로 상태 1회 조회 - (HTTP 상태코드, 응답 JSON, 응답시간) 반환"""
+    return get_task_backend(task_id).status(task_id, api_key, timeout)
+
+def cancel_task(task_id, api_key):
+    """Task를 만든 백엔드에 취소 요청 - 취소 성공 여부 반환"""
+    return get_task_backend(task_id).cancel(task_id, api_key)
+
+# 사용자별 공정 분배 - Task 생성 전에 사용자별 대기열을 두고 가중치 비율대로 번갈아 진행 슬롯을 배정
+SCHEDULER_USER_MAX_IN_FLIGHT = 2     # 사용자 한 명이 동시에 진행할 수 있는 작업 수
+SCHEDULER_USER_RETENTION = 30 * 60   # 대기/진행 작업이 없는 사용자의 통계를 보관하는 시간 (초)
+
+class UserShare:
+    """사용자 한 명의 대기열, 진행 중 작업 수, 배정 기록"""
+
+    def __init__(self, user_id, weight):
+        self.user_id = user_id
+        self.weight = weight
+        self.queue = deque()
+        self.in_flight = 0
+        self.virtual_time = 0.0   # 받은 배정 수 / 가중치 - 가장 작은 사용자부터 배정
+        self.dispatched = 0
+        self.wait_times = deque(maxlen=100)
+        self.last_active = time.monotonic()
+
+    def is_eligible(self, max_in_flight):
+        return bool(self.queue) and self.in_flight < max_in_flight
+
+class FairShareScheduler:
+    """사용자별 공정 분배 작업 스케줄러
+
+    전체 진행 슬롯(max_active)이 비면, 대기 중이고 사용자별 한도(user_max_in_flight) 미만인 사용자 중
+    지금까지 받은 배정 수를 가중치로 나눈 값(virtual_time)이 가장 작은 사용자의 가장 오래된 작업을 진행시킵니다.
+    가중치가 같으면 사용자별 라운드 로빈이 되어, 여러 작업을 몰아 넣은 사용자가 있어도
+    새로 온 사용자는 많아야 한 작업만 기다립니다. 쉬다 돌아온 사용자는 쉬는 동안의 몫을 쌓아 두지 않도록
+    현재 활동 중인 사용자의 최소 virtual_time부터 시작합니다.
+    """
+
+    def __init__(self, max_active, user_max_in_flight, weights=None):
+        self.max_active = max(1, max_active)
+        self.user_max_in_flight = max(1, user_max_in_flight)
+        self.weights = weights or {}
+        self.active = 0
+        self.users = {}
+        self.started = {}   # 진행 중 작업 → (사용자 ID, 시작 시각)
+        self.condition = threading.Condition()
+        self.wait_times = deque(maxlen=500)
+
+    def _get_user(self, user_id):
+        share = self.users.get(user_id)
+        if share is None:
+            share = self.users[user_id] = UserShare(user_id, max(0.1, float(self.weights.get(user_id, 1.0))))
+        if not share.queue and not share.in_flight:
+            busy = [other.virtual_time for other in self.users.values() if other is not share and (other.queue or other.in_flight)]
+            share.virtual_time = max(share.virtual_time, min(busy, default=0.0))
+        share.last_active = time.monotonic()
+        return share
+
+    def _next_ticket(self):
+        """다음에 진행할 작업 - 슬롯이 없거나 진행 가능한 사용자가 없으면 None"""
+        if self.active >= self.max_active:
+            return None
+        eligible = [share for share in self.users.values() if share.is_eligible(self.user_max_in_flight)]
+        if not eligible:
+            return None
+        share = min(eligible, key=lambda share: (share.virtual_time, share.queue[0]["enqueued_at"]))
+        return share.queue[0]
+
+    def _prune(self):
+        now = time.monotonic()
+        for user_id in [user_id for user_id, share in self.users.items()
+                        if not share.queue and not share.in_flight and now - share.last_active > SCHEDULER_USER_RETENTION]:
+            del self.users[user_id]
+
+    def would_wait(self, user_id):
+        """새 작업이 바로 진행되지 못하고 기다려야 하는지 여부"""
+        with self.condition:
+            share = self.users.get(user_id)
+            user_in_flight = share.in_flight + len(share.queue) if share else 0
+            queued = sum(len(other.queue) for other in self.users.values())
+            return self.active + queued >= self.max_active or user_in_flight >= self.user_max_in_flight
+
+    def position(self, user_id):
+        """user_id가 지금 작업을 하나 더 넣을 때의 대기 상황 (입장 제어의 예상 시간 계산용)
+
+        ahead: 공정 분배 순서상 먼저 배정될 대기 작업 수 - 다른 사용자의 대기 작업은
+        이 사용자의 대기 작업 수 + 1개까지만 셈 (그 뒤는 번갈아 배정되므로)
+        """
+        now = time.monotonic()
+        with self.condition:
+            share = self.users.get(user_id)
+            own_queued = len(share.queue) if share else 0
+            return {
+                "active": self.active,
+                "max_active": self.max_active,
+                "ahead": own_queued + sum(min(len(other.queue), own_queued + 1) for other in self.users.values() if other is not share),
+                "user_in_flight": share.in_flight if share else 0,
+                "user_max_in_flight": self.user_max_in_flight,
+                "active_ages": sorted(now - started for _, started in self.started.values()),
+                "user_active_ages": sorted(now - started for owner, started in self.started.values() if owner == user_id)
+            }
+
+    @contextmanager
+    def slot(self, user_id, timeout=None):
+        """user_id의 진행 슬롯 하나를 점유 (공정 분배 순서로 대기), 대기시간(초)을 반환"""
+        start_time = time.monotonic()
+        with self.condition:
+            self._prune()
+            share = self._get_user(user_id)
+            ticket = {"user_id": user_id, "enqueued_at": start_time}
+            share.queue.append(ticket)
+            try:
+                while self._next_ticket() is not ticket:
+                    wait = None
+                    if timeout is not None:
+                        wait = timeout - (time.monotonic() - start_time)
+                        if wait <= 0:
+                            raise TimeoutError("작업 배정 대기 시간 초과")
+                    self.condition.wait(wait)
+                self.active += 1
+                self.started[id(ticket)] = (user_id, time.monotonic())
+                share.in_flight += 1
+                share.dispatched += 1
+                share.virtual_time += 1 / share.weight
+            finally:
+                share.queue.remove(ticket)
+                self.condition.notify_all()
+
+            waited = time.monotonic() - start_time
+            share.wait_times.append(waited)
+            self.wait_times.append(waited)
+        try:
+            yield waited
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.started.pop(id(ticket), None)
+                share.in_flight -= 1
+                share.last_active = time.monotonic()
+                self.condition.notify_all()
+
+    def stats(self):
+        """전체/사용자별 진행 중, 대기 중 작업 수와 배정 대기시간"""
+        with self.condition:
+            self._prune()
+            users = {
+                user_id: {
+                    "weight": share.weight,
+                    "in_flight": share.in_flight,
+                    "queued": len(share.queue),
+                    "dispatched": share.dispatched,
+                    "wait": summarize_wait_times(list(share.wait_times))
+                }
+                for user_id, share in self.users.items()
+            }
+            active = self.active
+            wait_times = list(self.wait_times)
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "active": active,
+            "max_active": self.max_active,
+            "user_max_in_flight": self.user_max_in_flight,
+            "queued": sum(user["queued"] for user in users.values()),
+            "wait": summarize_wait_times(wait_times),
+            "users": users
+        }
+
+@st.cache_resource
+def get_job_scheduler():
+    """프로세스 전체에서 공유하는 작업 스케줄러
+
+    전체 슬롯은 JOB_MAX_ACTIVE (기본: API 키 수 × VMODEL_MAX_IN_FLIGHT), 사용자별 한도는 JOB_USER_MAX_IN_FLIGHT,
+    사용자별 가중치는 JOB_USER_WEIGHTS ({사용자 ID: 가중치}, 기본 1)
+    """
+    default_active = len(get_api_key_pool().keys) * int(st.secrets.get("VMODEL_MAX_IN_FLIGHT", GOVERNOR_DEFAULTS["VMODEL_MAX_IN_FLIGHT"]))
+    return FairShareScheduler(
+        max_active=int(st.secrets.get("JOB_MAX_ACTIVE", default_active)),
+        user_max_in_flight=int(st.secrets.get("JOB_USER_MAX_IN_FLIGHT", SCHEDULER_USER_MAX_IN_FLIGHT)),
+        weights=dict(st.secrets.get("JOB_USER_WEIGHTS") or {})
+    )
+
+# 입장 제어 - 예상 완료 시간이 작업 예산(60초)을 넘으면 처리 도중 실패시키지 않고 시작 전에 거절하거나 대기열 입장을 제안
+ADMISSION_QUEUE_MAX_ETA = 180        # 대기열 입장을 제안하는 예상 완료 시간 상한 (초, 넘으면 거절)
+ADMISSION_HISTORY = 20               # 처리 시간 추정에 쓰는 최근 작업 수
+ADMISSION_MIN_SAMPLES = 3            # 기록이 이보다 적으면 품질 모드의 안내 처리 시간(target_time)을 사용
+ADMISSION_SAMPLE_MAX_AGE = 10 * 60   # 처리 시간 기록 유효 기간 (초) - 오래된 지연 기록으로 계속 거절하지 않도록
+ADMISSION_PERCENTILE = 0.75          # 처리 시간 추정에 쓰는 백분위
+ADMISSION_TIMEOUT_PENALTY = 1.5      # 시간 초과로 끝난 작업은 예산 × 이 값으로 기록 (실제 처리 시간은 예산보다 길다는 것만 알 수 있음)
+ADMISSION_OFFER_TTL = 30             # 대기열 입장 제안의 유효 시간 (초)
+
+class AdmissionController:
+    """대기 작업 수, 진행 중 작업 수, 최근 처리 시간으로 새 작업의 완료 시각을 예상해 입장 여부 결정
+
+    결정: admit (예산 안에 완료 예상), probe (진행 중인 작업도 대기 작업도 없음 - 예상과 관계없이 받아들여
+    제공자가 회복했는지 확인), offer (대기하면 완료 가능 - 사용자에게 예상 시간과 함께 제안),
+    queue (사용자가 제안을 받아들임 - 예상 대기시간만큼 예산을 늘려 진행), reject (과부하로 거절).
+    모든 결정을 집계하고 admit 외의 결정은 logs/admission.log에 기록합니다 - 거절(shed)은 모델 실패와
+    섞이지 않도록 성능 로그에는 남기지 않습니다.
+    """
+
+    def __init__(self, scheduler, target=JOB_DEADLINE_SECONDS, max_queue_eta=ADMISSION_QUEUE_MAX_ETA):
+        self.scheduler = scheduler
+        self.target = target
+        self.max_queue_eta = max_queue_eta
+        self.samples = deque(maxlen=ADMISSION_HISTORY)
+        self.counts = {"admitted": 0, "probes": 0, "offered": 0, "queued": 0, "shed": 0}
+        self.recent_etas = deque(maxlen=500)
+        self.lock = threading.Lock()
+
+    def record_service_time(self, quality_mode, seconds):
+        """작업 처리 시간 (대기열 대기 제외) 기록"""
+        with self.lock:
+            self.samples.append((time.monotonic(), quality_mode, seconds))
+
+    def service_time(self, quality_mode=None):
+        """최근 처리 시간의 백분위 - quality_mode가 None이면 모든 모드, 기록이 부족하면 안내 처리 시간"""
+        cutoff = time.monotonic() - ADMISSION_SAMPLE_MAX_AGE
+        with self.lock:
+            times = sorted(seconds for recorded_at, mode, seconds in self.samples
+                           if recorded_at >= cutoff and quality_mode in (None, mode))
+        if len(times) < ADMISSION_MIN_SAMPLES:
+            return get_quality_tier(quality_mode or "high")["target_time"]
+        return times[min(len(times) - 1, int(len(times) * ADMISSION_PERCENTILE))]
+
+    def estimate(self, user_id, quality_mode):
+        """예상 대기시간, 처리 시간, 완료 시간 (초)"""
+        position = self.scheduler.position(user_id)
+        service_time = self.service_time(quality_mode)
+        slot_time = self.service_time()
+
+        # 진행 중 작업이 이미 최근 처리 시간보다 오래 걸리고 있으면 제공자가 느려진 것으로 보고 그 시간을 기준으로
+        ages = position["active_ages"]
+        if ages:
+            median_age = ages[len(ages) // 2]
+            service_time = max(service_time, median_age)
+            slot_time = max(slot_time, median_age)
+
+        # 비는 슬롯보다 앞선 대기 작업이 많으면 (가장 먼저 끝날 작업의 남은 시간) + (추가로 돌아야 할 차례 × 처리 시간)
+        queue_wait = 0
+        free = position["max_active"] - position["active"]
+        if position["ahead"] >= free:
+            rounds = (position["ahead"] - free) // position["max_active"]
+            queue_wait = max(0, slot_time - (ages[-1] if ages else 0)) + rounds * slot_time
+
+        # 사용자별 한도에 걸렸으면 자기 작업 중 하나가 끝나야 시작
+        user_ages = position["user_active_ages"]
+        if position["user_in_flight"] >= position["user_max_in_flight"] and user_ages:
+            queue_wait = max(queue_wait, slot_time - user_ages[-1])
+
+        return {
+            "eta": queue_wait + service_time,
+            "queue_wait": queue_wait,
+            "service_time": service_time,
+            "ahead": position["ahead"],
+            "active": position["active"],
+            "max_active": position["max_active"],
+            "idle": position["active"] == 0 and position["ahead"] == 0
+        }
+
+    def decide(self, user_id, quality_mode, accept_queue=False):
+        """입장 결정 - estimate 결과에 decision(admit/probe/offer/queue/reject) 추가, 모든 결정을 집계하고 admit 외에는 기록"""
+        admission = self.estimate(user_id, quality_mode)
+        if admission["eta"] <= self.target:
+            decision = "admit"
+        elif admission["idle"]:
+            decision = "probe"
+        elif admission["eta"] <= self.max_queue_eta:
+            decision = "queue" if accept_queue else "offer"
+        else:
+            decision = "reject"
+        admission["decision"] = decision
+
+        count_key = {"admit": "admitted", "probe": "probes", "offer": "offered", "queue": "queued", "reject": "shed"}[decision]
+        with self.lock:
+            self.counts[count_key] += 1
+            self.recent_etas.append(admission["eta"])
+        if decision != "admit":
+            append_to_log(
+                "logs/admission.log",
+                f"[{datetime.now().isoformat()}] ADMISSION_{decision.upper()}: user={user_id} mode={quality_mode} "
+                f"eta={admission['eta']:.1f}s queue_wait={admission['queue_wait']:.1f}s service={admission['service_time']:.1f}s "
+                f"ahead={admission['ahead']} active={admission['active']}/{admission['max_active']}"
+            )
+        return admission
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+            etas = list(self.recent_etas)
+            samples = len(self.samples)
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "target": self.target,
+            "max_queue_eta": self.max_queue_eta,
+            "counts": counts,
+            "eta": summarize_wait_times(etas),
+            "samples": samples,
+            "service_time": {mode: self.service_time(mode) for mode in QUALITY_TIERS}
+        }
+
+@st.cache_resource
+def get_admission_controller():
+    """프로세스 전체에서 공유하는 입장 제어기 (대기열 입장 제안 상한은 JOB_QUEUE_MAX_ETA)"""
+    return AdmissionController(
+        get_job_scheduler(),
+        max_queue_eta=float(st.secrets.get("JOB_QUEUE_MAX_ETA", ADMISSION_QUEUE_MAX_ETA))
+    )
+
+def record_job_service_time(deadline, quality_mode, timed_out=False):
+    """새로 만든 작업이 끝났을 때 처리 시간 (대기열 대기 제외)을 입장 제어기에 기록 - 이어받은 작업은 제외"""
+    if "create" not in deadline.stage_times:
+        return
+    seconds = deadline.elapsed() - deadline.stage_times.get("queue", 0)
+    if timed_out:
+        seconds = max(seconds, JOB_DEADLINE_SECONDS * ADMISSION_TIMEOUT_PENALTY)
+    get_admission_controller().record_service_time(quality_mode, seconds)
+
+def admit_job(quality_mode, start_clicked):
+    """시작 버튼/대기열 입장 제안 처리 - 진행할 작업의 JobDeadline 반환 (진행하지 않으면 None)
+
+    예상 완료 시간이 예산을 넘으면 제안을 세션에 저장해 보여주고, 사용자가 받아들이면 다시 예상해
+    대기열 대기시간만큼 늘린 예산으로 진행합니다.
+    """
+    offer = st.session_state.get('admission_offer')
+    if offer and (offer['quality_mode'] != quality_mode or time.time() - offer['offered_at'] > ADMISSION_OFFER_TTL):
+        del st.session_state.admission_offer
+        offer = None
+    
+    accepted = False
+    if offer and not start_clicked:
+        st.warning(f"⏳ 요청이 많아 예상 완료까지 약 {offer['eta']:.0f}초 걸립니다 (기준 {JOB_DEADLINE_SECONDS}초). 대기열에서 기다리시겠습니까?")
+        accepted = st.button(f"⏳ 대기열에서 기다리기 (예상 {offer['eta']:.0f}초)", use_container_width=True, key="accept_queue")
+    if not (start_clicked or accepted):
+        return None
+    st.session_state.pop('admission_offer', None)
+    
+    admission = get_admission_controller().decide(st.session_state.user_id, quality_mode, accept_queue=accepted)
+    if admission["decision"] == "offer":
+        st.session_state.admission_offer = {"quality_mode": quality_mode, "eta": admission["eta"], "offered_at": time.time()}
+        st.rerun()
+    if admission["decision"] == "reject":
+        st.error(f"🚦 지금은 요청이 많아 작업을 시작할 수 없습니다 (예상 완료 {admission['eta']:.0f}초). 잠시 후 다시 시도해주세요.")
+        return None
+    if admission["decision"] == "queue":
+        st.info(f"대기열에서 순서를 기다립니다 - 예상 완료까지 약 {admission['eta']:.0f}초")
+        return JobDeadline(budget=JOB_DEADLINE_SECONDS + admission["queue_wait"])
+    return JobDeadline()
+
+def is_admin_request():
+    """?admin_token=... 이 ADMIN_TOKEN 시크릿과 일치하는지 (시크릿 미설정시 항상 False)"""
+    token = st.secrets.get("ADMIN_TOKEN", "")
+    return bool(token) and hmac.compare_digest(st.query_params.get("admin_token", ""), token)
+
+# 메모리 점검 (관리자 전용 ?api=memory) - 세션별 추정 사용량, 큰 이미지, 프로세스 RSS 추이, tracemalloc 비교
+MEMORY_RSS_INTERVAL = 30               # RSS 기록 간격 (초)
+MEMORY_RSS_HISTORY = 2880              # 보관하는 RSS 기록 수 (30초 간격 24시간)
+MEMORY_LARGEST_IMAGES = 20             # 표시하는 큰 이미지 수
+MEMORY_SESSION_MAX_AGE = 6 * 60 * 60   # 이 시간 동안 재실행이 없던 세션 기록은 제외 (초)
+TRACEMALLOC_FRAMES = 10                # tracemalloc 할당 위치별 보관 스택 깊이
+TRACEMALLOC_TOP = 20                   # 표시하는 할당 위치 수
+SESSION_CACHE_FIELDS = ("previews", "download_data")   # 시드/기록 항목 중 다시 만들 수 있는 캐시 필드
+SESSION_CACHE_KEYS = ("uploaded_seed", "ref_prefetch", "reference_previews", "realtime_metrics_cache")
+
+def get_process_rss():
+    """현재 프로세스 RSS (바이트) - /proc이 없으면 최대 RSS로 대체, 알 수 없으면 None"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def estimate_footprint(obj, label, images, seen):
+    """객체가 붙잡고 있는 메모리 추정 (바이트) - PIL 이미지는 픽셀 버퍼 크기로 계산
+
+    발견한 이미지는 images에 추가하고, seen에 있는 객체는 다시 세지 않습니다.
+    """
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    
+    if isinstance(obj, Image.Image):
+        size = obj.width * obj.height * len(obj.getbands())
+        images.append({"where": label, "bytes": size, "size": obj.size, "mode": obj.mode})
+        return size
+    if isinstance(obj, Future):
+        if obj.done() and not obj.cancelled() and obj.exception() is None:
+            return sys.getsizeof(obj) + estimate_footprint(obj.result(), label, images, seen)
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_footprint(value, f"{label}.{key}", images, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_footprint(item, f"{label}[{index}]", images, seen) for index, item in enumerate(obj))
+    return sys.getsizeof(obj)
+
+def summarize_session_memory():
+    """현재 세션 데이터의 분류별(seeds/history/caches/other) 추정 사용량과 이미지 목록"""
+    images = []
+    seen = set()
+    seed_images = st.session_state.get('seed_images', {})
+    history = st.session_state.get('processing_history', [])
+    
+    # 캐시를 먼저 세서 seeds/history 합계에는 원본 데이터만 남도록 함
+    caches = 0
+    for item_label, item in [(f"seeds.{seed_id}", data) for seed_id, data in seed_images.items()] + [(f"history[{index}]", item) for index, item in enumerate(history)]:
+        for field in SESSION_CACHE_FIELDS:
+            caches += estimate_footprint(item.get(field), f"{item_label}.{field}", images, seen)
+    for key in SESSION_CACHE_KEYS:
+        caches += estimate_footprint(st.session_state.get(key), key, images, seen)
+    
+    breakdown = {
+        "seeds": estimate_footprint(seed_images, "seeds", images, seen),
+        "history": estimate_footprint(history, "history", images, seen),
+        "caches": caches,
+        "other": sum(estimate_footprint(st.session_state[key], key, images, seen) for key in list(st.session_state.keys()))
+    }
+    return {
+        "breakdown": breakdown,
+        "total": sum(breakdown.values()),
+        "seed_count": len(seed_images),
+        "history_count": len(history),
+        "largest_images": sorted(images, key=lambda image: image["bytes"], reverse=True)[:MEMORY_LARGEST_IMAGES]
+    }
+
+def report_session_memory():
+    """세션 메모리 추정치를 모니터에 보고
+
+    세션 상태 전체를 훑으므로 재실행마다 하지 않고, RSS 기록 간격이 지났거나 시드/처리 기록 수가 바뀌었을 때만 보고합니다.
+    """
+    counts = (len(st.session_state.seed_images), len(st.session_state.processing_history))
+    if (time.time() - st.session_state.get('memory_reported_at', 0) < MEMORY_RSS_INTERVAL
+            and st.session_state.get('memory_reported_counts') == counts):
+        return
+    get_memory_monitor().report_session(st.session_state.session_id, st.session_state.user_id, summarize_session_memory())
+    st.session_state.memory_reported_at = time.time()
+    st.session_state.memory_reported_counts = counts
+
+class MemoryMonitor:
+    """세션별 메모리 추정치 수집, RSS 추이 기록, tracemalloc 스냅샷 비교
+
+    세션 추정치는 각 세션이 재실행될 때 스스로 보고한 값입니다 (다른 세션의 상태를 직접 읽지 않음).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.rss_history = deque(maxlen=MEMORY_RSS_HISTORY)
+        self.snapshot = None
+        if os.environ.get("APP_TRACEMALLOC"):
+            self.start_tracing()
+        threading.Thread(target=self._rss_loop, daemon=True, name="memory-rss").start()
+
+    def _rss_loop(self):
+        while True:
+            self.record_rss()
+            time.sleep(MEMORY_RSS_INTERVAL)
+
+    def record_rss(self):
+        rss = get_process_rss()
+        if rss is not None:
+            with self.lock:
+                self.rss_history.append((datetime.now().isoformat(timespec="seconds"), rss))
+
+    def report_session(self, session_id, user_id, summary):
+        with self.lock:
+            self.sessions[session_id] = dict(summary, user_id=user_id, updated_at=time.time())
+
+    def start_tracing(self):
+        """tracemalloc 시작 (켜져 있는 동안 할당마다 비용이 듦) - 시작 시점이 첫 비교 기준"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.snapshot = tracemalloc.take_snapshot()
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def tracemalloc_report(self):
+        """할당 위치별 상위 사용량과 직전 조회 대비 증가량"""
+        if not tracemalloc.is_tracing():
+            return {"tracing": False}
+        
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        report = {
+            "tracing": True,
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "top": [
+                {"where": str(stat.traceback[0]), "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]
+            ]
+        }
+        if self.snapshot is not None:
+            report["diff_since_last"] = [
+                {"where": str(stat.traceback[0]), "bytes_diff": stat.size_diff, "bytes": stat.size, "count_diff": stat.count_diff}
+                for stat in snapshot.compare_to(self.snapshot, "lineno")[:TRACEMALLOC_TOP]
+            ]
+        self.snapshot = snapshot
+        return report
+
+    def stats(self):
+        self.record_rss()
+        cutoff = time.time() - MEMORY_SESSION_MAX_AGE
+        with self.lock:
+            for session_id in [sid for sid, info in self.sessions.items() if info["updated_at"] < cutoff]:
+                del self.sessions[session_id]
+            sessions = {sid: dict(info) for sid, info in self.sessions.items()}
+            rss_history = list(self.rss_history)
+        
+        images = [
+            dict(image, session_id=sid)
+            for sid, info in sessions.items() for image in info["largest_images"]
+        ]
+        for info in sessions.values():
+            del info["largest_images"]
+            info["updated_at"] = datetime.fromtimestamp(info["updated_at"]).isoformat(timespec="seconds")
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "rss": rss_history[-1][1] if rss_history else None,
+            "rss_history": rss_history,
+            "session_count": len(sessions),
+            "sessions_total_estimate": sum(info["total"] for info in sessions.values()),
+            "sessions": dict(sorted(sessions.items(), key=lambda item: item[1]["total"], reverse=True)),
+            "largest_images": sorted(images, key=lambda image: image["bytes"], reverse=True)[:MEMORY_LARGEST_IMAGES],
+            "tracemalloc": self.tracemalloc_report()
+        }
+
+@st.cache_resource
+def get_memory_monitor():
+    """프로세스 전체에서 공유하는 메모리 점검기 (처음 만들 때 RSS 기록 스레드 시작)"""
+    return MemoryMonitor()
+
+# 프로파일링 (관리자 전용) - 실행 중인 스크립트 스레드의 호출 스택을 주기적으로 샘플링해
+# pstats 파일과 flamegraph용 collapsed stack 파일로 저장. 꺼져 있으면 실행마다 설정 확인만 함
+PROFILE_DIR = "profiles"
+PROFILE_MODES = ("run", "job")       # run: 스크립트 실행 전체, job: 변환 작업 구간만
+PROFILE_SAMPLE_INTERVAL = 0.005      # 샘플링 간격 (초)
+PROFILE_MAX_SECONDS = 120            # 프로파일 하나의 최대 길이 (초)
+PROFILE_MAX_COUNT = 20               # 보관하는 최근 프로파일 수 (오래된 것부터 삭제)
+
+def get_profile_mode():
+    """이번 실행의 프로파일링 모드 ('run', 'job' 또는 None)
+
+    APP_PROFILE 환경변수가 우선이고, 없으면 ?profile=run|job 쿼리를 관리자 요청일 때만 따릅니다.
+    """
+    mode = os.environ.get("APP_PROFILE")
+    if mode in PROFILE_MODES:
+        return mode
+    
+    requested = st.query_params.get("profile")
+    if requested in PROFILE_MODES and is_admin_request():
+        return requested
+    return None
+
+class StackSampler:
+    """대상 스레드의 호출 스택을 주기적으로 샘플링하는 프로파일러
+
+    anchor 프레임(스크립트 모듈 실행 프레임)이 스택에서 사라지면 스스로 멈추고 저장하므로,
+    st.stop()/st.rerun()으로 실행이 중간에 끝나도 샘플러가 남지 않습니다.
+    """
+
+    def __init__(self, kind, anchor, label="", interval=PROFILE_SAMPLE_INTERVAL, max_seconds=PROFILE_MAX_SECONDS):
+        self.kind = kind
+        self.label = label
+        self.anchor = anchor
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.thread_id = threading.get_ident()
+        self.samples = {}   # (루트 → 말단 함수 키 튜플) → 샘플 수
+        self.started_at = time.time()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"profiler-{kind}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """샘플링 종료 및 파일 저장 (이미 스스로 멈췄으면 저장 완료까지 대기만 함)"""
+        self.stop_event.set()
+        self.thread.join()
+
+    def _sample(self):
+        """스택 하나 기록 - anchor가 스택에 없으면 (실행 종료) False"""
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            if frame is self.anchor:
+                break
+            frame = frame.f_back
+        if frame is None:
+            return False
+        
+        key = tuple(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            if time.time() - self.started_at > self.max_seconds or not self._sample():
+                break
+        self.anchor = None
+        try:
+            save_profile(self)
+        except Exception as e:
+            print(f"프로파일 저장 실패: {e}")
+
+def build_pstats(samples, interval):
+    """샘플을 pstats 형식 dict로 변환 - 호출 수는 샘플 수, 시간은 샘플 수 × 간격 (추정치)"""
+    stats = {}
+    
+    def entry(func):
+        return stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+    
+    for stack, count in samples.items():
+        elapsed = count * interval
+        for func in set(stack):
+            func_stats = entry(func)
+            func_stats[0] += count
+            func_stats[1] += count
+            func_stats[3] += elapsed
+        entry(stack[-1])[2] += elapsed
+        for caller, callee in set(zip(stack, stack[1:])):
+            edge = entry(callee)[4].setdefault(caller, [0, 0, 0.0, 0.0])
+            edge[0] += count
+            edge[1] += count
+            edge[3] += elapsed
+            if callee == stack[-1]:
+                edge[2] += elapsed
+    
+    return {
+        func: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+        for func, (cc, nc, tt, ct, callers) in stats.items()
+    }
+
+def save_profile(sampler):
+    """프로파일을 <이름>.pstats / .collapsed / .json 으로 저장하고 오래된 프로파일 정리"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    label = re.sub(r"[^0-9A-Za-z_-]", "_", sampler.label)[:40]
+    name = f"{datetime.fromtimestamp(sampler.started_at).strftime('%Y%m%d-%H%M%S')}_{sampler.kind}_{uuid.uuid4().hex[:6]}"
+    if label:
+        name += f"_{label}"
+    base_path = os.path.join(PROFILE_DIR, name)
+    
+    with open(base_path + ".pstats", "wb") as f:
+        marshal.dump(build_pstats(sampler.samples, sampler.interval), f)
+    
+    # flamegraph.pl / speedscope 등에서 바로 읽는 형식: "함수 (파일:줄);... 샘플수"
+    with open(base_path + ".collapsed", "w", encoding="utf-8") as f:
+        for stack, count in sorted(sampler.samples.items()):
+            frames = ";".join(f"{func} ({os.path.basename(filename)}:{line})" for filename, line, func in stack)
+            f.write(f"{frames} {count}\n")
+    
+    with open(base_path + ".json", "w", encoding="utf-8") as f:
+        json.dump({
+            "name": name,
+            "kind": sampler.kind,
+            "label": sampler.label,
+            "started_at": datetime.fromtimestamp(sampler.started_at).isoformat(),
+            "duration": time.time() - sampler.started_at,
+            "samples": sum(sampler.samples.values()),
+            "interval": sampler.interval
+        }, f, ensure_ascii=False)
+    
+    for old in list_profiles()[PROFILE_MAX_COUNT:]:
+        for extension in (".pstats", ".collapsed", ".json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, old["name"] + extension))
+            except FileNotFoundError:
+                pass
+
+def list_profiles():
+    """저장된 프로파일 목록 (최신순)"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for filename in os.listdir(PROFILE_DIR):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, filename), "r", encoding="utf-8") as f:
+                profile = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        profile["files"] = [os.path.join(PROFILE_DIR, profile["name"] + extension) for extension in (".pstats", ".collapsed")]
+        profiles.append(profile)
+    return sorted(profiles, key=lambda profile: profile["started_at"], reverse=True)
+
+def start_profiler(kind, anchor, label=""):
+    """프로파일 샘플링 시작 - stop()을 부르거나 anchor 프레임이 끝나면 저장"""
+    return StackSampler(kind, anchor, label).start()
+
+# 스크립트 재실행 시간 측정 - 위젯을 조작할 때마다 app.py 전체가 다시 실행되므로 구간별로 기록
+RERUN_TIMING_WINDOW = 500   # 구간별로 보관하는 최근 실행 수
+
+class RerunTimings:
+    """프로세스 전체의 스크립트 실행 소요시간 기록 (구간별 최근 값)"""
+
+    def __init__(self, window=RERUN_TIMING_WINDOW):
+        self.window = window
+        self.sections = {}
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def record(self, section, seconds):
+        with self.lock:
+            self.sections.setdefault(section, deque(maxlen=self.window)).append(seconds)
+            if section == "total":
+                self.runs += 1
+
+    def stats(self):
+        """구간별 소요시간 백분위수 (초)"""
+        with self.lock:
+            sections = {name: list(values) for name, values in self.sections.items()}
+            runs = self.runs
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "completed_runs": runs,
+            "window": self.window,
+            "sections": {name: summarize_wait_times(values) for name, values in sections.items()}
+        }
+
+@st.cache_resource
+def get_rerun_timings():
+    """프로세스 전체에서 공유하는 재실행 시간 기록"""
+    return RerunTimings()
+
+class RerunTimer:
+    """한 번의 스크립트 실행 안에서 구간이 끝날 때마다 직전 구간 소요시간을 기록
+
+    st.stop()/st.rerun()으로 중간에 끝난 실행은 그때까지의 구간만 남고 total은 기록되지 않습니다.
+    """
+
+    def __init__(self, timings, started_at):
+        self.timings = timings
+        self.started_at = started_at
+        self.last = started_at
+
+    def mark(self, section):
+        now = time.perf_counter()
+        self.timings.record(section, now - self.last)
+        self.last = now
+
+    def finish(self):
+        self.timings.record("total", time.perf_counter() - self.started_at)
+
+# 페이지 설정
+st.set_page_config(
+    page_title="AI 헤어스타일 변경 서비스",
+    page_icon="💇‍♀️",
+    layout="wide"
+)
+
+rerun_timer = RerunTimer(get_rerun_timings(), RERUN_STARTED_AT)
+rerun_timer.mark("module_setup")
+
+# API 엔드포인트 처리 (가장 먼저 실행)
+handle_verification_api()
+
+# 관리자 프로파일링 (켜져 있을 때만 샘플러 시작 - 이 모듈 실행 프레임이 끝나면 자동 저장)
+profile_mode = get_profile_mode()
+script_profiler = start_profiler("run", sys._getframe()) if profile_mode == "run" else None
+
+# 스타일링
+st.markdown("""
+<style>
+    .main-header {
+        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
+        color: white;
+        padding: 2rem;
+        border-radius: 10px;
+        text-align: center;
+        margin-bottom: 2rem;
+    }
+    .stButton > button {
+        background: linear-gradient(90deg, #667eea 0%, #764ba2 100%);
+        color: white;
+        border: none;
+        border-radius: 20px;
+        padding: 0.5rem 2rem;
+        font-weight: bold;
+    }
+    .success-box {
+        background: #d4edda;
+        color: #155724;
+        padding: 1rem;
+        border-radius: 5px;
+        border: 1px solid #c3e6cb;
+        margin: 1rem 0;
+    }
+    .info-box {
+        background: #d1ecf1;
+        color: #0c5460;
+        padding: 1rem;
+        border-radius: 5px;
+        border: 1px solid #bee5eb;
+        margin: 1rem 0;
+    }
+    .quality-info {
+        background: #fff3cd;
+        color: #856404;
+        padding: 1rem;
+        border-radius: 5px;
+        border: 1px solid #ffeaa7;
+        margin: 1rem 0;
+    }
+    .metrics-box {
+        background: #e2e3e5;
+        color: #383d41;
+        padding: 1rem;
+        border-radius: 5px;
+        border: 1px solid #d6d8db;
+        margin: 1rem 0;
+    }
+    .verification-box {
+        background: #f8f9fa;
+        color: #495057;
+        padding: 1rem;
+        border: 2px solid #6c757d;
+        border-radius: 8px;
+        margin: 1rem 0;
+    }
+</style>
+""", unsafe_allow_html=True)
+
+# 세션 상태 초기화
+if 'user_id' not in st.session_state:
+    # 새로고침/재접속 후에도 같은 사용자로 인식되도록 URL의 uid를 우선 사용
+    uid_param = st.query_params.get("uid", "")
+    st.session_state.user_id = uid_param if re.fullmatch(r"[0-9a-zA-Z_-]{4,32}", uid_param) else str(uuid.uuid4())[:8]
+
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:12]
+
+if st.query_params.get("uid") != st.session_state.user_id:
+    st.query_params["uid"] = st.session_state.user_id
+    
+if 'seed_images' not in st.session_state:
+    # 같은 uid로 저장된 상태가 있으면 복원 (다른 서버에서 저장했거나 서버 재시작 전 상태)
+    st.session_state.seed_images, st.session_state.processing_history = load_user_state(st.session_state.user_id)
+
+# 로깅 시스템 초기화
+setup_verification_logging()
+rerun_timer.mark("session_init")
+
+# API 설정 (대표 키 - 설정 여부 확인용, 실제 호출 키는 키 풀에서 선택)
+VMODEL_API_KEY = (get_vmodel_api_keys() or [""])[0]
+
+def get_task_api_key(task_id):
+    """Task를 만든 API 키 - 상태 조회/취소는 항상 같은 키로 (재시작 후에는 Task 기록의 key_id 사용)"""
+    pool = get_api_key_pool()
+    state = pool.key_for_task(task_id)
+    if state is None:
+        state = pool.get((get_task_store().get(task_id) or {}).get('key_id'))
+    return state.api_key
+
+def resize_image_if_needed(image, max_size=1024):
+    """이미지가 너무 크면 자동으로 리사이즈"""
+    width, height = image.size
+    
+    # 이미지가 max_size보다 크면 비율을 유지하며 리사이즈
+    if width > max_size or height > max_size:
+        # 긴 쪽을 기준으로 비율 계산
+        if width > height:
+            new_width = max_size
+            new_height = int(height * (max_size / width))
+        else:
+            new_height = max_size
+            new_width = int(width * (max_size / height))
+        
+        # 리샘플링으로 고품질 리사이즈
+        resized_image = resize_image(image, (new_width, new_height))
+        return resized_image, True  # 리사이즈됨을 표시
+    
+    return image, False  # 리사이즈 안됨
+
+def validate_image(image):
+    """이미지 유효성 검사 및 자동 리사이즈"""
+    try:
+        if image.size[0] < 100 or image.size[1] < 100:
+            return False, "이미지 크기가 너무 작습니다 (최소 100x100)", image
+        
+        # 자동 리사이즈
+        processed_image, was_resized = resize_image_if_needed(image, max_size=1024)
+        
+        if was_resized:
+            original_size = f"{image.size[0]}x{image.size[1]}"
+            new_size = f"{processed_image.size[0]}x{processed_image.size[1]}"
+            message = f"이미지 크기를 자동 조정했습니다: {original_size} → {new_size}"
+        else:
+            message = "유효한 이미지입니다"
+        
+        return True, message, processed_image
         
     except Exception as e:
         return False, f"이미지 검증 실패: {e}", image
 
-def upload_image_to_imgur(image):
-    """Imgur에 이미지 업로드하고 URL 반환"""
+# 머리 영역 크롭 설정
+SEED_ORIGINAL_MAX_SIZE = 4096     # 원본 해상도 보관 상한 (긴 변 기준)
+HEAD_CROP_PADDING = 0.15          # 머리 영역 바깥 여백 비율
+HEAD_CROP_SIZE = 1024             # 모델에 보내는 크롭 이미지 크기 (긴 변 기준)
+HEAD_BLEND_FEATHER = 0.08         # 결과 합성 경계 부드럽게 처리하는 비율
+DEFAULT_HEAD_BOX = (15, 0, 85, 75)  # 검출 실패시 기본 머리 영역 (%, 좌/상/우/하)
+
+@st.cache_resource
+def load_opencv():
+    """OpenCV 지연 로드 - 무거운 import를 앱 시작이 아닌 첫 얼굴 검출 때 한 번만 수행"""
+    try:
+        import cv2  # 선택 설치: 얼굴 검출로 머리 영역 자동 추정 (없으면 기본 영역 사용)
+    except ImportError:
+        return None
+    return cv2
+
+def detect_head_box(image):
+    """머리 영역 추정 - (좌, 상, 우, 하) 퍼센트 값
+
+    OpenCV가 있으면 CPU 얼굴 검출 결과를 머리카락까지 포함하도록 넓히고,
+    없거나 얼굴을 찾지 못하면 정면 인물 사진 기준 기본 영역을 사용합니다.
+    """
+    cv2 = load_opencv()
+    if cv2 is None:
+        return DEFAULT_HEAD_BOX
+    
+    try:
+        import numpy as np
+        
+        # 검출은 작은 흑백 이미지로 수행
+        small, _ = resize_image_if_needed(image.convert("L"), max_size=640)
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        faces = cascade.detectMultiScale(np.array(small), scaleFactor=1.1, minNeighbors=5, minSize=(40, 40))
+        if len(faces) == 0:
+            return DEFAULT_HEAD_BOX
+        
+        # 가장 큰 얼굴 기준으로 머리카락(위/옆)과 턱 아래를 포함하도록 확장
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+        width, height = small.size
+        left = max(0, x - 0.5 * w)
+        right = min(width, x + 1.5 * w)
+        top = max(0, y - 0.9 * h)
+        bottom = min(height, y + 1.4 * h)
+        return (
+            int(left / width * 100), int(top / height * 100),
+            int(round(right / width * 100)), int(round(bottom / height * 100))
+        )
+    except Exception as e:
+        print(f"머리 영역 검출 실패: {e}")
+        return DEFAULT_HEAD_BOX
+
+def get_head_crop_box(image_size, head_box, padding=HEAD_CROP_PADDING):
+    """퍼센트 머리 영역에 여백을 더한 픽셀 크롭 영역 (좌, 상, 우, 하)"""
+    width, height = image_size
+    left, top, right, bottom = head_box
+    pad_x = (right - left) * padding
+    pad_y = (bottom - top) * padding
+    return (
+        max(0, int((left - pad_x) / 100 * width)),
+        max(0, int((top - pad_y) / 100 * height)),
+        min(width, int(round((right + pad_x) / 100 * width))),
+        min(height, int(round((bottom + pad_y) / 100 * height)))
+    )
+
+def crop_head_region(image, head_box, target_size=HEAD_CROP_SIZE):
+    """원본에서 머리 영역만 잘라 모델 입력 크기로 맞춤 - (크롭 이미지, 픽셀 크롭 영역) 반환"""
+    crop_box = get_head_crop_box(image.size, head_box)
+    crop = image.crop(crop_box)
+    
+    # 작은 크롭은 확대, 큰 크롭은 축소하여 긴 변을 target_size에 맞춤
+    scale = target_size / max(crop.size)
+    if abs(scale - 1) > 0.01:
+        crop = resize_image(crop, (max(1, int(crop.width * scale)), max(1, int(crop.height * scale))))
+    return crop, crop_box
+
+def paste_head_result(original, result_crop, crop_box, feather=HEAD_BLEND_FEATHER):
+    """모델이 돌려준 머리 영역 결과를 원본 해상도 이미지에 부드럽게 합성"""
+    base = original.copy() if original.mode in ("RGB", "RGBA") else original.convert("RGB")
+    box_width, box_height = crop_box[2] - crop_box[0], crop_box[3] - crop_box[1]
+    patch = resize_image(result_crop.convert(base.mode), (box_width, box_height))
+    
+    # 가장자리로 갈수록 원본이 보이도록 흐린 마스크 사용 (이미지 경계에 닿은 쪽은 흐리지 않음)
+    margin = max(1, int(min(box_width, box_height) * feather))
+    inner = (
+        0 if crop_box[0] == 0 else margin,
+        0 if crop_box[1] == 0 else margin,
+        box_width if crop_box[2] == original.width else box_width - margin,
+        box_height if crop_box[3] == original.height else box_height - margin
+    )
+    mask = Image.new("L", (box_width, box_height), 0)
+    ImageDraw.Draw(mask).rectangle(inner, fill=255)
+    mask = mask.filter(ImageFilter.GaussianBlur(margin / 2))
+    
+    base.paste(patch, crop_box[:2], mask)
+    return base
+
+def draw_head_box_preview(image, head_box):
+    """머리 영역(여백 포함)을 표시한 미리보기 이미지"""
+    preview = image.convert("RGB")
+    draw = ImageDraw.Draw(preview)
+    draw.rectangle(get_head_crop_box(preview.size, head_box), outline=(118, 75, 162), width=max(2, preview.width // 150))
+    return preview
+
+def get_vmodel_version(quality_mode):
+    """품질 모드에 사용할 VModel 모델 버전"""
+    return st.secrets.get(get_quality_tier(quality_mode)["version_secret"], VMODEL_DEFAULT_VERSION)
+
+def prepare_image_for_tier(image, quality_mode):
+    """품질 모드의 작업 해상도로 축소"""
+    return resize_image_if_needed(image, max_size=get_quality_tier(quality_mode)["max_size"])[0]
+
+def encode_image_for_upload(image, quality_mode="high"):
+    """업로드용 이미지 인코딩 - (바이트, MIME 타입) 반환, 표준 모드는 작은 JPEG"""
+    tier = get_quality_tier(quality_mode)
+    if tier["format"] == "JPEG":
+        return encode_image(image, 'JPEG', convert_rgb=True, quality=tier["jpeg_quality"], optimize=True), 'image/jpeg'
+    return encode_image(image, 'PNG'), 'image/png'
+
+def upload_bytes_to_imgur(image_bytes, mime_type, timeout=UPLOAD_REQUEST_TIMEOUT):
+    """Imgur에 이미지 업로드하고 URL 반환 (실패시 예외)"""
+    # Imgur API 호출
+    headers = {
+        'Authorization': 'Client-ID 546c25a59c58ad7',  # 공개 클라이언트 ID
+        'Content-Type': 'application/json',
+    }
+    
+    data = {
+        'image': base64.b64encode(image_bytes).decode(),
+        'type': 'base64',
+        'title': 'temp_upload'
+    }
+    
+    response = requests.post(
+        'https://api.imgur.com/3/image',
+        headers=headers,
+        json=data,
+        timeout=timeout
+    )
+    
+    if response.status_code == 200:
+        result = response.json()
+        if result.get('success'):
+            return result['data']['link']
+    
+    raise RuntimeError(f"Imgur 업로드 실패: HTTP {response.status_code}")
+
+def upload_bytes_to_tmpfiles(image_bytes, mime_type, timeout=UPLOAD_REQUEST_TIMEOUT):
+    """대안 임시 파일 호스팅 서비스 (실패시 예외)"""
+    extension = mime_type.split('/')[-1]
+    files = {'file': (f'image.{extension}', io.BytesIO(image_bytes), mime_type)}
+    
+    response = requests.post(
+        'https://tmpfiles.org/api/v1/upload',
+        files=files,
+        timeout=timeout
+    )
+    
+    if response.status_code == 200:
+        result = response.json()
+        if 'data' in result and 'url' in result['data']:
+            # tmpfiles.org URL을 직접 액세스 가능한 형태로 변환
+            temp_url = result['data']['url']
+            return temp_url.replace('https://tmpfiles.org/', 'https://tmpfiles.org/dl/')
+    
+    raise RuntimeError(f"tmpfiles.org 업로드 실패: HTTP {response.status_code}")
+
+# 이미지 호스팅 서비스 목록 (우선순위 순) - 새 호스트는 여기에 추가
+IMAGE_UPLOAD_HOSTS = {
+    "imgur": upload_bytes_to_imgur,
+    "tmpfiles": upload_bytes_to_tmpfiles,
+}
+
+def upload_bytes_to_local_server(image_bytes, mime_type, timeout=None):
+    """자체 이미지 서버에 저장하고 서명된 URL 반환 - 외부 업로드 없이 디스크 쓰기만 발생"""
+    return get_local_image_server().put(image_bytes, mime_type)
+
+# 호스트별 업로드 URL 유효 시간 (초) - tmpfiles.org는 60분 후 삭제
+IMAGE_UPLOAD_HOST_TTL = {
+    "imgur": 6 * 60 * 60,
+    "tmpfiles": 55 * 60,
+}
+
+def get_image_upload_hosts():
+    """현재 설정에서 사용할 이미지 호스트 목록"""
+    if is_local_image_serving():
+        return {"local": upload_bytes_to_local_server}
+    return IMAGE_UPLOAD_HOSTS
+
+SEED_URL_REFRESH_MARGIN = 5 * 60   # 만료 이 시간 전에 시드 URL을 미리 다시 업로드 (초)
+
+def upload_image_hosted(image, quality_mode="high", timeout=UPLOAD_REQUEST_TIMEOUT):
+    """이미지 업로드 후 {url, host, expires_at} 반환 (실패시 예외) - Streamlit 호출 없음, 백그라운드 사용 가능"""
+    image_bytes, mime_type = encode_image_for_upload(image, quality_mode)
+    url, host = get_upload_hedger().upload(get_image_upload_hosts(), image_bytes, mime_type, timeout=timeout)
+    ttl = get_local_image_server().ttl if host == "local" else IMAGE_UPLOAD_HOST_TTL.get(host, 55 * 60)
+    return {
+        "url": url,
+        "host": host,
+        "expires_at": time.time() + ttl
+    }
+
+def upload_image(image, quality_mode="high", timeout=UPLOAD_REQUEST_TIMEOUT):
+    """이미지를 공개 URL로 업로드 - 여러 호스트에 헤징 업로드 후 가장 먼저 성공한 URL 반환
+
+    시간 초과(TimeoutError, DeadlineExceeded 포함)는 호출한 쪽이 작업 시간 초과로 기록하도록 그대로 전달합니다.
+    """
     try:
-        # 이미지를 base64로 변환
-        buffer = io.BytesIO()
-        image.save(buffer, format='PNG')
-        img_b64 = base64.b64encode(buffer.getvalue()).decode()
-        
-        # Imgur API 호출
-        headers = {
-            'Authorization': 'Client-ID 546c25a59c58ad7',  # 공개 클라이언트 ID
-            'Content-Type': 'application/json',
-        }
-        
-        data = {
-            'image': img_b64,
-            'type': 'base64',
-            'title': 'temp_upload'
-        }
-        
-        response = requests.post(
-            'https://api.imgur.com/3/image',
-            headers=headers,
-            json=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('success'):
-                return result['data']['link']
-        
-        # Imgur 실패시 fallback으로 임시 서비스 사용
-        st.warning("이미지 업로드 서비스에 일시적 문제가 있습니다. 다른 방법을 시도합니다...")
-        return upload_to_tempfile_io(image)
-        
+        return upload_image_hosted(image, quality_mode, timeout)["url"]
+    except TimeoutError:
+        raise
     except Exception as e:
-        st.warning(f"이미지 업로드 중 오류: {e}. 다른 방법을 시도합니다...")
-        return upload_to_tempfile_io(image)
+        notify("error", f"모든 이미지 업로드 서비스가 실패했습니다: {e}")
+        return None
 
-def upload_to_tempfile_io(image):
-    """대안 임시 파일 호스팅 서비스"""
-    try:
-        buffer = io.BytesIO()
-        image.save(buffer, format='PNG')
-        buffer.seek(0)
-        
-        files = {'file': ('image.png', buffer, 'image/png')}
-        
-        response = requests.post(
-            'https://tmpfiles.org/api/v1/upload',
-            files=files,
-            timeout=30
-        )
+def get_seed_upload_image(seed_data, head_box=None, quality_mode="high"):
+    """모델에 보낼 시드 이미지 - head_box가 있으면 원본 해상도에서 자른 머리 영역 (품질 모드 해상도)"""
+    max_size = get_quality_tier(quality_mode)["max_size"]
+    if head_box is None:
+        return prepare_image_for_tier(seed_data['image'], quality_mode)
+    return crop_head_region(seed_data.get('original_image', seed_data['image']), head_box, target_size=max_size)[0]
+
+def start_seed_upload(seed_data, head_box=None, quality_mode="high"):
+    """시드 이미지를 백그라운드에서 미리 업로드 (변환 시 업로드 대기 제거)"""
+    variant = (head_box, quality_mode)
+    seed_data['upload_variant'] = variant
+    seed_data['upload_future'] = get_background_executor().submit(
+        lambda: upload_image_hosted(get_seed_upload_image(seed_data, *variant), quality_mode)
+    )
+
+def ensure_seed_upload(seed_data, head_box=None, quality_mode="high"):
+    """머리 영역이나 품질 모드가 바뀌면 그 조합으로 미리 업로드를 다시 시작"""
+    if seed_data.get('upload_variant') != (head_box, quality_mode):
+        start_seed_upload(seed_data, head_box, quality_mode)
+
+def refresh_seed_uploads():
+    """백그라운드 업로드 결과 반영 및 만료가 가까운 시드 URL 재업로드"""
+    for seed_data in st.session_state.seed_images.values():
+        future = seed_data.get('upload_future')
+        if future is not None and future.done():
+            seed_data['upload_future'] = None
+            try:
+                hosted = future.result()
+                seed_data.update(hosted_url=hosted['url'], url_host=hosted['host'], url_expires_at=hosted['expires_at'])
+            except Exception as e:
+                # 실패하면 변환 시점에 다시 업로드
+                seed_data['upload_error'] = str(e)
         
-        if response.status_code == 200:
-            result = response.json()
-            if 'data' in result and 'url' in result['data']:
-                # tmpfiles.org URL을 직접 액세스 가능한 형태로 변환
-                temp_url = result['data']['url']
-                direct_url = temp_url.replace('https://tmpfiles.org/', 'https://tmpfiles.org/dl/')
-                return direct_url
-                
-    except Exception as e:
-        st.error(f"모든 이미지 업로드 서비스가 실패했습니다: {e}")
+        if seed_data.get('upload_future') is None and seed_data.get('hosted_url'):
+            if seed_data['url_expires_at'] - time.time() < SEED_URL_REFRESH_MARGIN:
+                start_seed_upload(seed_data, *seed_data['upload_variant'])
+
+def prepare_reference_image(file_bytes, quality_mode="high"):
+    """참조 이미지 검증/리사이즈/해시/업로드를 한 번에 처리 - 백그라운드 실행용"""
+    ref_image = Image.open(io.BytesIO(file_bytes))
+    is_valid, message, processed_image = validate_image(ref_image)
+    if is_valid:
+        processed_image = prepare_image_for_tier(processed_image, quality_mode)
+    prepared = {
+        "valid": is_valid,
+        "message": message,
+        "original_size": ref_image.size,
+        "image": processed_image,
+        "hosted": None
+    }
+    if is_valid:
+        prepared["image_hash"] = compute_image_hash(processed_image)
+        prepared["hosted"] = upload_image_hosted(processed_image, quality_mode)
+    return prepared
+
+def get_reference_key(ref_file, quality_mode):
+    return f"{hashlib.sha256(ref_file.getvalue()).hexdigest()}:{quality_mode}"
+
+def start_reference_prefetch(ref_file, quality_mode="high"):
+    """참조 이미지가 선택되면 바로 백그라운드에서 전처리/업로드 시작 (파일이 바뀌면 이전 작업 폐기)"""
+    file_bytes = ref_file.getvalue()
+    key = get_reference_key(ref_file, quality_mode)
+    prefetch = st.session_state.get('ref_prefetch')
+    if prefetch and prefetch['key'] == key:
+        return
+    
+    cancel_reference_prefetch()
+    st.session_state.ref_prefetch = {
+        "key": key,
+        "future": get_background_executor().submit(prepare_reference_image, file_bytes, quality_mode)
+    }
+
+def cancel_reference_prefetch():
+    """진행 중인 참조 이미지 선행 작업 취소 - 이미 시작된 업로드는 결과만 버림"""
+    prefetch = st.session_state.pop('ref_prefetch', None)
+    if prefetch:
+        prefetch['future'].cancel()
+
+def get_prefetched_reference(ref_file, quality_mode="high", timeout=60):
+    """현재 선택된 참조 이미지의 선행 처리 결과 - 없거나 실패하면 None"""
+    prefetch = st.session_state.get('ref_prefetch')
+    if not prefetch or prefetch['key'] != get_reference_key(ref_file, quality_mode):
         return None
+    try:
+        return prefetch['future'].result(timeout=timeout)
+    except Exception:
+        # 업로드 실패 등은 기존 경로에서 다시 처리
+        st.session_state.pop('ref_prefetch', None)
+        return None
+
+def get_ready_seed_url(seed_data, head_box=None, quality_mode="high", timeout=30):
+    """미리 업로드된 시드 URL 반환 - 업로드 중이면 완료를 기다리고, 없거나 만료 임박이면 None
+
+    head_box, quality_mode: 이번 변환 설정 - 미리 업로드한 조합과 다르면 사용할 수 없음
+    """
+    if seed_data.get('upload_variant') != (head_box, quality_mode):
+        return None
+    
+    future = seed_data.get('upload_future')
+    if future is not None:
+        try:
+            hosted = future.result(timeout=timeout)
+            seed_data.update(upload_future=None, hosted_url=hosted['url'], url_host=hosted['host'], url_expires_at=hosted['expires_at'])
+        except Exception:
+            seed_data['upload_future'] = None
+            return None
+    
+    if seed_data.get('hosted_url') and seed_data['url_expires_at'] - time.time() > SEED_URL_REFRESH_MARGIN:
+        return seed_data['hosted_url']
+    return None
+
+def is_client_connected():
+    """현재 세션의 브라우저 연결 유지 여부 (탭을 닫으면 False)"""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return True
+    try:
+        return get_runtime().is_active_session(ctx.session_id)
+    except RuntimeError:
+        return True
 
-def poll_vmodel_task(task_id, max_attempts=90):
-    """VModel Task 상태 폴링 - 실제 완료시에만 성능 로그 기록"""
-    headers = {"Authorization": f"Bearer {VMODEL_API_KEY}"}
+def cancel_task_by_user(task_id):
+    """작업 취소 버튼 콜백 - 다음 실행이 시작되기 전에 호출되어 Task를 바로 취소"""
+    get_task_poller().forget(task_id)
+    cancel_abandoned_task(task_id, get_task_api_key(task_id), reason="user")
+    st.session_state.canceled_task_id = task_id
+
+def cancel_pending_tasks(user_id, keep_input_hash=None, reason="superseded"):
+    """사용자의 진행 중 Task 취소 (결과가 이미 나온 Task와 keep_input_hash 작업은 유지)"""
+    poller = get_task_poller()
+    for record in get_task_store().find_resumable(user_id):
+        if record.get('status') == "pending" and (keep_input_hash is None or record.get('input_hash') != keep_input_hash):
+            poller.forget(record['task_id'])
+            cancel_abandoned_task(record['task_id'], get_task_api_key(record['task_id']), reason=reason)
+
+def fail_job_deadline(deadline, stage, quality_mode, task_id=None, queue_wait_time=0):
+    """작업 시간 예산 초과 처리 - 진행 중인 Task는 취소하고 단계별 소요시간과 함께 실패 기록"""
+    canceled = bool(task_id) and cancel_task(task_id, get_task_api_key(task_id))
+    if task_id:
+        get_task_store().update(task_id, status="canceled" if canceled else "timeout")
     
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    elapsed = deadline.elapsed()
+    record_job_service_time(deadline, quality_mode, timed_out=True)
+    stage_summary = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in deadline.stage_times.items())
+    append_to_log(
+        "logs/deadline_overruns.log",
+        f"[{datetime.now().isoformat()}] DEADLINE_EXCEEDED task={task_id} stage={stage} canceled={canceled} ({stage_summary})"
+    )
+    log_vmodel_api_call(
+        {"task_id": task_id, "status": "deadline_exceeded"},
+        {
+            "task_id": task_id,
+            "error": f"deadline_exceeded: {stage}",
+            "queue_wait_time": queue_wait_time,
+            "quality_mode": quality_mode,
+            "stage_times": deadline.stage_times
+        },
+        success=False,
+        processing_time=elapsed,
+        is_final_completion=True  # 시간 초과도 하나의 완료된 시도
+    )
+    notify("error", f"⏱️ {round(deadline.expires_at - deadline.started_at)}초 안에 완료할 수 없어 작업을 중단했습니다 (지연 단계: {stage})")
+
+def poll_vmodel_task(task_id, quality_mode="high", queue_wait_time=0, deadline=None, retry_counts=None):
+    """Task 상태 대기 - 조회는 공용 폴러가 담당, 실제 완료시에만 성능 로그 기록
+
+    폴링 간격/첫 조회 시점은 품질 모드 설정(QUALITY_TIERS)을 따르고,
+    대기/조회/다운로드 제한시간은 작업 마감 시각(deadline)까지 남은 시간으로 줄어듦.
+    작업 결과(지연/실패)는 Task를 만든 백엔드의 라우팅 통계에 반영
+    retry_counts: 작업 단계별 재시도 횟수 (생성 단계에서 넘겨받아 최종 기록에 포함)
+    """
+    tier = get_quality_tier(quality_mode)
+    deadline = deadline or JobDeadline()
+    retry_counts = retry_counts if retry_counts is not None else {"create": 0, "status": 0, "download": 0}
+    poller = get_task_poller()
+    store = get_task_store()
+    router = get_backend_router()
+    backend = get_task_backend(task_id)
     
     api_start_time = time.time()
+    max_wait = min(tier["max_wait"], deadline.remaining())
+    if max_wait < JOB_MIN_REQUEST_TIMEOUT:
+        fail_job_deadline(deadline, "poll", quality_mode, task_id, queue_wait_time)
+        return None
     
-    for attempt in range(max_attempts):
-        try:
-            poll_start_time = time.time()
-            response = requests.get(
-                f"https://api.vmodel.ai/api/tasks/v1/get/{task_id}", 
-                headers=headers,
-                timeout=10
-            )
-            api_response_time = time.time() - poll_start_time
+    watch = poller.watch(
+        task_id, get_task_api_key(task_id),
+        poll_delay=tier["poll_delay"], interval=tier["poll_interval"], timeout=min(tier["status_timeout"], max_wait)
+    )
+    
+    # 진행 상태는 작업 기록에 남기고 화면의 진행 영역이 주기적으로 읽어 표시 (취소 버튼도 그쪽에)
+    report_job_progress(task_id=task_id, progress=0.0, status_text="⏳ 작업 상태 확인 중...")
+    seen_version = 0
+    abandoned = False
+    
+    # 폴링 로그는 상태가 바뀔 때만 기록 (DEBUG_POLL_LOGGING이면 모든 응답 기록)
+    log_every_poll = bool(st.secrets.get("DEBUG_POLL_LOGGING", False))
+    last_status = None
+    transitions = []
+    
+    def poll_summary():
+        """최종 로그에 남길 폴링 요약 - 조회 횟수, 평균 조회 응답시간, 상태 전이 기록"""
+        snapshot = watch.snapshot()
+        retry_counts["status"] = snapshot["retries"]
+        return {
+            "polls": snapshot["poll_count"],
+            "avg_status_response_time": snapshot["total_response_time"] / max(1, snapshot["poll_count"]),
+            "wait_time": time.time() - api_start_time,
+            "transitions": transitions
+        }
+    
+    try:
+        while True:
+            elapsed = time.time() - api_start_time
+            if elapsed >= max_wait:
+                break
             
-            if response.status_code == 200:
-                result = response.json()
-                
-                # 중간 단계 로그 (성능 측정 제외)
+            if not is_job_viewed():
+                # 탭을 닫음 - 유예 시간 안에 재접속해서 이어받지 않으면 폴러가 취소
+                abandoned = True
+                return None
+            
+            # 폴러가 새 상태를 받아올 때까지 대기 (직접 조회하지 않음) - 탭 닫힘을 확인할 수 있도록 짧게 나눠 대기
+            version = watch.wait_for_update(seen_version, timeout=min(max_wait - elapsed, JOB_PROGRESS_INTERVAL))
+            if version == seen_version:
+                continue
+            seen_version = version
+            task = watch.snapshot()
+            
+            # 제공자가 취소했거나, 사용자가 취소/새 작업으로 대체해 폴러에서 제외됨
+            if task["status"] == "canceled":
+                store.update(task_id, status="canceled")
+                notify("error", "작업이 취소되었습니다.")
+                return None
+            # 재시도할 수 없는 조회 오류(4xx, 연속 연결 실패)는 응답 본문이 없어도 바로 실패 처리
+            if task["status"] == "error":
+                router.record(backend.name, False)
+                store.update(task_id, status="error")
+                notify("error", f"Task 상태 확인 실패: {task['last_error']}")
+                return None
+            if task["poll_count"] == 0 or task["result"] is None:
+                continue
+            
+            result = task["result"]
+            api_response_time = task["api_response_time"]
+            
+            # 중간 단계 로그 (성능 측정 제외) - 상태 전이만 기록
+            current_status = (result.get('result') or {}).get('status') if isinstance(result.get('result'), dict) else None
+            status_changed = current_status != last_status
+            if status_changed:
+                transitions.append({
+                    "status": current_status,
+                    "poll": task["poll_count"],
+                    "elapsed": round(time.time() - api_start_time, 2)
+                })
+                last_status = current_status
+            if status_changed or log_every_poll:
                 log_vmodel_api_call(
-                    {"task_id": task_id, "status": "polling"},
+                    {"task_id": task_id, "status": "polling", "poll_count": task["poll_count"]},
                     result,
                     success=True,
                     processing_time=time.time() - api_start_time,
                     is_final_completion=False  # 중간 단계는 성능 측정 제외
                 )
+            
+            # 응답 구조 확인
+            if result.get('code') == 200 and 'result' in result:
+                task_result = result['result']
+                status = task_result.get('status', 'processing')
+
+                # 진행률 업데이트 (안내한 처리 시간 기준)
+                progress = min(0.95, (time.time() - api_start_time) / tier["target_time"])
+                report_job_progress(progress=progress)
                 
-                # 응답 구조 확인
-                if result.get('code') == 200 and 'result' in result:
-                    task_result = result['result']
-                    status = task_result.get('status', 'processing')
+                if status == 'processing':
+                    report_job_progress(status_text=f"🎨 AI {tier['label']} 처리 중... ({progress*100:.0f}%) - {int(time.time() - api_start_time)}/{int(max_wait)}초")
+                elif status == 'starting':
+                    report_job_progress(status_text="🚀 AI 모델 시작 중...")
+                elif status == 'succeeded':
+                    report_job_progress(progress=1.0, status_text="✨ 완료!")
                     
-                    # 진행률 업데이트
-                    progress = min(0.95, (attempt + 1) * 0.01)
-                    progress_bar.progress(progress)
-                    
-                    if status == 'processing':
-                        status_text.text(f"🎨 AI 고품질 처리 중... ({progress*100:.0f}%) - {attempt+1}/90초")
-                    elif status == 'starting':
-                        status_text.text("🚀 AI 모델 시작 중...")
-                    elif status == 'succeeded':
-                        progress_bar.progress(1.0)
-                        status_text.text("✨ 완료!")
+                    # 결과 이미지 URL 가져오기
+                    deadline.record("poll", time.time() - api_start_time)
+                    output = task_result.get('output', [])
+                    if output and len(output) > 0:
+                        result_url = output[0]
+                        store.update(task_id, status="succeeded", result_url=result_url)
+                        notify("info", f"결과 이미지 다운로드 중: {result_url}")
                         
-                        # 결과 이미지 URL 가져오기
-                        output = task_result.get('output', [])
-                        if output and len(output) > 0:
-                            result_url = output[0]
-                            st.info(f"결과 이미지 다운로드 중: {result_url}")
+                        try:
+                            download_status, image_bytes = fetch_result_with_retry(
+                                backend, result_url, deadline, tier["download_timeout"], retry_counts
+                            )
+                        except (TimeoutError, requests.exceptions.Timeout):
+                            # Task는 이미 완료됨 - 취소 없이 실패만 기록 (재접속시 결과 URL로 다시 받음)
+                            fail_job_deadline(deadline, "download", quality_mode, queue_wait_time=queue_wait_time)
+                            return None
+                        if download_status == 200:
+                            total_processing_time = time.time() - api_start_time
+                            router.record(backend.name, True, total_processing_time)
+                            record_job_service_time(deadline, quality_mode)
                             
-                            img_response = requests.get(result_url, timeout=30)
-                            if img_response.status_code == 200:
-                                total_processing_time = time.time() - api_start_time
-                                
-                                # 실제 완료 로그만 성능 측정에 포함
-                                log_vmodel_api_call(
-                                    {"task_id": task_id, "status": "poll_completed"},
-                                    {
-                                        "task_id": task_id,
-                                        "result_url": result_url,
-                                        "api_response_time": api_response_time,
-                                        "total_time": task_result.get('total_time', 0)
-                                    },
-                                    success=True,
-                                    processing_time=total_processing_time,
-                                    is_final_completion=True  # 실제 완료만 성능 측정 포함
-                                )
-                                
-                                return Image.open(io.BytesIO(img_response.content))
-                            else:
-                                st.error(f"이미지 다운로드 실패: HTTP {img_response.status_code}")
-                                return None
-                        
-                        st.error("결과 이미지 URL을 찾을 수 없습니다.")
-                        return None
-                        
-                    elif status == 'failed':
-                        error_msg = task_result.get('error', '알 수 없는 오류')
-                        
-                        # 실패 로그 (성능 측정 포함)
-                        log_vmodel_api_call(
-                            {"task_id": task_id, "status": "poll_failed"},
-                            {"task_id": task_id, "error": error_msg},
-                            success=False,
-                            processing_time=time.time() - api_start_time,
-                            is_final_completion=True  # 실패도 하나의 완료된 시도
-                        )
-                        
-                        st.error(f"처리 실패: {error_msg}")
-                        return None
+                            # 실제 완료 로그만 성능 측정에 포함
+                            log_vmodel_api_call(
+                                {"task_id": task_id, "status": "poll_completed"},
+                                {
+                                    "task_id": task_id,
+                                    "result_url": result_url,
+                                    "api_response_time": api_response_time,
+                                    "queue_wait_time": queue_wait_time,
+                                    "quality_mode": quality_mode,
+                                    "stage_times": deadline.stage_times,
+                                    "backend": backend.name,
+                                    "poll_summary": poll_summary(),
+                                    "retries": retry_counts,
+                                    "total_time": task_result.get('total_time', 0)
+                                },
+                                success=True,
+                                processing_time=total_processing_time,
+                                is_final_completion=True  # 실제 완료만 성능 측정 포함
+                            )
+                            
+                            store.update(task_id, delivered=True)
+                            return Image.open(io.BytesIO(image_bytes))
+                        else:
+                            notify("error", f"이미지 다운로드 실패: HTTP {download_status}")
+                            return None
                     
-                    elif status == 'canceled':
-                        st.error("작업이 취소되었습니다.")
-                        return None
-                
-                time.sleep(1)
-            else:
-                st.error(f"Task 상태 확인 실패: HTTP {response.status_code}")
-                return None
-                
-        except Exception as e:
-            if attempt == max_attempts - 1:
-                st.error(f"처리 시간 초과 (90초): {e}")
-                return None
-            time.sleep(1)
+                    store.update(task_id, status="failed")
+                    notify("error", "결과 이미지 URL을 찾을 수 없습니다.")
+                    return None
+                    
+                elif status == 'failed':
+                    error_msg = task_result.get('error', '알 수 없는 오류')
+                    router.record(backend.name, False)
+                    
+                    # 실패 로그 (성능 측정 포함)
+                    log_vmodel_api_call(
+                        {"task_id": task_id, "status": "poll_failed"},
+                        {
+                            "task_id": task_id,
+                            "error": error_msg,
+                            "queue_wait_time": queue_wait_time,
+                            "quality_mode": quality_mode,
+                            "backend": backend.name,
+                            "poll_summary": poll_summary(),
+                            "retries": retry_counts
+                        },
+                        success=False,
+                        processing_time=time.time() - api_start_time,
+                        is_final_completion=True  # 실패도 하나의 완료된 시도
+                    )
+                    
+                    store.update(task_id, status="failed")
+                    notify("error", f"처리 실패: {error_msg}")
+                    return None
+        
+        # 시간 초과된 Task는 제공자 쪽에서도 취소하고 자동으로 다시 이어받지 않음
+        deadline.record("poll", time.time() - api_start_time)
+        router.record(backend.name, False)
+        last_error = watch.snapshot()["last_error"]
+        if deadline.expired():
+            fail_job_deadline(deadline, "poll", quality_mode, task_id, queue_wait_time)
+            return None
+        
+        store.update(task_id, status="canceled" if cancel_task(task_id, get_task_api_key(task_id)) else "timeout")
+        if last_error:
+            notify("error", f"처리 시간 초과 ({int(max_wait)}초): {last_error}")
+        else:
+            notify("error", f"처리 시간 초과 - {backend.name} 서버가 응답하지 않습니다")
+        return None
     
-    st.error("처리 시간 초과 - VModel 서버가 응답하지 않습니다")
-    return None
+    except BaseException:
+        # 예외로 대기가 중단됨 - 유예 시간 안에 다시 이어받지 않으면 폴러가 취소
+        abandoned = True
+        raise
+    finally:
+        poller.unwatch(task_id, abandoned=abandoned)
+
+def submit_with_retry(backend, lease, target_url, source_url, quality_mode, deadline, idempotency_key, retry_counts):
+    """Task 생성 요청 + 일시적 오류 재시도 - 마지막 submit 결과 반환 (요청 예외는 재시도 후에도 실패하면 그대로 전달)
+
+    서버가 요청을 처리하지 않은 것이 확실한 오류(연결 실패, 429, 503)만 기본으로 재시도합니다.
+    처리 여부가 불분명한 오류(응답 시간 초과, 연결 끊김, 그 외 5xx)는 제공자가 Idempotency-Key로
+    중복 생성을 막는다고 설정한 경우(VMODEL_IDEMPOTENT_CREATE)에만 같은 키로 재시도합니다.
+    """
+    idempotent = bool(st.secrets.get("VMODEL_IDEMPOTENT_CREATE", False))
+    create_timeout = get_quality_tier(quality_mode)["create_timeout"]
+    
+    for attempt in range(CREATE_MAX_RETRIES + 1):
+        error = None
+        submitted = None
+        try:
+            with deadline.stage("create"):
+                submitted = backend.submit(
+                    lease, target_url, source_url, quality_mode,
+                    timeout=deadline.timeout(create_timeout, "create"),
+                    idempotency_key=idempotency_key
+                )
+            if submitted["task_id"]:
+                return submitted
+            category = classify_error(status_code=submitted["status_code"])
+        except requests.RequestException as e:
+            error = e
+            category = classify_error(e)
+        
+        delay = retry_delay(attempt, submitted["retry_after"] if submitted else None)
+        safe = category in NOT_PROCESSED_ERRORS or (idempotent and is_retryable(category))
+        if attempt == CREATE_MAX_RETRIES or not safe or deadline.remaining() - delay < JOB_MIN_REQUEST_TIMEOUT:
+            if error is not None:
+                raise error
+            return submitted
+        
+        retry_counts["create"] += 1
+        append_to_log(
+            "logs/vmodel_api_raw.log",
+            f"[{datetime.now().isoformat()}] VMODEL_CREATE_RETRY: backend={backend.name} attempt={attempt + 1} category={category} delay={delay:.2f}s"
+        )
+        time.sleep(delay)
+        backend.acquire_retry(lease, timeout=deadline.timeout(JOB_DEADLINE_SECONDS, "create"))
+    return submitted
+
+def fetch_result_with_retry(backend, result_url, deadline, timeout_limit, retry_counts):
+    """결과 이미지 다운로드 + 일시적 오류 재시도 - (HTTP 상태코드, 바이트) 반환
+
+    남은 예산이 부족하면 DeadlineExceeded, 재시도 후에도 요청 예외면 그대로 전달합니다.
+    """
+    for attempt in range(DOWNLOAD_MAX_RETRIES + 1):
+        error = None
+        try:
+            with deadline.stage("download"):
+                status_code, content = backend.fetch_result(result_url, deadline.timeout(timeout_limit, "download"))
+            if status_code == 200:
+                return status_code, content
+            category = classify_error(status_code=status_code)
+        except requests.RequestException as e:
+            error = e
+            category = classify_error(e)
+        
+        delay = retry_delay(attempt)
+        if attempt == DOWNLOAD_MAX_RETRIES or not is_retryable(category) or deadline.remaining() - delay < JOB_MIN_REQUEST_TIMEOUT:
+            if error is not None:
+                raise error
+            return status_code, content
+        
+        retry_counts["download"] += 1
+        time.sleep(delay)
 
-def process_with_vmodel_api(seed_image, ref_image, quality_mode="high"):
-    """VModel API로 헤어 변경 처리 - 중간 로깅 제거"""
+def process_with_vmodel_api(seed_image, ref_image, quality_mode="high", task_meta=None, seed_url=None, ref_url=None, deadline=None):
+    """헤어 변경 처리 - 라우터가 고른 백엔드(기본 VModel)로 Task 생성 후 결과 대기, 중간 로깅 제거
+
+    task_meta: Task 기록에 함께 저장할 정보 (사용자/세션 ID, 입력 해시 등) - 재연결용
+    seed_url, ref_url: 미리 업로드해 둔 이미지 URL (없으면 여기서 업로드)
+    deadline: 작업 마감 시각 (JobDeadline) - 모든 단계가 남은 시간 안에서만 진행
+    """
     
-    if not VMODEL_API_KEY:
-        st.error("⚠️ VModel API 키가 설정되지 않았습니다. Streamlit Secrets에서 VMODEL_API_KEY를 설정해주세요.")
+    if not VMODEL_API_KEY and "vmodel" in get_image_backend_names():
+        notify("error", "⚠️ VModel API 키가 설정되지 않았습니다. Streamlit Secrets에서 VMODEL_API_KEY를 설정해주세요.")
         return None
     
+    deadline = deadline or JobDeadline()
+    queue_wait_time = 0
+    # 이 작업의 재시도 횟수 (성능 기록용)와 생성 재시도에 같이 보내는 멱등 키
+    retry_counts = {"create": 0, "status": 0, "download": 0}
+    idempotency_key = f"{(task_meta or {}).get('input_hash') or 'job'}-{uuid.uuid4().hex[:12]}"
     try:
         # 이미지를 실제 URL로 업로드
-        st.info("이미지를 업로드하고 있습니다...")
-        target_url = upload_image_to_imgur(seed_image)
-        swap_url = upload_image_to_imgur(ref_image)
+        notify("info", "이미지를 업로드하고 있습니다...")
+        with deadline.stage("upload"):
+            target_url = seed_url or upload_image(seed_image, quality_mode, deadline.timeout(UPLOAD_REQUEST_TIMEOUT, "upload"))
+            swap_url = ref_url or upload_image(ref_image, quality_mode, deadline.timeout(UPLOAD_REQUEST_TIMEOUT, "upload"))
         
         if not target_url or not swap_url:
-            st.error("이미지 업로드에 실패했습니다. 잠시 후 다시 시도해주세요.")
+            notify("error", "이미지 업로드에 실패했습니다. 잠시 후 다시 시도해주세요.")
             return None
         
-        st.success("이미지 업로드 완료!")
-        
-        # VModel API 페이로드
-        payload = {
-            "version": "5c0440717a995b0bbd93377bd65dbb4fe360f67967c506aa6bd8f6b660733a7e",
-            "input": {
-                "source": swap_url,
-                "target": target_url,
-                "disable_safety_checker": False,
-            }
-        }
+        notify("success", "이미지 업로드 완료!")
         
         # 고품질 모드 선택시 추가 파라미터
         if quality_mode == "high":
-            st.markdown("""
+            notify("markdown", """
             <div class="quality-info">
                 🎨 <strong>고품질 모드</strong>로 처리합니다<br>
                 • 더 선명한 머리카락 디테일<br>
@@ -717,82 +4078,394 @@ def process_with_vmodel_api(seed_image, ref_image, quality_mode="high"):
                 • 처리시간 약간 증가 (30-45초)
             </div>
             """, unsafe_allow_html=True)
+        else:
+            notify("markdown", """
+            <div class="quality-info">
+                ⚡ <strong>표준 모드</strong>로 처리합니다<br>
+                • 작은 해상도와 압축 이미지로 업로드<br>
+                • 짧은 간격으로 결과 확인 (15-25초)
+            </div>
+            """, unsafe_allow_html=True)
         
-        headers = {
-            "Authorization": f"Bearer {VMODEL_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Task 생성 API 호출 (중간 로깅 제거)
-        api_start_time = time.time()
-        response = requests.post(
-            "https://api.vmodel.ai/api/tasks/v1/create", 
-            json=payload, 
-            headers=headers, 
-            timeout=30
-        )
-        api_response_time = time.time() - api_start_time
-        
-        if response.status_code == 200:
-            result = response.json()
-            
-            # Task 생성 로그 (성능 측정 제외)
-            log_vmodel_api_call(
-                payload,
-                {"response": result, "api_response_time": api_response_time},
-                success=True,
-                processing_time=api_response_time,
-                is_final_completion=False  # 시작 단계는 성능 측정 제외
-            )
-            
-            # 응답 구조 확인
-            if result.get('code') == 200 and 'result' in result:
-                task_id = result['result'].get('task_id')
-                if task_id:
-                    return poll_vmodel_task(task_id, max_attempts=90)
+        # 사용자별 공정 분배 - 다른 사용자가 작업을 몰아 넣어도 번갈아 진행 슬롯을 배정받음 (작업이 끝날 때까지 유지)
+        scheduler = get_job_scheduler()
+        user_id = (task_meta or {}).get('user_id') or st.session_state.get('user_id', 'unknown')
+        if scheduler.would_wait(user_id):
+            notify("info", "요청이 많아 대기열에서 순서를 기다리고 있습니다...")
+        deadline.current_stage = "queue"
+        # 대기열 입장을 받아들인 작업은 늘어난 예산만큼 기다릴 수 있음
+        with scheduler.slot(user_id, timeout=deadline.timeout(deadline.remaining(), "queue")) as scheduler_wait_time:
+            deadline.record("queue", scheduler_wait_time)
+            queue_wait_time = scheduler_wait_time
             
-        # 에러 응답 로그 (성능 측정 포함)
-        try:
-            error_data = response.json()
-            log_vmodel_api_call(
-                payload,
-                {"error": error_data, "status_code": response.status_code},
-                success=False,
-                processing_time=api_response_time,
-                is_final_completion=True  # 실패도 하나의 완료된 시도
-            )
-            st.error(f"API 오류: {error_data}")
-        except:
-            log_vmodel_api_call(
-                payload,
-                {"error": f"HTTP {response.status_code}", "status_code": response.status_code},
-                success=False,
-                processing_time=api_response_time,
-                is_final_completion=True
-            )
-            st.error(f"API 호출 실패: HTTP {response.status_code}")
-        
+            # 가장 빠른 정상 백엔드부터 시도 - Task 생성에 실패하면 다음 백엔드로 전환
+            router = get_backend_router()
+            submit_errors = []
+            for backend in router.candidates():
+                if backend.is_saturated():
+                    notify("info", "요청이 많아 대기열에서 순서를 기다리고 있습니다...")
+                
+                # 백엔드별 동시 진행 Task 수와 생성 속도 제한 (초과시 FIFO 대기)
+                deadline.current_stage = "queue"
+                with backend.reserve(timeout=deadline.timeout(JOB_DEADLINE_SECONDS, "queue")) as (lease, slot_wait_time):
+                    deadline.record("queue", slot_wait_time)
+                    queue_wait_time = scheduler_wait_time + slot_wait_time
+                    
+                    # Task 생성 요청 (일시적 오류는 같은 멱등 키로 재시도)
+                    try:
+                        submitted = submit_with_retry(
+                            backend, lease, target_url, swap_url, quality_mode, deadline, idempotency_key, retry_counts
+                        )
+                    except requests.RequestException as e:
+                        if deadline.expired():
+                            raise
+                        router.record(backend.name, False)
+                        submit_errors.append(f"{backend.name}: {e}")
+                        continue
+                    
+                    task_id = submitted["task_id"]
+                    if task_id:
+                        # Task 생성 로그 (성능 측정 제외)
+                        log_vmodel_api_call(
+                            submitted["payload"],
+                            {"response": submitted["response"], "api_response_time": submitted["api_response_time"], "backend": backend.name},
+                            success=True,
+                            processing_time=submitted["api_response_time"],
+                            is_final_completion=False  # 시작 단계는 성능 측정 제외
+                        )
+                        
+                        # 새로고침되어도 같은 Task에 (같은 백엔드/키로) 다시 연결할 수 있도록 기록
+                        router.pin(task_id, backend.name)
+                        get_task_store().add({
+                            **(task_meta or {}),
+                            "task_id": task_id,
+                            "quality_mode": quality_mode,
+                            "deadline_at": deadline.expires_at,
+                            "backend": backend.name,
+                            "key_id": submitted["key_id"]
+                        })
+                        return poll_vmodel_task(task_id, quality_mode=quality_mode, queue_wait_time=queue_wait_time, deadline=deadline, retry_counts=retry_counts)
+                    
+                    # 생성 실패 - 중간 단계로만 기록하고 다음 백엔드로
+                    router.record(backend.name, False)
+                    error_data = submitted["response"] or f"HTTP {submitted['status_code']}"
+                    log_vmodel_api_call(
+                        submitted["payload"],
+                        {"error": error_data, "status_code": submitted["status_code"], "backend": backend.name},
+                        success=False,
+                        processing_time=submitted["api_response_time"],
+                        is_final_completion=False
+                    )
+                    submit_errors.append(f"{backend.name}: {error_data}")
+
+        # 모든 백엔드에서 생성 실패 (성능 측정 포함)
+        log_vmodel_api_call(
+            {"status": "submit_failed"},
+            {"error": "; ".join(submit_errors), "queue_wait_time": queue_wait_time, "quality_mode": quality_mode, "retries": retry_counts},
+            success=False,
+            processing_time=deadline.elapsed(),
+            is_final_completion=True  # 실패도 하나의 완료된 시도
+        )
+        notify("error", f"API 오류: {'; '.join(submit_errors)}")
         return None
         
     except Exception as e:
+        # 남은 시간이 부족해 중단된 경우 (대기열/생성 요청 시간 초과 포함)
+        if isinstance(e, TimeoutError) or deadline.expired():
+            fail_job_deadline(deadline, getattr(e, 'stage', None) or deadline.current_stage, quality_mode, queue_wait_time=queue_wait_time)
+            return None
+        
         # 예외 로그 (성능 측정 포함)
         log_vmodel_api_call(
             {"error_context": "exception_in_process_with_vmodel_api"},
-            {"error": str(e)},
+            {"error": str(e), "quality_mode": quality_mode},
             success=False,
             processing_time=0,
             is_final_completion=True
         )
-        st.error(f"처리 중 오류 발생: {e}")
+        notify("error", f"처리 중 오류 발생: {e}")
+        return None
+
+def resume_vmodel_task(record):
+    """기록된 Task에 다시 연결 - 완료된 Task는 결과만 받아오고, 진행 중이면 원래 마감 시각까지만 상태 대기"""
+    task_id = record['task_id']
+    quality_mode = record.get('quality_mode', 'high')
+    
+    if record.get('status') == "succeeded" and record.get('result_url'):
+        download_status, image_bytes = get_task_backend(task_id).fetch_result(
+            record['result_url'], get_quality_tier(quality_mode)["download_timeout"]
+        )
+        if download_status == 200:
+            get_task_store().update(task_id, delivered=True)
+            return Image.open(io.BytesIO(image_bytes))
+        
+        # 결과 URL이 만료된 경우 다시 시도하지 않음
+        get_task_store().update(task_id, status="failed")
+        notify("error", f"이전 결과 다운로드 실패: HTTP {download_status}")
         return None
+    
+    # 이 서버가 이어받음 (처음 기다리던 서버는 세션이 사라져도 취소하지 않음)
+    get_task_store().update(task_id, replica=log_shards.get_shard_id())
+    deadline = JobDeadline(expires_at=record.get('deadline_at') or record['created_at'] + JOB_DEADLINE_SECONDS)
+    return poll_vmodel_task(task_id, quality_mode=quality_mode, deadline=deadline)
+
+def restore_full_resolution(seed_data, result_image, head_box):
+    """머리 영역 결과를 원본 해상도 시드에 합성 (전체 이미지로 처리했으면 그대로 반환)"""
+    if not head_box:
+        return result_image
+    original = seed_data.get('original_image', seed_data['image'])
+    return paste_head_result(original, result_image, get_head_crop_box(original.size, head_box))
+
+def add_history_item(seed_filename, ref_filename, result_image, processing_time, quality_mode):
+    """처리 기록 저장"""
+    history_item = {
+        'id': str(uuid.uuid4())[:8],
+        'seed_filename': seed_filename,
+        'ref_filename': ref_filename,
+        'result_image': result_image,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'processing_time': processing_time,
+        'quality_mode': quality_mode
+    }
+    st.session_state.processing_history.append(history_item)
+    save_history_state(st.session_state.user_id, history_item)
+
+def display_result(seed_image, result_image, quality_mode, processing_time, key_suffix=""):
+    """변환 결과 비교 표시 및 다운로드 버튼"""
+    st.divider()
+    st.markdown("### 🎉 최종 결과")
+    
+    # 원본 vs 결과 비교
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        if seed_image is not None:
+            st.image(seed_image, caption="원본", width=300)
+    with col2:
+        st.image(result_image, caption="변경 결과", width=300)
+    
+    # 고품질 다운로드 버튼
+    st.divider()
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        # 파일명 생성
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        quality_suffix = "HQ" if quality_mode == "high" else "STD"
+        filename = f"hair_result_{quality_suffix}_{timestamp}.png"
+        
+        # 고품질 PNG 다운로드
+        download_data = create_download_link(result_image, filename)
+        
+        st.download_button(
+            label="💾 고품질 PNG 다운로드",
+            data=download_data,
+            file_name=filename,
+            mime="image/png",
+            use_container_width=True,
+            help="최고 품질의 PNG 파일로 다운로드됩니다",
+            key=f"result_download{key_suffix}"
+        )
+    
+    # 결과 정보
+    quality_desc = "고품질" if quality_mode == "high" else "표준"
+    st.info(f"""
+    **처리 정보**
+    - 품질 모드: {quality_desc}
+    - 처리 시간: {processing_time:.1f}초
+    - 최종 해상도: {result_image.size}
+    - 파일 형식: 고품질 PNG
+    - 압축: 최적화됨
+    """)
+
+def run_transform_job(seed_data, head_box, quality_mode, deadline, existing_task=None, ref_image=None, ref_url=None, task_meta=None, profile=False):
+    """백그라운드 작업 본문 - 같은 입력의 Task가 있으면 이어받고, 없으면 새로 처리한 뒤 원본 해상도 시드에 합성"""
+    profiler = start_profiler("job", sys._getframe(), label=quality_mode) if profile else None
+    try:
+        if existing_task:
+            notify("info", "같은 이미지로 진행 중인 작업이 있어 새로 요청하지 않고 이어서 받아옵니다.")
+            result_image = resume_vmodel_task(existing_task)
+        else:
+            # AI 처리 (품질 모드 적용) - 시드 크롭과 미리 업로드한 URL 대기도 작업 스레드에서
+            result_image = process_with_vmodel_api(
+                get_seed_upload_image(seed_data, head_box, quality_mode),  # 머리 영역 크롭 또는 처리된 시드 이미지
+                ref_image,  # 처리된 참조 이미지
+                quality_mode=quality_mode,
+                seed_url=get_ready_seed_url(seed_data, head_box, quality_mode, timeout=max(0, deadline.remaining())),
+                ref_url=ref_url,
+                task_meta=task_meta,
+                deadline=deadline
+            )
+        
+        if result_image:
+            # 머리 영역 결과를 원본 해상도 시드에 합성
+            result_image = restore_full_resolution(seed_data, result_image, head_box)
+        return result_image
+    finally:
+        if profiler:
+            profiler.stop()
+
+def run_resume_job(record, seed_data=None, head_box=None):
+    """백그라운드 작업 본문 - 새로고침/재접속 전에 시작된 Task에 다시 연결해서 결과를 받아옴"""
+    notify("info", f"🔁 이전에 시작한 변환 작업을 이어서 받아옵니다 (Task {record['task_id']})")
+    result_image = resume_vmodel_task(record)
+    if result_image and seed_data and head_box:
+        result_image = restore_full_resolution(seed_data, result_image, head_box)
+    return result_image
+
+def resume_pending_tasks():
+    """새로고침/재접속 전에 시작된 작업에 다시 연결 - 아직 실행 중인 작업은 진행 영역만 연결하고, 없으면 Task를 이어받는 작업 시작"""
+    runner = get_job_runner()
+    running = runner.find_running(st.session_state.user_id)
+    if running:
+        st.session_state.active_jobs = [job.job_id for job in running]
+        return
+    
+    active_jobs = []
+    for record in get_task_store().find_resumable(st.session_state.user_id):
+        # 같은 시드가 세션에 남아 있으면 원본 해상도로 합성
+        head_box = tuple(record['head_box']) if record.get('head_box') else None
+        seed_data = next(
+            (data for data in st.session_state.seed_images.values() if data.get('image_hash') == record.get('seed_hash')),
+            None
+        )
+        job = runner.start(
+            st.session_state.user_id,
+            partial(run_resume_job, record, seed_data, head_box),
+            meta={
+                "kind": "resume",
+                "task_id": record['task_id'],
+                "created_at": record['created_at'],
+                "seed_filename": record.get('seed_filename', '알 수 없음'),
+                "ref_filename": record.get('ref_filename', '알 수 없음'),
+                "quality_mode": record.get('quality_mode', 'high')
+            }
+        )
+        active_jobs.append(job.job_id)
+    if active_jobs:
+        st.session_state.active_jobs = active_jobs
+
+def collect_finished_jobs():
+    """끝난 백그라운드 작업의 결과를 처리 기록에 추가하고, 다음 전체 실행에서 표시할 결과로 옮김"""
+    runner = get_job_runner()
+    running = []
+    for job_id in st.session_state.pop('active_jobs', []):
+        job = runner.get(job_id)
+        if job is None:
+            continue
+        snapshot = job.snapshot()
+        if snapshot["state"] != "done":
+            running.append(job_id)
+            continue
+        
+        runner.discard(job_id)
+        st.session_state.setdefault('performance_history', []).extend(snapshot["performance_records"])
+        meta = job.meta
+        started_at = meta.get('created_at', snapshot["started_at"])
+        outcome = {"meta": meta, "notices": snapshot["notices"], "result": snapshot["result"], "processing_time": snapshot["finished_at"] - started_at}
+        if outcome["result"]:
+            add_history_item(meta['seed_filename'], meta['ref_filename'], outcome["result"], outcome["processing_time"], meta['quality_mode'])
+        st.session_state.setdefault('job_outcomes', []).append(outcome)
+    if running:
+        st.session_state.active_jobs = running
+
+def show_job_outcomes():
+    """끝난 작업의 안내 메시지와 결과를 한 번 표시"""
+    for outcome in st.session_state.pop('job_outcomes', []):
+        for kind, message, options in outcome["notices"]:
+            getattr(st, kind)(message, **options)
+        
+        meta = outcome["meta"]
+        result_image = outcome["result"]
+        processing_time = outcome["processing_time"]
+        if meta['kind'] == "resume":
+            if result_image:
+                st.success(f"✨ 이전 작업 완료! (시작 후 {processing_time:.1f}초)")
+                display_result(None, result_image, meta['quality_mode'], processing_time, key_suffix=f"_{meta['task_id']}")
+        elif result_image:
+            st.success(f"✨ 헤어 변경 완료! (소요시간: {processing_time:.1f}초)")
+            display_result(meta['seed_image'], result_image, meta['quality_mode'], processing_time)
+        else:
+            st.error("헤어 변경에 실패했습니다. 다시 시도해주세요.")
+
+@st.fragment(run_every=JOB_PROGRESS_INTERVAL)
+def render_job_progress():
+    """진행 중인 작업의 진행률/상태/취소 버튼 - 이 영역만 주기적으로 다시 실행되고 나머지 화면은 다시 실행되지 않음
+
+    작업이 끝나면 결과를 세션에 반영하고 전체 화면을 한 번 다시 실행 (결과와 처리 기록 표시)
+    """
+    runner = get_job_runner()
+    finished = False
+    for job_id in st.session_state.get('active_jobs', []):
+        job = runner.get(job_id)
+        snapshot = job.snapshot() if job else None
+        if snapshot is None or snapshot["state"] == "done":
+            finished = True
+            continue
+        
+        job.mark_viewed()
+        for kind, message, options in snapshot["notices"]:
+            getattr(st, kind)(message, **options)
+        st.progress(snapshot["progress"])
+        st.text(snapshot["status_text"] or "⏳ AI가 헤어스타일을 변경하고 있습니다...")
+        if snapshot["task_id"]:
+            st.button("⏹️ 작업 취소", key=f"cancel_task_{snapshot['task_id']}", on_click=cancel_task_by_user, args=(snapshot["task_id"],))
+    
+    if finished:
+        collect_finished_jobs()
+        st.rerun()
 
 def create_download_link(image, filename):
     """이미지 다운로드 링크 생성 - 고품질 설정"""
-    img_buffer = io.BytesIO()
     # 최고 품질로 PNG 저장
-    image.save(img_buffer, format='PNG', optimize=True, compress_level=1)
-    img_buffer.seek(0)
-    return img_buffer.getvalue()
+    return encode_image(image, 'PNG', optimize=True, compress_level=1)
+
+# 화면 표시용 미리보기 - st.image에 PIL 이미지를 넘기면 재실행마다 다시 인코딩되므로 바이트로 만들어 보관
+PREVIEW_CACHE_SIZE = 4   # 항목별로 보관하는 미리보기 수 (폭/머리 영역 조합)
+
+def encode_preview_image(image, width):
+    """표시 폭에 맞춘 JPEG 미리보기 바이트 (고해상도 화면을 위해 2배 크기)"""
+    preview = image.convert("RGB")
+    preview.thumbnail((width * 2, width * 2), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    preview.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def get_cached_preview(holder, width, render, variant=None):
+    """holder(시드/기록 dict 등)에 보관한 미리보기 바이트 - 없을 때만 render()로 이미지를 만들어 인코딩"""
+    previews = holder.setdefault('previews', {})
+    key = (width, variant)
+    if key not in previews:
+        if len(previews) >= PREVIEW_CACHE_SIZE:
+            previews.clear()
+        previews[key] = encode_preview_image(render(), width)
+    return previews[key]
+
+def get_history_download_data(item):
+    """처리 기록 다운로드용 PNG - 처음 필요할 때 한 번만 인코딩해서 기록에 보관"""
+    if 'download_data' not in item:
+        item['download_data'] = create_download_link(item['result_image'], None)
+    return item['download_data']
+
+def get_uploaded_seed(seed_file):
+    """업로드한 시드 파일의 검증/리사이즈 결과 - 같은 파일이면 재실행마다 다시 디코딩하지 않음"""
+    cached = st.session_state.get('uploaded_seed')
+    if cached and cached['file_id'] == seed_file.file_id:
+        return cached
+    
+    seed_image = Image.open(seed_file)
+    seed_image.load()
+    is_valid, message, processed_image = validate_image(seed_image)
+    st.session_state.uploaded_seed = {
+        'file_id': seed_file.file_id,
+        'image': seed_image,
+        'valid': is_valid,
+        'message': message,
+        'processed_image': processed_image
+    }
+    return st.session_state.uploaded_seed
+
+# 시드 미리 업로드 결과 반영 및 만료 임박 URL 갱신
+refresh_seed_uploads()
+rerun_timer.mark("seed_refresh")
 
 # 메인 UI
 st.markdown("""
@@ -803,8 +4476,8 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
 
-# API 키 체크
-if not VMODEL_API_KEY:
+# API 키 체크 (VModel 백엔드를 쓸 때만)
+if not VMODEL_API_KEY and "vmodel" in get_image_backend_names():
     st.error("""
     ⚠️ **VModel API 키가 필요합니다!**
     
@@ -868,6 +4541,8 @@ if metrics:
         </div>
         """, unsafe_allow_html=True)
 
+rerun_timer.mark("metrics")
+
 # 사이드바
 with st.sidebar:
     st.header("🎛️ 설정")
@@ -875,11 +4550,15 @@ with st.sidebar:
     
     # API 상태 표시
     st.markdown("### 🔑 API 상태")
-    vmodel_status = "✅ 연결됨" if VMODEL_API_KEY else "❌ 미설정"
+    vmodel_status = f"✅ 연결됨 (키 {len(get_api_key_pool().keys)}개)" if VMODEL_API_KEY else "❌ 미설정"
     st.write(f"VModel: {vmodel_status}")
     
     if st.button("🔄 새 세션 시작"):
+        # 이전 세션에서 진행 중이던 유료 Task는 바로 취소
+        cancel_pending_tasks(st.session_state.user_id, reason="new_session")
+        clear_user_state(st.session_state.user_id)
         st.session_state.clear()
+        del st.query_params["uid"]
         st.rerun()
     
     st.divider()
@@ -913,7 +4592,9 @@ with st.sidebar:
     - 독립 검증 가능 (?api=metrics)
     """)
 
-# 메인 탭
+rerun_timer.mark("sidebar")
+
+# 메인 탭 (탭 본문은 선택 여부와 관계없이 모두 실행되므로 이미지 인코딩 결과를 재사용)
 tab1, tab2, tab3 = st.tabs(["🎨 헤어 변경", "📸 시드 관리", "📝 처리 기록"])
 
 with tab2:
@@ -929,39 +4610,47 @@ with tab2:
         )
         
         if seed_file:
-            seed_image = Image.open(seed_file)
+            # 자동 리사이즈 포함 검증 (파일이 바뀔 때만)
+            uploaded_seed = get_uploaded_seed(seed_file)
+            preview = get_cached_preview(uploaded_seed, 300, lambda: uploaded_seed['processed_image'])
             
-            # 자동 리사이즈 포함 검증
-            is_valid, message, processed_image = validate_image(seed_image)
-            
-            if is_valid:
-                st.image(processed_image, caption="미리보기 (처리된 이미지)", width=300)
-                st.success(message)
+            if uploaded_seed['valid']:
+                st.image(preview, caption="미리보기 (처리된 이미지)", width=300)
+                st.success(uploaded_seed['message'])
                 
                 # 이미지 정보 표시
                 st.caption(f"원본 파일명: {seed_file.name}")
-                st.caption(f"처리된 크기: {processed_image.size}")
+                st.caption(f"처리된 크기: {uploaded_seed['processed_image'].size}")
             else:
-                st.image(seed_image, caption="미리보기", width=300)
-                st.error(message)
-                processed_image = seed_image
+                st.image(preview, caption="미리보기", width=300)
+                st.error(uploaded_seed['message'])
     
     with col2:
         if seed_file and st.button("💾 시드 저장", type="primary"):
-            seed_image = Image.open(seed_file)
-            is_valid, message, processed_image = validate_image(seed_image)
+            uploaded_seed = get_uploaded_seed(seed_file)
+            seed_image, processed_image = uploaded_seed['image'], uploaded_seed['processed_image']
+            is_valid, message = uploaded_seed['valid'], uploaded_seed['message']
             
             if is_valid:
-                # 처리된 이미지로 저장
+                # 처리된 이미지로 저장 (머리 영역 크롭/합성용 원본 해상도 이미지도 함께 보관)
+                original_image, _ = resize_image_if_needed(seed_image, max_size=SEED_ORIGINAL_MAX_SIZE)
                 seed_id = str(uuid.uuid4())[:8]
                 st.session_state.seed_images[seed_id] = {
                     'image': processed_image,  # 처리된 이미지 저장
+                    'original_image': original_image.copy(),
+                    'image_hash': compute_image_hash(processed_image),
+                    'head_box': detect_head_box(processed_image),
                     'filename': seed_file.name,
                     'original_size': seed_image.size,
                     'processed_size': processed_image.size,
                     'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 }
                 
+                # 변환 전에 미리 업로드 시작 (저장 직후 백그라운드 진행, 기본 머리 영역 크롭)
+                seed_data = st.session_state.seed_images[seed_id]
+                save_seed_state(st.session_state.user_id, seed_id, seed_data)
+                start_seed_upload(seed_data, seed_data['head_box'], st.session_state.get('quality_mode', 'high'))
+                
                 st.markdown(f"""
                 <div class="success-box">
                     ✅ 시드 저장 완료!<br>
@@ -984,19 +4673,33 @@ with tab2:
                 col1, col2 = st.columns([1, 1])
                 
                 with col1:
-                    st.image(seed_data['image'], width=200)
+                    st.image(get_cached_preview(seed_data, 200, lambda: seed_data['image']), width=200)
                 
                 with col2:
                     st.write(f"**ID**: {seed_id}")
                     st.write(f"**크기**: {seed_data['image'].size}")
+                    if seed_data.get('hosted_url'):
+                        st.caption(f"☁️ 미리 업로드됨 ({seed_data['url_host']})")
+                    elif seed_data.get('upload_future') is not None:
+                        st.caption("⏳ 미리 업로드 중...")
                     
                     if st.button(f"🗑️ 삭제", key=f"delete_{seed_id}"):
                         del st.session_state.seed_images[seed_id]
+                        delete_seed_state(st.session_state.user_id, seed_id)
                         st.rerun()
 
+rerun_timer.mark("tab_seed")
+
 with tab1:
     st.header("🎨 헤어스타일 변경")
     
+    if st.session_state.pop('canceled_task_id', None):
+        st.info("⏹️ 진행 중이던 변환 작업을 취소했습니다.")
+    
+    # 새로고침/재접속 전에 진행 중이던 작업 이어받기 (새 작업을 시작한 경우 제외 - 이전 작업은 취소됨)
+    if not st.session_state.get('start_job') and not st.session_state.get('active_jobs'):
+        resume_pending_tasks()
+    
     if not st.session_state.seed_images:
         st.warning("먼저 시드 이미지를 업로드해주세요!")
         st.info("👈 **시드 관리** 탭에서 시드 이미지를 추가하세요")
@@ -1015,7 +4718,35 @@ with tab1:
             selected_seed_id = seed_options[selected_seed_name]
             selected_seed_data = st.session_state.seed_images[selected_seed_id]
             
-            st.image(selected_seed_data['image'], caption="선택된 시드", width=250)
+            # 머리 영역만 모델에 보내고 결과는 원본 해상도에 합성
+            use_head_crop = st.checkbox(
+                "✂️ 머리 영역만 처리 (원본 해상도 유지)",
+                value=True,
+                help="머리 주변만 잘라 업로드하고 결과를 원본 사진에 합성합니다. 업로드가 작아지고 결과는 원본 해상도로 나옵니다."
+            )
+            head_box = None
+            if use_head_crop:
+                detected_box = selected_seed_data.get('head_box') or DEFAULT_HEAD_BOX
+                with st.expander("머리 영역 조정"):
+                    x_range = st.slider("가로 범위 (%)", 0, 100, (detected_box[0], detected_box[2]), key=f"head_x_{selected_seed_id}")
+                    y_range = st.slider("세로 범위 (%)", 0, 100, (detected_box[1], detected_box[3]), key=f"head_y_{selected_seed_id}")
+                if x_range[1] - x_range[0] >= 10 and y_range[1] - y_range[0] >= 10:
+                    head_box = (x_range[0], y_range[0], x_range[1], y_range[1])
+                else:
+                    st.warning("머리 영역이 너무 작아 전체 이미지로 처리합니다.")
+            
+            # 선택한 영역/품질 조합으로 미리 업로드 (변경시 다시 시작)
+            ensure_seed_upload(selected_seed_data, head_box, st.session_state.get('quality_mode', 'high'))
+            
+            if head_box:
+                preview = get_cached_preview(
+                    selected_seed_data, 250,
+                    lambda: draw_head_box_preview(selected_seed_data['image'], head_box),
+                    variant=head_box
+                )
+                st.image(preview, caption="선택된 시드 (보라색: 처리 영역)", width=250)
+            else:
+                st.image(get_cached_preview(selected_seed_data, 250, lambda: selected_seed_data['image']), caption="선택된 시드", width=250)
         
         with col2:
             st.subheader("2️⃣ 헤어 참조 이미지")
@@ -1027,8 +4758,14 @@ with tab1:
             )
             
             if ref_file:
-                ref_image = Image.open(ref_file)
-                st.image(ref_image, caption="참조 이미지", width=250)
+                reference_previews = st.session_state.setdefault('reference_previews', {})
+                preview = get_cached_preview(reference_previews, 250, lambda: Image.open(ref_file), variant=ref_file.file_id)
+                st.image(preview, caption="참조 이미지", width=250)
+                
+                # 품질 선택 중에 미리 전처리/업로드 진행
+                start_reference_prefetch(ref_file, st.session_state.get('quality_mode', 'high'))
+            else:
+                cancel_reference_prefetch()
         
         # 품질 설정
         if ref_file:
@@ -1042,7 +4779,8 @@ with tab1:
                     "high": "🎨 고품질 (권장) - 선명한 디테일, 30-45초",
                     "standard": "⚡ 표준 - 빠른 처리, 15-25초"
                 }[x],
-                index=0  # 기본값: 고품질
+                index=0,  # 기본값: 고품질
+                key="quality_mode"
             )
         
         # 처리 실행
@@ -1051,91 +4789,84 @@ with tab1:
             
             col1, col2, col3 = st.columns([1, 2, 1])
             with col2:
-                if st.button("🚀 AI 헤어 변경 시작", type="primary", use_container_width=True):
-                    
-                    ref_image = Image.open(ref_file)
+                start_clicked = st.button("🚀 AI 헤어 변경 시작", type="primary", use_container_width=True, key="start_job")
+                
+                # 예상 완료 시간으로 입장 결정 - 버튼을 누른 순간부터 모든 단계가 하나의 시간 예산을 공유
+                deadline = admit_job(quality_mode, start_clicked)
+                if deadline:
+                    # 파일 선택 시점에 시작한 전처리/업로드 결과가 있으면 그대로 사용
+                    with deadline.stage("upload"):
+                        prefetched_ref = get_prefetched_reference(ref_file, quality_mode, timeout=deadline.remaining())
+                    if prefetched_ref:
+                        is_valid, message = prefetched_ref['valid'], prefetched_ref['message']
+                        processed_ref_image = prefetched_ref['image']
+                        original_ref_size = prefetched_ref['original_size']
+                        ref_url = prefetched_ref['hosted']['url'] if prefetched_ref['hosted'] else None
+                    else:
+                        ref_image = Image.open(ref_file)
+                        original_ref_size = ref_image.size
+                        ref_url = None
+                        
+                        # 참조 이미지도 자동 리사이즈 (품질 모드 해상도)
+                        is_valid, message, processed_ref_image = validate_image(ref_image)
+                        if is_valid:
+                            processed_ref_image = prepare_image_for_tier(processed_ref_image, quality_mode)
                     
-                    # 참조 이미지도 자동 리사이즈
-                    is_valid, message, processed_ref_image = validate_image(ref_image)
                     if not is_valid:
                         st.error(f"참조 이미지 오류: {message}")
                         st.stop()
                     
-                    if processed_ref_image.size != ref_image.size:
-                        st.info(f"참조 이미지 크기 조정: {ref_image.size} → {processed_ref_image.size}")
+                    if processed_ref_image.size != original_ref_size:
+                        st.info(f"참조 이미지 크기 조정: {original_ref_size} → {processed_ref_image.size}")
                     
-                    with st.spinner("AI가 헤어스타일을 변경하고 있습니다..."):
-                        start_time = time.time()
-                        
-                        # AI 처리 (품질 모드 적용)
-                        result_image = process_with_vmodel_api(
-                            selected_seed_data['image'],  # 이미 처리된 시드 이미지
-                            processed_ref_image,  # 처리된 참조 이미지
-                            quality_mode=quality_mode
-                        )
-                        
-                        processing_time = time.time() - start_time
-                        
-                        if result_image:
-                            st.success(f"✨ 헤어 변경 완료! (소요시간: {processing_time:.1f}초)")
-                            
-                            # 처리 기록 저장
-                            history_item = {
-                                'id': str(uuid.uuid4())[:8],
-                                'seed_filename': selected_seed_data['filename'],
-                                'ref_filename': ref_file.name,
-                                'result_image': result_image,
-                                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                'processing_time': processing_time,
-                                'quality_mode': quality_mode
-                            }
-                            st.session_state.processing_history.append(history_item)
-                            
-                            # 결과 표시
-                            st.divider()
-                            st.markdown("### 🎉 최종 결과")
-                            
-                            # 원본 vs 결과 비교
-                            col1, col2 = st.columns([1, 1])
-                            with col1:
-                                st.image(selected_seed_data['image'], caption="원본", width=300)
-                            with col2:
-                                st.image(result_image, caption="변경 결과", width=300)
-                            
-                            # 고품질 다운로드 버튼
-                            st.divider()
-                            col1, col2, col3 = st.columns([1, 2, 1])
-                            with col2:
-                                # 파일명 생성
-                                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                                quality_suffix = "HQ" if quality_mode == "high" else "STD"
-                                filename = f"hair_result_{quality_suffix}_{timestamp}.png"
-                                
-                                # 고품질 PNG 다운로드
-                                download_data = create_download_link(result_image, filename)
-                                
-                                st.download_button(
-                                    label="💾 고품질 PNG 다운로드",
-                                    data=download_data,
-                                    file_name=filename,
-                                    mime="image/png",
-                                    use_container_width=True,
-                                    help="최고 품질의 PNG 파일로 다운로드됩니다"
-                                )
-                            
-                            # 결과 정보
-                            quality_desc = "고품질" if quality_mode == "high" else "표준"
-                            st.info(f"""
-                            **처리 정보**
-                            - 품질 모드: {quality_desc}
-                            - 처리 시간: {processing_time:.1f}초
-                            - 최종 해상도: {result_image.size}
-                            - 파일 형식: 고품질 PNG
-                            - 압축: 최적화됨
-                            """)
-                            
-                        else:
-                            st.error("헤어 변경에 실패했습니다. 다시 시도해주세요.")
+                    seed_hash = selected_seed_data.get('image_hash') or compute_image_hash(selected_seed_data['image'])
+                    ref_hash = (prefetched_ref or {}).get('image_hash') or compute_image_hash(processed_ref_image)
+                    input_hash = compute_job_hash(f"{seed_hash}:{head_box}", ref_hash, quality_mode)
+                    
+                    # 다른 입력으로 진행 중이던 이전 작업은 새 작업으로 대체되므로 취소
+                    cancel_pending_tasks(st.session_state.user_id, keep_input_hash=input_hash)
+                    
+                    # 같은 입력으로 이미 만든 Task가 있으면 새로 만들지 않고 이어받음
+                    existing_tasks = get_task_store().find_resumable(st.session_state.user_id, input_hash=input_hash)
+                    
+                    # 변환은 백그라운드 작업으로 실행 - 진행 상황은 진행 영역에만 표시되고 나머지 화면은 계속 조작 가능
+                    # (다른 입력의 이전 작업은 위에서 취소되었으므로 진행 영역에는 새 작업만 표시)
+                    job = get_job_runner().start(
+                        st.session_state.user_id,
+                        partial(
+                            run_transform_job,
+                            selected_seed_data, head_box, quality_mode, deadline,
+                            existing_task=existing_tasks[0] if existing_tasks else None,
+                            ref_image=processed_ref_image,
+                            ref_url=ref_url,
+                            task_meta={
+                                "user_id": st.session_state.user_id,
+                                "session_id": st.session_state.session_id,
+                                "input_hash": input_hash,
+                                "seed_hash": seed_hash,
+                                "ref_hash": ref_hash,
+                                "head_box": head_box,
+                                "seed_filename": selected_seed_data['filename'],
+                                "ref_filename": ref_file.name
+                            },
+                            profile=profile_mode == "job"
+                        ),
+                        meta={
+                            "kind": "transform",
+                            "seed_filename": selected_seed_data['filename'],
+                            "ref_filename": ref_file.name,
+                            "quality_mode": quality_mode,
+                            "seed_image": selected_seed_data.get('original_image', selected_seed_data['image'])
+                        }
+                    )
+                    st.session_state.active_jobs = [job.job_id]
+    
+    # 진행 중인 백그라운드 작업과 끝난 작업 결과 표시 (진행 영역만 주기적으로 다시 실행)
+    show_job_outcomes()
+    if st.session_state.get('active_jobs'):
+        render_job_progress()
+
+rerun_timer.mark("tab_transform")
 
 with tab3:
     st.header("📝 처리 기록")
@@ -1167,13 +4898,13 @@ with tab3:
                     st.write(f"**처리 시간**: {item['processing_time']:.1f}초")
                 
                 with col2:
-                    st.image(item['result_image'], caption="처리 결과", width=300)
+                    st.image(get_cached_preview(item, 300, lambda: item['result_image']), caption="처리 결과", width=300)
                     
                     # 고품질 다운로드
                     timestamp = item['created_at'].replace('-', '').replace(':', '').replace(' ', '_')
                     quality_suffix = "HQ" if item.get('quality_mode') == 'high' else "STD"
                     filename = f"result_{item['id']}_{quality_suffix}_{timestamp}.png"
-                    download_data = create_download_link(item['result_image'], filename)
+                    download_data = get_history_download_data(item)
                     
                     st.download_button(
                         "💾 고품질 다운로드",
@@ -1184,14 +4915,24 @@ with tab3:
                         help="최고 품질 PNG 다운로드"
                     )
 
+rerun_timer.mark("tab_history")
+
 # 푸터
 st.divider()
-st.markdown("""
+retention_note = "" if get_state_store().shared else " (이 서버가 재시작되어도 삭제)"
+st.markdown(f"""
 <div style="text-align: center; color: #666; padding: 1rem;">
     💇‍♀️ AI Hair Style Transfer | Made with ❤️ using Streamlit Cloud<br>
     <small>🎨 고품질 모드로 선명한 헤어 디테일을 경험해보세요!</small><br>
     <small>🔍 <strong>독립 검증 API</strong>: ?api=logs | ?api=performance | ?api=metrics</small><br>
     <small>📊 개선된 성능 측정: 실제 변환만 집계, 중복 제거, 정확한 완료 판정</small><br>
-    <small>세션 종료시 데이터가 삭제됩니다. 중요한 결과는 다운로드하세요!</small>
+    <small>시드와 처리 기록은 저장 후 {STATE_TTL // 3600}시간이 지나거나 새 세션을 시작하면 삭제됩니다{retention_note}. 중요한 결과는 다운로드하세요!</small>
 </div>
 """, unsafe_allow_html=True)
+
+# 이 세션의 메모리 추정치 보고 (?api=memory 집계용)
+report_session_memory()
+
+rerun_timer.finish()
+if script_profiler:
+    script_profiler.stop()
@@ -0,0 +1,76 @@
+"""
+이미지 처리 작업자 프로세스용 함수
+
+Streamlit이 실행하는 app.py는 작업자 프로세스에서 import할 수 없으므로, 프로세스 풀에서
+실행할 CPU 작업(LANCZOS 리사이즈, PNG/JPEG 인코딩)은 이 모듈에 둡니다.
+이미지는 PIL 객체를 pickle하지 않고 원시 픽셀 버퍼로 주고받으며, 큰 입력 버퍼는
+공유 메모리로 전달합니다 (공유 메모리 생성/삭제는 요청한 쪽에서 담당).
+색 프로파일 같은 이미지 부가 정보(image.info)도 함께 넘겨, 현재 스레드에서 처리할 때와 결과가 같도록 합니다.
+"""
+
+import io
+import time
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+# 원시 버퍼만으로 그대로 복원되는 모드 (팔레트 등 부가 정보가 필요한 모드는 풀로 보내지 않음)
+RAW_MODES = ("RGB", "RGBA", "L")
+
+# 원시 버퍼와 함께 넘기는 image.info 항목 (PNG/JPEG 저장시 그대로 기록됨)
+INFO_KEYS = ("icc_profile", "dpi", "exif", "transparency", "gamma", "srgb")
+
+def resize(image, size):
+    """LANCZOS 리사이즈"""
+    return image.resize(tuple(size), Image.Resampling.LANCZOS)
+
+def encode(image, format, convert_rgb=False, **save_options):
+    """이미지를 파일 형식 바이트로 인코딩"""
+    if convert_rgb:
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **save_options)
+    return buffer.getvalue()
+
+OPERATIONS = {
+    "resize": resize,
+    "encode": encode
+}
+
+def apply(operation, image, options):
+    """작업 실행 (PIL 이미지 → PIL 이미지 또는 바이트)"""
+    return OPERATIONS[operation](image, **options)
+
+def pack_info(image):
+    return {key: image.info[key] for key in INFO_KEYS if key in image.info}
+
+def restore_info(image, info):
+    image.info.update(info or {})
+    return image
+
+def pack_image(image):
+    """PIL 이미지를 원시 버퍼 dict로 (프로세스 간 전달용)"""
+    return {"mode": image.mode, "size": image.size, "data": image.tobytes(), "info": pack_info(image)}
+
+def unpack_image(packed):
+    image = Image.frombytes(packed["mode"], tuple(packed["size"]), packed["data"])
+    return restore_info(image, packed.get("info"))
+
+def load_input(spec):
+    """입력 spec(원시 버퍼 또는 공유 메모리 이름)에서 이미지 복원"""
+    if "shm" not in spec:
+        return unpack_image(spec)
+    shm = shared_memory.SharedMemory(name=spec["shm"])
+    try:
+        image = Image.frombytes(spec["mode"], tuple(spec["size"]), bytes(shm.buf[:spec["length"]]))
+        return restore_info(image, spec.get("info"))
+    finally:
+        shm.close()
+
+def run(operation, spec, options):
+    """작업자 프로세스 진입점 - 결과와 시작 시각/처리 시간 반환 (이미지 결과는 원시 버퍼로)"""
+    started_at = time.time()
+    result = apply(operation, load_input(spec), options)
+    if isinstance(result, Image.Image):
+        result = pack_image(result)
+    return {"result": result, "started_at": started_at, "elapsed": time.time() - started_at}
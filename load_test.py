@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+"""
+동시 사용자 부하 테스트 도구
+Streamlit AppTest로 여러 가상 세션을 동시에 실행하여
+시드 업로드 → 시드 저장 → 참조 업로드 → 변환 시작 흐름을 재현합니다.
+외부 서비스(이미지 호스팅, VModel API)는 모두 가짜 백엔드로 대체됩니다.
+
+사용법:
+    python load_test.py --levels 1,2,4,8 --polls 2 --json load_report.json
+    python load_test.py --checks      # 부하 측정 대신 기능 점검 시나리오 실행
+
+필요 사항: file_uploader 조작을 지원하는 Streamlit AppTest (streamlit>=1.4x)
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from unittest import mock
+
+from PIL import Image
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# 한 세션이 거치는 단계 (순서대로 실행)
+# start: 버튼 클릭 후 화면이 돌아올 때까지 (변환은 백그라운드 작업), wait_result: 진행 영역이 결과를 가져올 때까지
+STEPS = ["initial_load", "upload_seed", "save_seed", "upload_ref", "start", "wait_result", "idle_rerun"]
+RESULT_POLL_INTERVAL = 0.2   # 결과 대기 중 재실행 간격 (초) - 브라우저의 진행 영역 새로고침 대신
+
+SEED_UPLOAD_LABEL = "시드 이미지 업로드 (본인 얼굴)"
+REF_UPLOAD_LABEL = "원하는 헤어스타일 이미지"
+SAVE_BUTTON_LABEL = "💾 시드 저장"
+START_BUTTON_LABEL = "🚀 AI 헤어 변경 시작"
+
+
+def make_png_bytes(size=(512, 640), color=(180, 140, 120)):
+    """테스트용 PNG 이미지 바이트 생성"""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class MockResponse:
+    """requests.Response 대용 최소 구현"""
+
+    def __init__(self, status_code=200, payload=None, content=b""):
+        self.status_code = status_code
+        self._payload = payload
+        self.content = content
+        self.headers = {}
+
+    def json(self):
+        if self._payload is None:
+            raise ValueError("No JSON payload")
+        return self._payload
+
+
+class MockBackends:
+    """이미지 호스팅과 VModel API를 흉내내는 가짜 백엔드
+
+    latency: 모든 호출에 더해지는 지연 (초)
+    polls: succeeded 상태가 되기까지 필요한 상태 조회 횟수
+    status_failures: 상태 조회에 차례로 돌려줄 오류 HTTP 상태코드 (기능 점검용, 본문 없음)
+    """
+
+    def __init__(self, latency=0.05, polls=2):
+        self.latency = latency
+        self.polls = polls
+        self.result_png = make_png_bytes(color=(90, 60, 40))
+        self.lock = threading.Lock()
+        self.poll_counts = {}
+        self.call_counts = {}
+        self.status_failures = []
+
+    def _count(self, name):
+        with self.lock:
+            self.call_counts[name] = self.call_counts.get(name, 0) + 1
+
+    def post(self, url, *args, **kwargs):
+        time.sleep(self.latency)
+        if "imgur.com" in url:
+            self._count("imgur_upload")
+            return MockResponse(200, {"success": True, "data": {"link": f"https://i.imgur.mock/{uuid.uuid4().hex[:8]}.png"}})
+        if "tmpfiles.org" in url:
+            self._count("tmpfiles_upload")
+            return MockResponse(200, {"data": {"url": f"https://tmpfiles.org/{uuid.uuid4().hex[:8]}/image.png"}})
+        if "/tasks/v1/create" in url:
+            self._count("vmodel_create")
+            task_id = f"mock_{uuid.uuid4().hex[:12]}"
+            with self.lock:
+                self.poll_counts[task_id] = 0
+            return MockResponse(200, {"code": 200, "result": {"task_id": task_id}})
+        if "/tasks/v1/cancel/" in url:
+            self._count("vmodel_cancel")
+            return MockResponse(200, {"code": 200, "result": {}})
+        self._count("unknown_post")
+        return MockResponse(404, {"error": "unknown endpoint"})
+
+    def get(self, url, *args, **kwargs):
+        time.sleep(self.latency)
+        if "/tasks/v1/get/" in url:
+            self._count("vmodel_status")
+            with self.lock:
+                failure = self.status_failures.pop(0) if self.status_failures else None
+            if failure:
+                return MockResponse(failure)
+            task_id = url.rsplit("/", 1)[-1]
+            with self.lock:
+                self.poll_counts[task_id] = self.poll_counts.get(task_id, 0) + 1
+                count = self.poll_counts[task_id]
+            if count < self.polls:
+                return MockResponse(200, {"code": 200, "result": {"task_id": task_id, "status": "processing"}})
+            return MockResponse(200, {
+                "code": 200,
+                "result": {
+                    "task_id": task_id,
+                    "status": "succeeded",
+                    "output": [f"https://cdn.vmodel.mock/{task_id}.png"],
+                    "total_time": count,
+                },
+            })
+        if "cdn.vmodel.mock" in url:
+            self._count("result_download")
+            return MockResponse(200, content=self.result_png)
+        self._count("unknown_get")
+        return MockResponse(404, {"error": "unknown endpoint"})
+
+
+def get_rss_bytes():
+    """현재 프로세스 RSS (바이트)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # /proc이 없는 환경에서는 최대 RSS로 대체 (Linux: KB 단위)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, pct):
+    """단순 최근접 순위 백분위수"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def find_by_label(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"위젯을 찾을 수 없습니다: {label}")
+
+
+@contextmanager
+def shared_apptest_runtime(secrets):
+    """AppTest를 여러 스레드에서 동시에 실행하기 위한 공용 런타임
+
+    AppTest는 실행마다 전역 Runtime 싱글톤과 st.secrets를 교체했다가 비우므로
+    세션이 겹치면 서로의 런타임을 지워버립니다. 부하 테스트 동안에는
+    하나의 가짜 런타임과 secrets를 고정해 둡니다.
+    """
+    import streamlit as st
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1.util import patch_config_options
+
+    runtime = mock.MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+
+    def instance(cls):
+        return cls._instance or runtime
+
+    # 세션마다 스크립트를 새로 컴파일하는데, 여러 스레드의 동시 ast.parse는
+    # CPython 3.11/3.12에서 SystemError를 낼 수 있어 컴파일만 직렬화
+    compile_lock = threading.Lock()
+    original_get_bytecode = ScriptCache.get_bytecode
+
+    def get_bytecode(self, script_path):
+        with compile_lock:
+            return original_get_bytecode(self, script_path)
+
+    saved_secrets = st.secrets
+    shared_secrets = Secrets()
+    shared_secrets._secrets = dict(secrets)
+    st.secrets = shared_secrets
+    try:
+        with mock.patch.object(Runtime, "instance", classmethod(instance)), \
+                mock.patch.object(Runtime, "exists", classmethod(lambda cls: True)), \
+                mock.patch.object(ScriptCache, "get_bytecode", get_bytecode), \
+                patch_config_options({"global.appTest": True}):
+            yield
+    finally:
+        st.secrets = saved_secrets
+
+
+def run_session(seed_png, ref_png, timeout):
+    """가상 세션 하나의 전체 흐름을 실행하고 단계별 소요시간 반환"""
+    from streamlit.testing.v1 import AppTest
+
+    timings = {}
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+
+    def timed(step, action):
+        start = time.perf_counter()
+        action()
+        timings[step] = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(f"{step}: {at.exception[0].value}")
+
+    timed("initial_load", at.run)
+    timed("upload_seed", lambda: find_by_label(at.file_uploader, SEED_UPLOAD_LABEL)
+          .set_value(("seed.png", seed_png, "image/png")).run())
+    timed("save_seed", lambda: find_by_label(at.button, SAVE_BUTTON_LABEL).click().run())
+    timed("upload_ref", lambda: find_by_label(at.file_uploader, REF_UPLOAD_LABEL)
+          .set_value(("ref.png", ref_png, "image/png")).run())
+    timed("start", lambda: find_by_label(at.button, START_BUTTON_LABEL).click().run())
+
+    def wait_result():
+        # AppTest는 fragment 타이머를 돌리지 않으므로 결과가 표시될 때까지 직접 재실행
+        deadline = time.monotonic() + timeout
+        while not any("헤어 변경 완료" in s.value for s in at.success):
+            if at.error or time.monotonic() > deadline:
+                errors = [e.value for e in at.error] + [w.value for w in at.warning]
+                raise RuntimeError(f"wait_result: 변환 결과가 없습니다 {errors}")
+            time.sleep(RESULT_POLL_INTERVAL)
+            at.run()
+
+    timed("wait_result", wait_result)
+
+    timed("idle_rerun", at.run)
+    return timings
+
+
+def run_level(sessions, seed_png, ref_png, timeout):
+    """동시 세션 수 하나에 대한 부하 실행"""
+    results = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def worker():
+        barrier.wait()
+        try:
+            timings = run_session(seed_png, ref_png, timeout)
+            with lock:
+                results.append(timings)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    rss_before = get_rss_bytes()
+    cpu_before = time.process_time()
+    wall_start = time.perf_counter()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_before
+    rss_after = get_rss_bytes()
+
+    steps = {}
+    for step in STEPS:
+        values = [r[step] for r in results if step in r]
+        steps[step] = {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "max": max(values) if values else 0.0,
+            "mean": statistics.mean(values) if values else 0.0,
+        }
+
+    return {
+        "sessions": sessions,
+        "completed": len(results),
+        "errors": errors,
+        "wall_time": wall_time,
+        "steps": steps,
+        "rss_bytes": rss_after,
+        "rss_per_session": max(0, rss_after - rss_before) / sessions,
+        "cpu_per_session": cpu_time / sessions,
+    }
+
+
+def print_level(report):
+    print(f"\n👥 동시 세션 {report['sessions']}개 - 완료 {report['completed']}, 오류 {len(report['errors'])}, "
+          f"전체 {report['wall_time']:.1f}초")
+    print(f"   RSS {report['rss_bytes'] / 1024 / 1024:.1f}MB "
+          f"(세션당 +{report['rss_per_session'] / 1024 / 1024:.2f}MB), "
+          f"CPU 세션당 {report['cpu_per_session']:.2f}초")
+    print(f"   {'단계':<14}{'p50':>9}{'p95':>9}{'max':>9}")
+    for step in STEPS:
+        stats = report["steps"][step]
+        print(f"   {step:<14}{stats['p50']:>8.2f}s{stats['p95']:>8.2f}s{stats['max']:>8.2f}s")
+    for error in report["errors"][:5]:
+        print(f"   ❌ {error}")
+
+
+# 기능 점검 (--checks) - 시나리오마다 세션 하나를 실행하고 기대한 화면이 나오는지 확인
+CHECKS = []
+
+
+def check(func):
+    CHECKS.append(func)
+    return func
+
+
+def start_transform(at, seed_png, ref_png):
+    """첫 화면 → 시드 업로드/저장 → 참조 업로드 → 변환 시작"""
+    at.run()
+    find_by_label(at.file_uploader, SEED_UPLOAD_LABEL).set_value(("seed.png", seed_png, "image/png")).run()
+    find_by_label(at.button, SAVE_BUTTON_LABEL).click().run()
+    find_by_label(at.file_uploader, REF_UPLOAD_LABEL).set_value(("ref.png", ref_png, "image/png")).run()
+    find_by_label(at.button, START_BUTTON_LABEL).click().run()
+
+
+def rerun_until(at, condition, timeout):
+    """condition()을 만족할 때까지 재실행하고 걸린 시간 반환 (AppTest는 fragment 타이머를 돌리지 않음)"""
+    start = time.monotonic()
+    while not condition():
+        if at.exception:
+            raise AssertionError(at.exception[0].value)
+        if time.monotonic() - start > timeout:
+            errors = [e.value for e in at.error] + [w.value for w in at.warning]
+            raise AssertionError(f"{timeout:.0f}초 안에 기대한 화면이 나오지 않음 {errors}")
+        time.sleep(RESULT_POLL_INTERVAL)
+        at.run()
+    return time.monotonic() - start
+
+
+@check
+def check_status_error_fails_fast(backends, seed_png, ref_png, timeout):
+    """첫 상태 조회가 404(재시도하지 않는 오류)면 Task 대기 제한시간까지 기다리지 않고 바로 실패 표시"""
+    from streamlit.testing.v1 import AppTest
+
+    backends.status_failures.append(404)
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    start_transform(at, seed_png, ref_png)
+    rerun_until(at, lambda: any("Task 상태 확인 실패" in e.value for e in at.error), 15)
+
+
+@check
+def check_metrics_after_job(backends, seed_png, ref_png, timeout):
+    """백그라운드 작업이 끝나면 그 성능 기록이 세션에 들어가 실시간 성능 지표(st.metric)가 표시됨"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    start_transform(at, seed_png, ref_png)
+    rerun_until(at, lambda: any("헤어 변경 완료" in s.value for s in at.success), timeout)
+    at.run()
+    history = at.session_state["performance_history"] if "performance_history" in at.session_state else []
+    if len(history) != 1 or not history[0]["completed"]:
+        raise AssertionError(f"성능 기록이 세션에 없음: {history}")
+    labels = [metric.label for metric in at.metric]
+    if "Accuracy" not in labels:
+        raise AssertionError(f"실시간 성능 지표가 표시되지 않음: {labels}")
+
+
+@contextmanager
+def held_state_writes():
+    """백그라운드 상태 기록의 blob 저장을 release()까지 붙잡아 두고, 사용된 (상태 저장소, blob 저장소)를 모음"""
+    state_store = sys.modules["state_store"]
+    gate = threading.Event()
+    stores = {}
+    pending = []
+    original_blob_put = state_store.MemoryBlobStore.put
+    original_state_put = state_store.MemoryStateStore.put
+
+    def blob_put(self, user_id, data):
+        stores["blobs"] = self
+        pending.append(user_id)
+        try:
+            gate.wait(10)
+            return original_blob_put(self, user_id, data)
+        finally:
+            pending.remove(user_id)
+
+    def state_put(self, namespace, key, value, ttl=None):
+        stores["state"] = self
+        return original_state_put(self, namespace, key, value, ttl)
+
+    def release():
+        gate.set()
+        deadline = time.monotonic() + 10
+        while pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)   # blob 저장 뒤의 정보 기록/되돌리기까지 끝나도록
+        return stores
+
+    with mock.patch.object(state_store.MemoryBlobStore, "put", blob_put), \
+            mock.patch.object(state_store.MemoryStateStore, "put", state_put):
+        yield release
+    gate.set()
+
+
+@check
+def check_new_session_drops_pending_writes(backends, seed_png, ref_png, timeout):
+    """시드 저장이 백그라운드에서 끝나기 전에 새 세션을 시작해도 이전 사용자의 시드/이미지가 되살아나지 않음"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    user_id = at.session_state["user_id"]
+    with held_state_writes() as release:
+        find_by_label(at.file_uploader, SEED_UPLOAD_LABEL).set_value(("seed.png", seed_png, "image/png")).run()
+        find_by_label(at.button, SAVE_BUTTON_LABEL).click().run()
+        find_by_label(at.button, "🔄 새 세션 시작").click().run()
+        stores = release()
+    seeds = stores["state"].items("seeds", f"{user_id}/")
+    blobs = [digest for blob_user_id, digest in stores["blobs"].blobs if blob_user_id == user_id]
+    if seeds or blobs:
+        raise AssertionError(f"삭제한 사용자 상태가 되살아남: 시드 {list(seeds)}, blob {len(blobs)}개")
+
+
+@check
+def check_deleted_seed_stays_deleted(backends, seed_png, ref_png, timeout):
+    """시드 저장이 백그라운드에서 끝나기 전에 삭제해도 저장소에 시드가 다시 기록되지 않음"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    user_id = at.session_state["user_id"]
+    with held_state_writes() as release:
+        find_by_label(at.file_uploader, SEED_UPLOAD_LABEL).set_value(("seed.png", seed_png, "image/png")).run()
+        find_by_label(at.button, SAVE_BUTTON_LABEL).click().run()
+        find_by_label(at.button, "🗑️ 삭제").click().run()
+        stores = release()
+    seeds = stores["state"].items("seeds", f"{user_id}/")
+    if seeds:
+        raise AssertionError(f"삭제한 시드가 되살아남: {list(seeds)}")
+
+
+def run_checks(backends, seed_png, ref_png, timeout):
+    """모든 기능 점검 실행 - 실패한 점검 수 반환"""
+    failed = 0
+    for func in CHECKS:
+        try:
+            func(backends, seed_png, ref_png, timeout)
+            print(f"✅ {func.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {func.__name__}: {e}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streamlit 앱 동시 사용자 부하 테스트")
+    parser.add_argument("--levels", default="1,2,4,8", help="단계별 동시 세션 수 (쉼표 구분)")
+    parser.add_argument("--polls", type=int, default=2, help="가짜 Task가 완료되기까지의 상태 조회 횟수")
+    parser.add_argument("--latency", type=float, default=0.05, help="가짜 백엔드 호출당 지연 (초)")
+    parser.add_argument("--timeout", type=float, default=120, help="스크립트 실행 1회 제한시간 (초)")
+    parser.add_argument("--degrade-factor", type=float, default=2.0,
+                        help="기준 대비 재실행 p95가 이 배수를 넘으면 성능 저하로 판정")
+    parser.add_argument("--local-images", action="store_true",
+                        help="외부 이미지 호스트 대신 앱 자체 이미지 서버 사용 (IMAGE_SERVING_MODE=local)")
+    parser.add_argument("--backends", default=None,
+                        help="사용할 이미지 편집 백엔드 (쉼표 구분, 예: vmodel,local - IMAGE_BACKENDS)")
+    parser.add_argument("--workdir", default=None, help="로그가 기록될 작업 디렉토리 (기본: 임시 디렉토리)")
+    parser.add_argument("--json", dest="json_path", default=None, help="결과를 JSON으로 저장할 경로")
+    parser.add_argument("--checks", action="store_true", help="부하 측정 대신 기능 점검 시나리오 실행")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(",") if level.strip()]
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="hair_loadtest_")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    print("🔧 AI 헤어스타일 서비스 부하 테스트")
+    print("=" * 50)
+    print(f"작업 디렉토리: {workdir}")
+
+    backends = MockBackends(latency=args.latency, polls=args.polls)
+    seed_png = make_png_bytes(size=(1600, 2000))
+    ref_png = make_png_bytes(size=(800, 1000), color=(40, 30, 20))
+
+    secrets = {"VMODEL_API_KEY": "loadtest-key"}
+    if args.local_images:
+        secrets.update(IMAGE_SERVING_MODE="local", LOCAL_IMAGE_BIND="127.0.0.1")
+    if args.backends:
+        secrets["IMAGE_BACKENDS"] = args.backends
+
+    if args.checks:
+        with mock.patch("requests.post", side_effect=backends.post), \
+                mock.patch("requests.get", side_effect=backends.get), \
+                shared_apptest_runtime(secrets):
+            failed = run_checks(backends, seed_png, ref_png, args.timeout)
+        print(f"\n📋 기능 점검 {len(CHECKS)}개 중 실패 {failed}개")
+        return 1 if failed else 0
+
+    reports = []
+    with mock.patch("requests.post", side_effect=backends.post), \
+            mock.patch("requests.get", side_effect=backends.get), \
+            shared_apptest_runtime(secrets):
+        for sessions in levels:
+            report = run_level(sessions, seed_png, ref_png, args.timeout)
+            reports.append(report)
+            print_level(report)
+
+    # 성능 저하 판정: 1단계의 유휴 재실행 p95를 기준으로 비교
+    baseline = reports[0]["steps"]["idle_rerun"]["p95"] if reports else 0
+    capacity = 0
+    for report in reports:
+        rerun_p95 = report["steps"]["idle_rerun"]["p95"]
+        if report["errors"] or (baseline and rerun_p95 > baseline * args.degrade_factor):
+            break
+        capacity = report["sessions"]
+
+    print("\n" + "=" * 50)
+    print(f"📊 백엔드 호출 수: {json.dumps(backends.call_counts, ensure_ascii=False)}")
+    print(f"🎯 재실행 성능 저하 없이 처리 가능한 동시 세션: {capacity}개 "
+          f"(기준 p95 {baseline:.2f}s × {args.degrade_factor})")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"levels": reports, "capacity": capacity, "backend_calls": backends.call_counts},
+                      f, ensure_ascii=False, indent=2)
+        print(f"💾 결과 저장: {json_path}")
+
+    return 0 if capacity else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""
+프로세스별 로그 샤드 기록 및 병합
+
+여러 Streamlit 워커 프로세스(또는 여러 서버)가 같은 로그 파일에 동시에 쓰면 줄이 섞일 수 있어,
+각 프로세스는 자기 샤드 파일(<디렉토리>/shards/<이름>.<호스트>-<PID>.<확장자>)에만 기록합니다.
+한 레코드는 줄바꿈까지 포함해 한 번의 write로 기록하고, 읽을 때는 줄바꿈으로 끝나지 않은
+(기록 중인) 마지막 줄은 건너뜁니다.
+
+읽기는 항상 병합 결과를 반환합니다: 압축된 기준 파일(기존 단일 로그 파일 포함) + 아직 압축되지 않은
+샤드 내용을 중복 제거 후 시간순으로 정렬합니다. 압축(compact)은 샤드 내용을 기준 파일로 옮기고
+샤드별로 어디까지 옮겼는지 manifest에 기록하며, 끝난 프로세스의 샤드는 삭제합니다.
+
+사용 예:
+    python log_shards.py            # 모든 로그 압축
+    python log_shards.py --status   # 샤드 현황만 출력
+"""
+
+import json
+import os
+import re
+import socket
+from contextlib import contextmanager
+
+try:
+    import fcntl  # 다중 프로세스 파일 잠금 (Windows에는 없음)
+except ImportError:
+    fcntl = None
+
+# 압축 대상 기준 로그 파일
+PERFORMANCE_LOG = "performance_data/performance_log.jsonl"
+TEXT_LOGS = [
+    "logs/vmodel_api_raw.log",
+    "logs/success_failures.log",
+    "logs/session.log",
+    "logs/deadline_overruns.log",
+    "logs/admission.log",
+    "logs/image_pool.log",
+]
+
+TIMESTAMP_PATTERN = re.compile(r"^\[([^\]]+)\]")
+
+def get_shard_id():
+    """현재 프로세스의 샤드 식별자 (호스트-PID) - fork 후에도 맞도록 매번 계산"""
+    host = re.sub(r"[^0-9A-Za-z_-]", "_", socket.gethostname()) or "host"
+    return f"{host}-{os.getpid()}"
+
+def get_shard_dir(base_path):
+    return os.path.join(os.path.dirname(base_path) or ".", "shards")
+
+def get_shard_path(base_path, shard_id=None):
+    """기준 로그 파일에 대한 현재 프로세스의 샤드 경로"""
+    stem, extension = os.path.splitext(os.path.basename(base_path))
+    return os.path.join(get_shard_dir(base_path), f"{stem}.{shard_id or get_shard_id()}{extension}")
+
+def list_shards(base_path):
+    """기준 로그 파일의 모든 샤드 파일 이름"""
+    stem, extension = os.path.splitext(os.path.basename(base_path))
+    shard_dir = get_shard_dir(base_path)
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(shard_dir)
+        if name.startswith(f"{stem}.") and name.endswith(extension)
+    )
+
+def _append(base_path, line):
+    """한 줄을 현재 프로세스 샤드 끝에 한 번의 write로 기록"""
+    path = get_shard_path(base_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = (line.replace("\n", " ") + "\n").encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def append_line(base_path, message):
+    """텍스트 로그 한 줄 기록"""
+    _append(base_path, message)
+
+def append_record(base_path, record):
+    """JSONL 레코드 하나 기록"""
+    _append(base_path, json.dumps(record, ensure_ascii=False))
+
+def _read_complete_lines(path, offset=0):
+    """offset 이후의 완결된 줄 목록과 다음 offset 반환 (기록 중인 마지막 줄은 제외)"""
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+    end = data.rfind(b"\n") + 1
+    lines = data[:end].decode("utf-8", errors="replace").splitlines()
+    return [line for line in lines if line.strip()], offset + end
+
+def _load_manifest(base_path):
+    try:
+        with open(base_path + ".manifest.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _write_atomic(path, text):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def _collect_lines(base_path):
+    """(기준 파일 줄 목록, {샤드: (새 줄 목록, 다음 offset)}, manifest) - manifest를 먼저 읽어야 누락이 없음"""
+    manifest = _load_manifest(base_path)
+    base_lines, _ = _read_complete_lines(base_path)
+    shard_dir = get_shard_dir(base_path)
+    shards = {
+        name: _read_complete_lines(os.path.join(shard_dir, name), manifest.get(name, 0))
+        for name in list_shards(base_path)
+    }
+    return base_lines, shards, manifest
+
+def _parse_records(lines):
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+def _merge_records(records):
+    """중복 제거(request_id, 없으면 레코드 전체) 후 timestamp 순 정렬"""
+    merged = {}
+    for record in records:
+        key = record.get("request_id") or json.dumps(record, sort_keys=True, ensure_ascii=False)
+        merged.setdefault(key, record)
+    return sorted(merged.values(), key=lambda record: record.get("timestamp", ""))
+
+def _merge_lines(lines):
+    """같은 줄 중복 제거 후 맨 앞 [timestamp] 기준 정렬 (같은 시각이면 기록 순서 유지)"""
+    unique = list(dict.fromkeys(lines))
+
+    def sort_key(line):
+        match = TIMESTAMP_PATTERN.match(line)
+        return match.group(1) if match else ""
+
+    return sorted(unique, key=sort_key)
+
+def read_records(base_path=PERFORMANCE_LOG):
+    """JSONL 로그의 병합 결과 (중복 제거, 시간순)"""
+    base_lines, shards, _ = _collect_lines(base_path)
+    lines = base_lines + [line for shard_lines, _ in shards.values() for line in shard_lines]
+    return _merge_records(_parse_records(lines))
+
+def read_log_lines(base_path):
+    """텍스트 로그의 병합 결과 (중복 제거, 시간순)"""
+    base_lines, shards, _ = _collect_lines(base_path)
+    lines = base_lines + [line for shard_lines, _ in shards.values() for line in shard_lines]
+    return _merge_lines(lines)
+
+def log_exists(base_path):
+    return os.path.exists(base_path) or bool(list_shards(base_path))
+
+def _is_finished_shard(name):
+    """이 호스트에서 이미 끝난 프로세스의 샤드인지 (다른 호스트 샤드는 판단하지 않음)"""
+    match = re.search(r"\.([0-9A-Za-z_-]+)-(\d+)\.[^.]+$", name)
+    if not match or match.group(1) != get_shard_id().rsplit("-", 1)[0]:
+        return False
+    try:
+        os.kill(int(match.group(2)), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+@contextmanager
+def _compaction_lock(base_path):
+    os.makedirs(os.path.dirname(base_path) or ".", exist_ok=True)
+    with open(base_path + ".lock", "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def compact(base_path, jsonl=None):
+    """샤드 내용을 기준 파일로 병합 - 옮긴 줄 수 반환
+
+    기준 파일을 먼저 교체한 뒤 manifest를 갱신하므로, 중간에 중단되어도
+    같은 줄이 두 번 읽힐 뿐(중복 제거됨) 누락되지는 않습니다.
+    """
+    if jsonl is None:
+        jsonl = base_path.endswith(".jsonl")
+
+    with _compaction_lock(base_path):
+        base_lines, shards, manifest = _collect_lines(base_path)
+        new_lines = [line for shard_lines, _ in shards.values() for line in shard_lines]
+        if new_lines:
+            if jsonl:
+                merged = [json.dumps(record, ensure_ascii=False) for record in _merge_records(_parse_records(base_lines + new_lines))]
+            else:
+                merged = _merge_lines(base_lines + new_lines)
+            _write_atomic(base_path, "".join(f"{line}\n" for line in merged))
+
+        shard_dir = get_shard_dir(base_path)
+        new_manifest = {}
+        for name, (_, offset) in shards.items():
+            path = os.path.join(shard_dir, name)
+            # 끝난 프로세스의 샤드를 끝까지 옮겼으면 삭제
+            if _is_finished_shard(name) and offset >= os.path.getsize(path):
+                os.remove(path)
+                continue
+            new_manifest[name] = offset
+        _write_atomic(base_path + ".manifest.json", json.dumps(new_manifest, ensure_ascii=False, indent=2))
+        return len(new_lines)
+
+def compact_all():
+    """성능 로그와 텍스트 로그 전체 압축 - {파일: 옮긴 줄 수}"""
+    return {path: compact(path) for path in [PERFORMANCE_LOG] + TEXT_LOGS if log_exists(path)}
+
+def shard_status(base_path):
+    """샤드별 크기와 아직 압축되지 않은 바이트 수"""
+    manifest = _load_manifest(base_path)
+    shard_dir = get_shard_dir(base_path)
+    status = {}
+    for name in list_shards(base_path):
+        size = os.path.getsize(os.path.join(shard_dir, name))
+        status[name] = {"size": size, "pending_bytes": size - manifest.get(name, 0)}
+    return status
+
+if __name__ == "__main__":
+    import sys
+
+    paths = [PERFORMANCE_LOG] + TEXT_LOGS
+    if len(sys.argv) > 1 and sys.argv[1] == "--status":
+        print(json.dumps({path: shard_status(path) for path in paths if log_exists(path)}, ensure_ascii=False, indent=2))
+    else:
+        for path, moved in compact_all().items():
+            print(f"📦 {path}: {moved}줄 병합")
@@ -0,0 +1,451 @@
+"""
+공유 상태 저장소 (사용자 상태 기록 + 이미지 바이트)
+
+세션 상태(st.session_state)는 그 세션을 처리하는 프로세스에만 있어서, 여러 서버(레플리카)에 분산하면
+같은 사용자를 항상 같은 서버로 보내야 하고(sticky session) 서버를 재시작하면 상태가 사라집니다.
+이 모듈은 시드/처리 기록/Task 기록 같은 작은 JSON 값을 (namespace, key) 단위로 보관하는 상태 저장소와,
+이미지 바이트를 사용자별 디렉토리에 내용 해시 이름으로 보관하는 blob 저장소를 제공합니다.
+
+상태 저장소 (모두 같은 메서드: get/put/delete/items/modify/stats):
+    memory                      프로세스 메모리 (기본, 서버 간 공유 안 됨)
+    sqlite:///공유디스크/state.db  여러 프로세스/서버가 같은 SQLite 파일 사용
+    redis://호스트:6379/0         Redis 프로토콜 서버 (redis 패키지 필요)
+
+값은 JSON으로 저장하며 ttl(초)이 지나면 읽을 때 보이지 않고 주기적으로 정리됩니다.
+
+사용 예:
+    store = open_state_store("sqlite:///mnt/shared/state.db")
+    store.put("seeds", "user1/ab12cd34", {"filename": "me.png"}, ttl=3600)
+    store.items("seeds", "user1/")
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis  # Redis 프로토콜 상태 저장소 (선택사항)
+except ImportError:
+    redis = None
+
+PRUNE_INTERVAL = 60   # 만료된 값/파일 정리 간격 (초)
+
+def _expires_at(ttl):
+    return time.time() + ttl if ttl else None
+
+def _is_expired(expires_at, now=None):
+    return expires_at is not None and expires_at <= (now or time.time())
+
+class MemoryStateStore:
+    """프로세스 메모리 상태 저장소 - 같은 프로세스의 세션끼리만 공유 (새로고침 후 복원용)"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self):
+        self.values = {}   # (namespace, key) -> (value, 만료 시각)
+        self.lock = threading.Lock()
+        self.last_pruned = time.monotonic()
+
+    def _prune(self):
+        if time.monotonic() - self.last_pruned < PRUNE_INTERVAL:
+            return
+        self.last_pruned = time.monotonic()
+        now = time.time()
+        for name in [name for name, (_, expires_at) in self.values.items() if _is_expired(expires_at, now)]:
+            del self.values[name]
+
+    def get(self, namespace, key):
+        with self.lock:
+            value, expires_at = self.values.get((namespace, key), (None, None))
+            return None if _is_expired(expires_at) else json.loads(value) if value is not None else None
+
+    def put(self, namespace, key, value, ttl=None):
+        # JSON으로 직렬화해서 보관 (다른 저장소와 같은 값만 받고, 호출한 쪽이 값을 바꿔도 영향 없도록)
+        encoded = json.dumps(value, ensure_ascii=False)
+        with self.lock:
+            self._prune()
+            self.values[(namespace, key)] = (encoded, _expires_at(ttl))
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.values.pop((namespace, key), None)
+
+    def items(self, namespace, prefix=""):
+        """namespace에서 key가 prefix로 시작하는 값 {key: value}"""
+        now = time.time()
+        with self.lock:
+            return {
+                key: json.loads(value) for (item_namespace, key), (value, expires_at) in self.values.items()
+                if item_namespace == namespace and key.startswith(prefix) and not _is_expired(expires_at, now)
+            }
+
+    def modify(self, namespace, key, change, ttl=None):
+        """change(현재 값 또는 None)의 반환값으로 원자적으로 교체 - None을 반환하면 그대로 둠"""
+        with self.lock:
+            value, expires_at = self.values.get((namespace, key), (None, None))
+            current = None if value is None or _is_expired(expires_at) else json.loads(value)
+            updated = change(current)
+            if updated is not None:
+                self.values[(namespace, key)] = (json.dumps(updated, ensure_ascii=False), _expires_at(ttl))
+            return updated
+
+    def stats(self):
+        counts = {}
+        now = time.time()
+        with self.lock:
+            for (namespace, _), (_, expires_at) in self.values.items():
+                if not _is_expired(expires_at, now):
+                    counts[namespace] = counts.get(namespace, 0) + 1
+        return {"backend": self.name, "shared": self.shared, "counts": counts}
+
+class SQLiteStateStore:
+    """SQLite 파일 상태 저장소 - 공유 디스크에 두면 여러 서버가 같은 상태를 사용
+
+    호출마다 연결을 새로 열어 스레드/프로세스 간 연결을 공유하지 않고, 읽고 바꾸는 작업(modify)은
+    BEGIN IMMEDIATE 트랜잭션으로 다른 프로세스의 쓰기와 겹치지 않게 합니다.
+    """
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.last_pruned = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        return _ClosingConnection(connection)
+
+    def _prune(self, connection):
+        if time.monotonic() - self.last_pruned < PRUNE_INTERVAL:
+            return
+        self.last_pruned = time.monotonic()
+        connection.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+    def get(self, namespace, key):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, namespace, key, value, ttl=None):
+        with self._connect() as connection:
+            self._prune(connection)
+            connection.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), _expires_at(ttl))
+            )
+
+    def delete(self, namespace, key):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace, prefix=""):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT key, value FROM state WHERE namespace = ? AND substr(key, 1, ?) = ? "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, len(prefix), prefix, time.time())
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def modify(self, namespace, key, change, ttl=None):
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                    (namespace, key, time.time())
+                ).fetchone()
+                updated = change(json.loads(row[0]) if row else None)
+                if updated is not None:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                        (namespace, key, json.dumps(updated, ensure_ascii=False), _expires_at(ttl))
+                    )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return updated
+
+    def stats(self):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT namespace, COUNT(*) FROM state WHERE expires_at IS NULL OR expires_at > ? GROUP BY namespace",
+                (time.time(),)
+            ).fetchall()
+        return {"backend": self.name, "shared": self.shared, "path": os.path.abspath(self.path), "counts": dict(rows)}
+
+class _ClosingConnection:
+    """with 블록이 끝나면 연결을 닫음 (sqlite3 연결의 with는 커밋만 하고 닫지 않음)"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+class RedisStateStore:
+    """Redis 프로토콜 상태 저장소 - 키는 <prefix><namespace>:<key>, 만료는 Redis TTL 사용"""
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, url, prefix="hairstyle:"):
+        if redis is None:
+            raise RuntimeError("Redis 상태 저장소를 사용하려면 redis 패키지가 필요합니다 (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _name(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace, key):
+        value = self.client.get(self._name(namespace, key))
+        return json.loads(value) if value is not None else None
+
+    def put(self, namespace, key, value, ttl=None):
+        self.client.set(self._name(namespace, key), json.dumps(value, ensure_ascii=False), ex=int(ttl) if ttl else None)
+
+    def delete(self, namespace, key):
+        self.client.delete(self._name(namespace, key))
+
+    def items(self, namespace, prefix=""):
+        start = len(self._name(namespace, ""))
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", self._name(namespace, prefix)) + "*"
+        names = list(self.client.scan_iter(match=pattern))
+        if not names:
+            return {}
+        # 목록을 읽는 사이에 만료된 키는 None
+        return {
+            name.decode("utf-8")[start:]: json.loads(value)
+            for name, value in zip(names, self.client.mget(names)) if value is not None
+        }
+
+    def modify(self, namespace, key, change, ttl=None):
+        name = self._name(namespace, key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    value = pipe.get(name)
+                    updated = change(json.loads(value) if value is not None else None)
+                    if updated is None:
+                        pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    pipe.set(name, json.dumps(updated, ensure_ascii=False), ex=int(ttl) if ttl else None)
+                    pipe.execute()
+                    return updated
+                except redis.WatchError:
+                    # 다른 서버가 그 사이에 바꿈 - 새 값으로 다시 계산
+                    continue
+
+    def stats(self):
+        counts = {}
+        for name in self.client.scan_iter(match=re.sub(r"([*?\[\]\\])", r"\\\1", self.prefix) + "*"):
+            namespace = name.decode("utf-8")[len(self.prefix):].split(":", 1)[0]
+            counts[namespace] = counts.get(namespace, 0) + 1
+        return {"backend": self.name, "shared": self.shared, "counts": counts}
+
+def open_state_store(url):
+    """STATE_BACKEND 설정값으로 상태 저장소 생성 - "memory" | "sqlite:///경로" | "redis://..." (rediss:// 포함)"""
+    url = (url or "memory").strip()
+    if url == "memory":
+        return MemoryStateStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStateStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateStore(url)
+    raise ValueError(f"알 수 없는 상태 저장소: {url}")
+
+# 이미지 바이트 저장소 - 내용 해시(digest)로 저장하고 상태 저장소에는 digest만 기록
+USER_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+def compute_digest(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def _check_user_id(user_id):
+    # 사용자 ID가 그대로 디렉토리 이름이 되므로 경로 문자 차단
+    if not USER_ID_PATTERN.fullmatch(user_id):
+        raise ValueError(f"잘못된 사용자 ID: {user_id!r}")
+
+class MemoryBlobStore:
+    """프로세스 메모리 blob 저장소 (기본) - {(사용자, digest): (바이트, 저장 시각)}, 오래 안 쓴 순서
+
+    max_bytes를 넘으면 가장 오래 쓰지 않은 blob부터 버립니다 (버린 이미지의 시드/기록은 복원할 때 건너뜀).
+    """
+
+    name = "memory"
+    shared = False
+
+    def __init__(self, ttl=None, max_bytes=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.blobs = OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.last_pruned = time.monotonic()
+
+    def put(self, user_id, data):
+        """바이트 저장 후 digest 반환 (같은 내용이면 저장 시각만 갱신)"""
+        _check_user_id(user_id)
+        digest = compute_digest(data)
+        with self.lock:
+            self._prune()
+            self._remove((user_id, digest))
+            self.blobs[(user_id, digest)] = (data, time.time())
+            self.size += len(data)
+            while self.max_bytes and self.size > self.max_bytes and len(self.blobs) > 1:
+                self._remove(next(iter(self.blobs)))
+                self.evicted += 1
+        return digest
+
+    def get(self, user_id, digest):
+        with self.lock:
+            data, saved_at = self.blobs.get((user_id, digest), (None, None))
+            if data is None:
+                return None
+            if self.ttl and saved_at < time.time() - self.ttl:
+                self._remove((user_id, digest))
+                return None
+            self.blobs.move_to_end((user_id, digest))
+        return data
+
+    def delete(self, user_id, digest):
+        with self.lock:
+            self._remove((user_id, digest))
+
+    def delete_user(self, user_id):
+        with self.lock:
+            for key in [key for key in self.blobs if key[0] == user_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        data, _ = self.blobs.pop(key, (None, None))
+        if data is not None:
+            self.size -= len(data)
+
+    def _prune(self):
+        if not self.ttl or time.monotonic() - self.last_pruned < PRUNE_INTERVAL:
+            return
+        self.last_pruned = time.monotonic()
+        cutoff = time.time() - self.ttl
+        for key in [key for key, (_, saved_at) in self.blobs.items() if saved_at < cutoff]:
+            self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            users = len({user_id for user_id, _ in self.blobs})
+            return {"backend": self.name, "shared": self.shared, "users": users, "blobs": len(self.blobs),
+                    "bytes": self.size, "max_bytes": self.max_bytes, "evicted": self.evicted}
+
+class FileBlobStore:
+    """디렉토리 blob 저장소 - <디렉토리>/<사용자>/<digest> 파일 (공유 디스크에 두면 서버 간 공유)
+
+    같은 내용은 같은 파일이므로 다시 쓰지 않고 수정 시각만 갱신하며, ttl이 지난 파일은 주기적으로 삭제합니다.
+    """
+
+    name = "directory"
+    shared = True
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.last_pruned = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id, digest=""):
+        _check_user_id(user_id)
+        return os.path.join(self.directory, user_id, digest)
+
+    def put(self, user_id, data):
+        digest = compute_digest(data)
+        path = self._path(user_id, digest)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 임시 파일에 쓰고 교체 (다른 서버가 쓰는 도중의 파일을 읽지 않도록)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        self._prune()
+        return digest
+
+    def get(self, user_id, digest):
+        try:
+            with open(self._path(user_id, digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, user_id, digest):
+        try:
+            os.remove(self._path(user_id, digest))
+        except FileNotFoundError:
+            pass
+
+    def delete_user(self, user_id):
+        shutil.rmtree(self._path(user_id), ignore_errors=True)
+
+    def _prune(self):
+        with self.lock:
+            if not self.ttl or time.monotonic() - self.last_pruned < PRUNE_INTERVAL:
+                return
+            self.last_pruned = time.monotonic()
+        cutoff = time.time() - self.ttl
+        for user_id in os.listdir(self.directory):
+            user_dir = os.path.join(self.directory, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            for name in os.listdir(user_dir):
+                try:
+                    if os.path.getmtime(os.path.join(user_dir, name)) < cutoff:
+                        os.remove(os.path.join(user_dir, name))
+                except FileNotFoundError:
+                    continue   # 다른 서버가 먼저 정리함
+            try:
+                os.rmdir(user_dir)   # 비어 있을 때만 삭제됨
+            except OSError:
+                pass
+
+    def stats(self):
+        users = blobs = size = 0
+        for user_id in os.listdir(self.directory):
+            user_dir = os.path.join(self.directory, user_id)
+            if os.path.isdir(user_dir):
+                users += 1
+                for entry in os.scandir(user_dir):
+                    blobs += 1
+                    size += entry.stat().st_size
+        return {"backend": self.name, "shared": self.shared, "directory": os.path.abspath(self.directory),
+                "users": users, "blobs": blobs, "bytes": size}
+
+def open_blob_store(directory=None, ttl=None, max_bytes=None):
+    """디렉토리를 지정하면 파일 blob 저장소, 아니면 메모리 blob 저장소 (max_bytes: 메모리 저장소 최대 크기)"""
+    return FileBlobStore(directory, ttl) if directory else MemoryBlobStore(ttl, max_bytes)
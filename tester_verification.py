@@ -4,25 +4,21 @@
 SSH 접속 후 이 파일을 실행하여 VModel AI 성능을 독립적으로 검증
 """
 
-import json
 import os
 from datetime import datetime
 
+import log_shards
+
 def calculate_ktcc_metrics():
     """KTCC 기준에 따른 성능 지표 계산"""
     
     print("🔍 VModel AI 성능 지표 독립 검증 시작...")
     
-    # 성능 로그 파일 읽기
-    performance_data = []
-    try:
-        with open("performance_data/performance_log.jsonl", "r", encoding='utf-8') as f:
-            for line in f:
-                if line.strip():
-                    performance_data.append(json.loads(line))
-    except FileNotFoundError:
+    # 성능 로그 읽기 (기준 파일 + 프로세스별 샤드 병합)
+    if not log_shards.log_exists(log_shards.PERFORMANCE_LOG):
         print("❌ 성능 데이터 파일을 찾을 수 없습니다.")
         return
+    performance_data = log_shards.read_records(log_shards.PERFORMANCE_LOG)
     
     if not performance_data:
         print("❌ 성능 데이터가 없습니다.")
@@ -40,7 +36,7 @@ def calculate_ktcc_metrics():
     f1_score = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
     
     # 처리 시간 분석
-    processing_times = [record['total_time'] for record in performance_data if record['success']]
+    processing_times = [record['processing_time'] for record in performance_data if record['success']]
     avg_processing_time = sum(processing_times) / len(processing_times) if processing_times else 0
     
     # 결과 출력
@@ -59,8 +55,24 @@ def calculate_ktcc_metrics():
     print()
     print("⏱️ 처리 시간 (60초 기준):")
     print(f"   평균 처리 시간: {avg_processing_time:.1f}초 {'✅' if avg_processing_time <= 60 else '❌'}")
+
+    # 품질 모드별 처리 시간 (기록에 quality_mode가 없으면 고품질)
+    mode_times = {}
+    for record in performance_data:
+        if record['success']:
+            mode_times.setdefault(record.get('quality_mode', 'high'), []).append(record['processing_time'])
+    for mode, times in sorted(mode_times.items()):
+        print(f"   {mode} 모드: 평균 {sum(times) / len(times):.1f}초 ({len(times)}건)")
     print()
     
+    # 과부하로 시작 전에 거절한 요청은 모델 실패가 아니므로 위 지표에서 제외하고 따로 표시
+    if log_shards.log_exists("logs/admission.log"):
+        admission_lines = log_shards.read_log_lines("logs/admission.log")
+        shed = sum(1 for line in admission_lines if "ADMISSION_REJECT:" in line)
+        queued = sum(1 for line in admission_lines if "ADMISSION_QUEUE:" in line)
+        print(f"🚦 과부하로 거절한 요청: {shed}건, 대기열 입장: {queued}건 (성능 지표에서 제외)")
+        print()
+    
     # 전체 기준 통과 여부
     all_passed = (accuracy >= 75 and precision >= 75 and 
                  recall >= 75 and f1_score >= 75 and 
@@ -88,25 +100,22 @@ def show_raw_logs():
     print("\n📄 VModel API 원본 로그:")
     print("-" * 40)
     
-    try:
-        with open("logs/vmodel_api_raw.log", "r", encoding='utf-8') as f:
-            content = f.read()
-            print(content[-2000:])  # 마지막 2000자만 표시
-    except FileNotFoundError:
+    if not log_shards.log_exists("logs/vmodel_api_raw.log"):
         print("❌ 로그 파일을 찾을 수 없습니다.")
+        return
+    content = "\n".join(log_shards.read_log_lines("logs/vmodel_api_raw.log"))
+    print(content[-2000:])  # 마지막 2000자만 표시
 
 def show_success_summary():
     """성공/실패 요약 표시"""
     print("\n📊 성공/실패 요약:")
     print("-" * 40)
     
-    try:
-        with open("logs/success_failures.log", "r", encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines[-10:]:  # 마지막 10개 결과만 표시
-                print(line.strip())
-    except FileNotFoundError:
+    if not log_shards.log_exists("logs/success_failures.log"):
         print("❌ 요약 로그를 찾을 수 없습니다.")
+        return
+    for line in log_shards.read_log_lines("logs/success_failures.log")[-10:]:  # 마지막 10개 결과만 표시
+        print(line.strip())
 
 if __name__ == "__main__":
     import sys
@@ -121,8 +130,11 @@ if __name__ == "__main__":
             show_raw_logs()
         elif sys.argv[1] == "--summary":
             show_success_summary()
+        elif sys.argv[1] == "--compact":
+            for path, moved in log_shards.compact_all().items():
+                print(f"📦 {path}: {moved}줄 병합")
         else:
-            print("사용법: python tester_verification.py [--metrics|--logs|--summary]")
+            print("사용법: python tester_verification.py [--metrics|--logs|--summary|--compact]")
     else:
         # 전체 검증 실행
         calculate_ktcc_metrics()